@@ -0,0 +1,110 @@
+import time
+import threading
+import numpy as np
+
+from collections import OrderedDict
+
+from app.chatbot.embedding_cache import normalize_text
+
+
+def normalize_facts(desired_fact, fact_provided):
+    # key part for a (desired_fact, fact_provided) pair, independent of ordering, spacing and case
+    desired = tuple(sorted({normalize_text(fact) for fact in desired_fact or []}))
+    provided = []
+    for fact_type, fact in (fact_provided or {}).items():
+        facts = fact if isinstance(fact, list) else [fact]
+        provided.append((fact_type, tuple(sorted(normalize_text(item) for item in facts))))
+    return desired, tuple(sorted(provided))
+
+def answer_cache_key(catalog_hash, desired_fact, fact_provided, top_ids):
+    # row ids only name the same rows within one catalog, the one of the config that retrieved them
+    return (catalog_hash, *normalize_facts(desired_fact, fact_provided), tuple(int(doc_id) for doc_id in top_ids))
+
+class AnswerCache():
+    # generated answers keyed on the normalized facts and the retrieved row ids,
+    # optionally also found by a near-duplicate question over the same rows
+    def __init__(self, max_size=1024, ttl=3600, similarity=None, embed=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity = similarity if embed is not None else None
+        self.embed = embed
+        self.version = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "near_hits": 0, "misses": 0, "expired": 0, "evictions": 0, "invalidations": 0}
+
+    def check_version(self, catalog_hash):
+        # answers quote catalog rows, a new catalog drops all of them
+        with self.lock:
+            if catalog_hash != self.version:
+                if self.version is not None:
+                    self.counters["invalidations"] += len(self.entries)
+                self.entries.clear()
+                self.version = catalog_hash
+
+    def _fresh(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if self.ttl and time.time() - entry["created_at"] > self.ttl:
+            del self.entries[key]
+            self.counters["expired"] += 1
+            return None
+        return entry
+
+    def question_embedding(self, question):
+        if self.similarity is None:
+            return None
+        vector = np.asarray(self.embed([question])[0], dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def get(self, key, question=None):
+        with self.lock:
+            entry = self._fresh(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return entry["answer"]
+            # a near duplicate asks for the same facts (same catalog and desired facts) about the same rows
+            candidates = [other for other in self.entries if other[:2] == key[:2] and other[-1] == key[-1]] if self.similarity is not None and question else []
+
+        if len(candidates) > 0:
+            embedding = self.question_embedding(question)
+            with self.lock:
+                best, best_similarity = None, self.similarity
+                for other in candidates:
+                    entry = self._fresh(other)
+                    if entry is not None and entry["embedding"] is not None and float(entry["embedding"] @ embedding) >= best_similarity:
+                        best, best_similarity = other, float(entry["embedding"] @ embedding)
+                if best is not None:
+                    self.entries.move_to_end(best)
+                    self.counters["near_hits"] += 1
+                    return self.entries[best]["answer"]
+
+        with self.lock:
+            self.counters["misses"] += 1
+        return None
+
+    def put(self, key, answer, question=None):
+        embedding = self.question_embedding(question) if question else None
+        with self.lock:
+            self.entries[key] = {"answer": answer, "created_at": time.time(), "embedding": embedding}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.counters["invalidations"] += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counters["hits"] + self.counters["near_hits"] + self.counters["misses"]
+            return {
+                **self.counters,
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hit_rate": (self.counters["hits"] + self.counters["near_hits"]) / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,186 @@
+from app.chatbot.checksum import file_hash
+from app.chatbot.fuzzy_index import NgramIndex
+from app.chatbot.bm25_index import BM25Index
+from app.chatbot.semantic_index import save_matrix_index
+
+import os
+import json
+import time
+import shutil
+import numpy as np
+import pandas as pd
+
+
+ARTIFACT_FORMAT = 1
+
+def bundle_version(source_hash):
+    return source_hash[:16]
+
+def save_catalog(df, path, tombstones=None):
+    # one file per column: numeric columns as plain arrays, text columns as
+    # utf-8 bytes + offsets + null mask (the arrow string layout).
+    # tombstones are doc_ids of rows removed from the source, kept so the other doc_ids stay stable
+    os.makedirs(path, exist_ok=True)
+    if tombstones is not None and len(tombstones) > 0:
+        np.save(os.path.join(path, "tombstones.npy"), np.asarray(tombstones, dtype=np.int64))
+    columns = []
+    for i, col in enumerate(df.columns):
+        series = df[col]
+        if pd.api.types.is_numeric_dtype(series):
+            np.save(os.path.join(path, f"values_{i}.npy"), series.to_numpy())
+            columns.append({"name": col, "kind": "numeric"})
+        else:
+            null = series.isna().to_numpy()
+            encoded = [b"" if is_null else str(value).encode("utf-8") for value, is_null in zip(series.to_list(), null)]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(value) for value in encoded])
+            np.save(os.path.join(path, f"data_{i}.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+            np.save(os.path.join(path, f"offsets_{i}.npy"), offsets)
+            np.save(os.path.join(path, f"null_{i}.npy"), null)
+            columns.append({"name": col, "kind": "string"})
+
+    with open(os.path.join(path, "columns.json"), "w", encoding="utf-8") as f:
+        json.dump({"columns": columns, "rows": len(df)}, f, ensure_ascii=False)
+
+def load_catalog(path, columns=None):
+    # columns limits the load to a subset, the frame keeps every row
+    with open(os.path.join(path, "columns.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    data = {}
+    for i, col in enumerate(manifest["columns"]):
+        if columns is not None and col["name"] not in columns:
+            continue
+        if col["kind"] == "numeric":
+            data[col["name"]] = np.load(os.path.join(path, f"values_{i}.npy"))
+        else:
+            raw = np.load(os.path.join(path, f"data_{i}.npy")).tobytes()
+            offsets = np.load(os.path.join(path, f"offsets_{i}.npy")).tolist()
+            null = np.load(os.path.join(path, f"null_{i}.npy")).tolist()
+            data[col["name"]] = pd.Series(
+                [np.nan if null[j] else raw[offsets[j]:offsets[j + 1]].decode("utf-8") for j in range(manifest["rows"])],
+                dtype=object,
+            )
+
+    df = pd.DataFrame(data, index=pd.RangeIndex(manifest["rows"]))
+    tombstones_path = os.path.join(path, "tombstones.npy")
+    if os.path.isfile(tombstones_path):
+        df.attrs["tombstones"] = np.load(tombstones_path).tolist()
+    return df
+
+def build_bundle(df_path, artifact_dir, col_to_embed, embed_documents=None, column_embeddings=None, matrix_dtype="float32", model_name="", force=False):
+    # column_embeddings (e.g. exported from Chroma) wins over embed_documents, with neither the bundle has no embeddings
+    source_hash = file_hash(df_path)
+    version = bundle_version(source_hash)
+    bundle_path = os.path.join(artifact_dir, version)
+    if os.path.isfile(os.path.join(bundle_path, "manifest.json")) and not force:
+        print(f"bundle {version} already built")
+        return bundle_path
+
+    timings = {}
+    start = time.perf_counter()
+    df = pd.read_csv(df_path)
+    timings["read_csv"] = time.perf_counter() - start
+
+    tmp_path = f"{bundle_path}.{os.getpid()}.tmp"
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    start = time.perf_counter()
+    save_catalog(df, os.path.join(tmp_path, "catalog"))
+    timings["catalog"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    NgramIndex.build(df, ["Nama Obat", "Manufaktur"], source_hash=source_hash).save(os.path.join(tmp_path, "ngram.npz"))
+    timings["ngram"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    BM25Index.build(df, col_to_embed, source_hash).save(os.path.join(tmp_path, "bm25"))
+    timings["bm25"] = time.perf_counter() - start
+
+    if column_embeddings is None and embed_documents is not None:
+        start = time.perf_counter()
+        column_embeddings = {col: embed_documents([str(text) for text in df[col].to_list()]) for col in col_to_embed}
+        timings["embed"] = time.perf_counter() - start
+    if column_embeddings is not None:
+        start = time.perf_counter()
+        save_matrix_index(os.path.join(tmp_path, "embeddings"), column_embeddings, matrix_dtype, model_name)
+        timings["embeddings"] = time.perf_counter() - start
+
+    manifest = {
+        "format": ARTIFACT_FORMAT,
+        "version": version,
+        "source_hash": source_hash,
+        "source_path": os.path.abspath(df_path),
+        "rows": len(df),
+        "columns": df.columns.to_list(),
+        "col_to_embed": col_to_embed,
+        "embedding_model": model_name if column_embeddings is not None else None,
+        "matrix_dtype": matrix_dtype if column_embeddings is not None else None,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "build_seconds": timings,
+    }
+    with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    if os.path.isdir(bundle_path):
+        shutil.rmtree(bundle_path)
+    os.rename(tmp_path, bundle_path)
+    set_current_version(artifact_dir, version)
+    return bundle_path
+
+def set_current_version(artifact_dir, version):
+    tmp_path = os.path.join(artifact_dir, f"CURRENT.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(version)
+    os.replace(tmp_path, os.path.join(artifact_dir, "CURRENT"))
+
+def current_version(artifact_dir):
+    try:
+        with open(os.path.join(artifact_dir, "CURRENT")) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def current_manifest(artifact_dir):
+    # manifest of the bundle CURRENT points to, the one update_index (or build_index) finished last
+    version = current_version(artifact_dir)
+    if version is None:
+        return None
+    manifest_path = os.path.join(artifact_dir, version, "manifest.json")
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    return manifest if manifest["format"] == ARTIFACT_FORMAT else None
+
+def load_manifest(artifact_dir, source_hash):
+    manifest_path = os.path.join(artifact_dir, bundle_version(source_hash), "manifest.json")
+    if not os.path.isfile(manifest_path):
+        return None
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest["format"] != ARTIFACT_FORMAT or manifest["source_hash"] != source_hash:
+        return None
+    return manifest
+
+def load_bundle(artifact_dir, source_hash):
+    bundle_path = os.path.join(artifact_dir, bundle_version(source_hash))
+    manifest = load_manifest(artifact_dir, source_hash)
+    if manifest is None:
+        return None
+
+    embeddings_path = os.path.join(bundle_path, "embeddings")
+    chroma_path = os.path.join(bundle_path, "chroma")
+    return {
+        "manifest": manifest,
+        "df": load_catalog(os.path.join(bundle_path, "catalog")),
+        "ngram_index": NgramIndex.load(os.path.join(bundle_path, "ngram.npz")),
+        # the BM25 arrays are memory-mapped and shared between worker processes
+        "bm25_index": BM25Index.load(os.path.join(bundle_path, "bm25"), mmap=True),
+        "matrix_path": embeddings_path if os.path.isdir(embeddings_path) else None,
+        # written by update_index, doc_ids of the shared Chroma directory only match build_index bundles
+        "chroma_path": chroma_path if os.path.isdir(chroma_path) else None,
+    }
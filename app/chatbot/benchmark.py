@@ -0,0 +1,585 @@
+from app.chatbot.chatbot_utils import *
+from app.chatbot.fuzzy_index import NgramIndex
+from app.chatbot.fusion import HYBRID_WEIGHTS, rrf_top_k
+from app.chatbot.bm25_index import BM25Index
+from app.chatbot.artifacts import build_bundle, load_bundle
+from app.chatbot.semantic_index import MatrixSemanticIndex, save_matrix_index, export_chroma_embeddings
+from app.chatbot.retrieval_pool import RetrievalPool, PrecomputedEmbeddings, fact_texts
+from app.chatbot.embedding_cache import CachedEmbeddings
+
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+from rapidfuzz.distance import JaroWinkler
+
+
+def LegacyReciprocalRankFusion(rank_df, k, name):
+    rank_df[name] = rank_df.apply(lambda x: sum(1 / (k + x[col]) if "jaro_winkler" not in col else 2 / (k + x[col]) for col in rank_df.columns if "rank" in col), axis=1).rank(ascending=False, method="min")
+    return rank_df
+
+class LegacyJaroWinklerRanking():
+    # per-row apply implementation kept as the reference for parity checks
+    def __init__(self, doc_df):
+        self.doc_df = doc_df
+        self.doc_len = len(doc_df)
+        self.df = pd.DataFrame({"id": [i for i in range(self.doc_len)]})
+
+    def rank(self, query_dict):
+        for query_type, query in query_dict.items():
+            if query_type in ["Nama Obat", "Manufaktur"]:
+                items = list(enumerate(query)) if isinstance(query, list) else [(None, query)]
+                for i, item in items:
+                    col_name = f"{query_type}_{i}_score" if i is not None else f"{query_type}_score"
+                    results = self.doc_df[[query_type]].copy()
+                    results["score"] = results[query_type].apply(lambda x: JaroWinkler.similarity(x, item))
+                    results_id = results.sort_values(by="score", ascending=False).index.to_list()
+                    results_score = results.sort_values(by="score", ascending=False)["score"].to_list()
+
+                    col_df = pd.DataFrame({"id": results_id, col_name: results_score})
+                    col_df["id"] = col_df["id"].astype(int)
+                    self.df = pd.merge(left=self.df, right=col_df, how="left", on="id")
+                    self.df[col_name] = self.df[col_name].fillna(self.df[col_name].min())
+
+        rank_df = self.df.copy()
+        rank_df["jaro_winkler_rank"] = rank_df.apply(lambda x: sum(x[col] for col in rank_df.columns if "score" in col) / len(query_dict), axis=1).rank(ascending=False, method="min")
+
+        return rank_df[["id", "jaro_winkler_rank"]]
+
+
+class LegacySemanticRanking():
+    # one embedding and one vector query per fact, kept as the reference for parity checks
+    def __init__(self, vector_db, doc_df):
+        self.retriever = vector_db
+        self.doc_df = doc_df
+        self.doc_len = len(doc_df)
+        self.df = pd.DataFrame({"id": [i for i in range(self.doc_len)]})
+
+    def rank(self, query_dict):
+        for query_type, query in query_dict.items():
+            if query_type not in ["Nama Obat", "Manufaktur"]:
+                items = list(enumerate(query)) if isinstance(query, list) else [(None, query)]
+                for i, item in items:
+                    col_name = f"{query_type}_{i}_score" if i is not None else f"{query_type}_score"
+                    results = self.retriever.similarity_search_with_relevance_scores(item, filter={"column": query_type}, k=self.doc_len)
+                    results_id = [result[0].metadata["doc_id"] for result in results]
+                    results_score = [result[1] for result in results]
+
+                    col_df = pd.DataFrame({"id": results_id, col_name: results_score})
+                    col_df["id"] = col_df["id"].astype(int)
+                    self.df = pd.merge(left=self.df, right=col_df, how="left", on="id")
+                    self.df[col_name] = self.df[col_name].fillna(self.df[col_name].min())
+
+        rank_df = self.df.copy()
+        rank_df["semantic_rank"] = rank_df.apply(lambda x: sum(x[col] for col in rank_df.columns if "score" in col) / len(query_dict), axis=1).rank(ascending=False, method="min")
+
+        return rank_df[["id", "semantic_rank"]]
+
+def create_legacy_lexical_retrievers(df, col_to_embed):
+    from langchain_community.retrievers import BM25Retriever
+
+    lexical_retrievers = {}
+    for col in col_to_embed:
+        lexical_retrievers[col] = BM25Retriever.from_texts(
+            texts=[str(text) for text in df[col].to_list()],
+            metadatas=[{"doc_id": str(doc_id), "column": col} for doc_id in range(len(df))],
+        )
+        lexical_retrievers[col].k = len(df)
+    return lexical_retrievers
+
+class LegacyLexicalRanking():
+    # one BM25Retriever per column returning every Document, kept as the reference for parity checks
+    def __init__(self, retrievers, doc_df):
+        self.retrievers = retrievers
+        self.doc_len = len(doc_df)
+        self.df = pd.DataFrame({"id": [i for i in range(self.doc_len)]})
+
+    def rank(self, query_dict):
+        for query_type, query in query_dict.items():
+            if query_type not in ["Nama Obat", "Manufaktur"]:
+                items = list(enumerate(query)) if isinstance(query, list) else [(None, query)]
+                for i, item in items:
+                    col_name = f"{query_type}_{i}_rank" if i is not None else f"{query_type}_rank"
+                    results = self.retrievers[query_type].invoke(item)
+                    results_id = [result.metadata["doc_id"] for result in results]
+
+                    col_df = pd.DataFrame({"id": results_id, col_name: [i for i in range(1, self.doc_len + 1)]})
+                    col_df["id"] = col_df["id"].astype(int)
+                    self.df = pd.merge(left=self.df, right=col_df, how="left", on="id")
+
+        rank_df = LegacyReciprocalRankFusion(self.df, 60, "lexical_rank")
+
+        return rank_df[["id", "lexical_rank"]]
+
+def sample_name_queries(df, n_queries, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = df.sample(n=n_queries, random_state=seed)
+    queries = []
+    for _, row in rows.iterrows():
+        name = str(row["Nama Obat"]).lower().split()
+        name = " ".join(name[:rng.integers(1, len(name) + 1)])
+        query = {"Nama Obat": name, "Indikasi Umum": "meredakan demam"}
+        if rng.random() < 0.5:
+            query["Manufaktur"] = str(row["Manufaktur"])
+        if rng.random() < 0.3:
+            query["Nama Obat"] = [name, name[:max(len(name) // 2, 1)]]
+        queries.append(query)
+    return queries
+
+def sample_fact_queries(df, n_queries, seed=0):
+    rng = np.random.default_rng(seed)
+    queries = sample_name_queries(df, n_queries, seed)
+    rows = df.sample(n=n_queries, random_state=seed + 1)
+    for query, (_, row) in zip(queries, rows.iterrows()):
+        words = str(row["Indikasi Umum"]).lower().split()
+        query["Indikasi Umum"] = " ".join(words[:rng.integers(2, 6)])
+        if rng.random() < 0.5:
+            query["Efek Samping"] = [" ".join(str(row["Efek Samping"]).lower().split()[:3]), "mengantuk"]
+        if rng.random() < 0.5:
+            query.pop("Nama Obat")
+    return queries
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def uncached(semantic_retriever):
+    # init_components puts the query embedding cache in front of the model, the second of two paths timed
+    # over the same facts would only get warm hits
+    if isinstance(semantic_retriever.embed_model, CachedEmbeddings):
+        semantic_retriever.embed_model = semantic_retriever.embed_model.embed_model
+    return semantic_retriever
+
+def bench_jaro_winkler(df, n_queries):
+    queries = sample_name_queries(df, n_queries)
+    legacy_times, new_times = [], []
+    mismatches = 0
+
+    for query in queries:
+        legacy_rank, legacy_time = timed(LegacyJaroWinklerRanking(df).rank, query)
+        new_rank, new_time = timed(JaroWinklerRanking(df).rank, query)
+        legacy_times.append(legacy_time)
+        new_times.append(new_time)
+        if not np.array_equal(legacy_rank["jaro_winkler_rank"].to_numpy(), new_rank["jaro_winkler_rank"].to_numpy()):
+            mismatches += 1
+            print(f"rank mismatch for {query}")
+
+    print(f"queries: {len(queries)}, catalog rows: {len(df)}, rank mismatches: {mismatches}")
+    print(f"legacy apply : mean {np.mean(legacy_times) * 1000:.1f} ms, p95 {np.percentile(legacy_times, 95) * 1000:.1f} ms")
+    print(f"cdist        : mean {np.mean(new_times) * 1000:.1f} ms, p95 {np.percentile(new_times, 95) * 1000:.1f} ms")
+    return mismatches
+
+def bench_ngram(df, n_queries, max_candidates=200):
+    queries = sample_name_queries(df, n_queries)
+    index, build_time = timed(NgramIndex.build, df, ["Nama Obat", "Manufaktur"])
+    full_times, index_times, overlaps = [], [], []
+
+    for query in queries:
+        full_rank, full_time = timed(JaroWinklerRanking(df).rank, query)
+        index_rank, index_time = timed(JaroWinklerRanking(df, ngram_index=index, max_candidates=max_candidates).rank, query)
+        full_times.append(full_time)
+        index_times.append(index_time)
+        # an indexed hit counts when the full scan also ranks it in the top 10 (ties included)
+        index_top = index_rank.sort_values(by="jaro_winkler_rank")["id"].to_list()[0:10]
+        overlaps.append(np.mean(full_rank.set_index("id").loc[index_top, "jaro_winkler_rank"].to_numpy() <= 10))
+
+    print(f"queries: {len(queries)}, catalog rows: {len(df)}, index build: {build_time * 1000:.1f} ms")
+    print(f"full scan : mean {np.mean(full_times) * 1000:.1f} ms, p95 {np.percentile(full_times, 95) * 1000:.1f} ms")
+    print(f"ngram     : mean {np.mean(index_times) * 1000:.1f} ms, p95 {np.percentile(index_times, 95) * 1000:.1f} ms")
+    print(f"top-10 agreement with full scan: {np.mean(overlaps):.3f}")
+
+def bench_fusion(n_docs, n_trials, k=10, seed=0):
+    rng = np.random.default_rng(seed)
+    legacy_times, new_times, topk_times = [], [], []
+    mismatches = 0
+
+    for _ in range(n_trials):
+        rank_df = pd.DataFrame({"id": np.arange(n_docs)})
+        for col in HYBRID_WEIGHTS.keys():
+            rank_df[col] = rng.permutation(n_docs) + 1.0
+
+        legacy_rank, legacy_time = timed(LegacyReciprocalRankFusion, rank_df.copy(), 60, "hybird_rank")
+        new_rank, new_time = timed(ReciprocalRankFusion, rank_df.copy(), 60, "hybird_rank", HYBRID_WEIGHTS)
+        (top, _), topk_time = timed(rrf_top_k, rank_df[list(HYBRID_WEIGHTS.keys())].to_numpy(), k, list(HYBRID_WEIGHTS.values()))
+        legacy_times.append(legacy_time)
+        new_times.append(new_time)
+        topk_times.append(topk_time)
+
+        if not np.array_equal(legacy_rank["hybird_rank"].to_numpy(), new_rank["hybird_rank"].to_numpy()):
+            mismatches += 1
+        elif not np.array_equal(np.sort(new_rank["hybird_rank"].to_numpy()[top]), np.sort(new_rank["hybird_rank"].to_numpy())[:k]):
+            mismatches += 1
+
+    print(f"trials: {n_trials}, documents: {n_docs}, rank mismatches: {mismatches}")
+    print(f"legacy apply : mean {np.mean(legacy_times) * 1000:.2f} ms")
+    print(f"rank matrix  : mean {np.mean(new_times) * 1000:.2f} ms")
+    print(f"top-{k} only  : mean {np.mean(topk_times) * 1000:.2f} ms")
+    return mismatches
+
+def bench_semantic(df, semantic_retriever, queries):
+    # both paths call the model itself, so the difference is the batching alone
+    semantic_retriever = uncached(semantic_retriever)
+    legacy_times, new_times = [], []
+    mismatches = 0
+
+    for query in queries:
+        legacy_rank, legacy_time = timed(LegacySemanticRanking(semantic_retriever.vector_db, df).rank, query)
+        new_rank, new_time = timed(SemanticRanking(semantic_retriever, df).rank, query)
+        legacy_times.append(legacy_time)
+        new_times.append(new_time)
+        # HNSW search is approximate and may order near-ties differently, so compare the top of the ranking
+        legacy_top = set(legacy_rank.sort_values(by="semantic_rank")["id"].to_list()[0:10])
+        new_top = set(new_rank.sort_values(by="semantic_rank")["id"].to_list()[0:10])
+        if legacy_top != new_top:
+            mismatches += 1
+
+    n_facts = [sum(len(v) if isinstance(v, list) else 1 for t, v in query.items() if t not in ["Nama Obat", "Manufaktur"]) for query in queries]
+    print(f"queries: {len(queries)}, semantic facts per query: {np.mean(n_facts):.1f}, top-10 mismatches: {mismatches}")
+    print(f"per-fact search : p50 {np.percentile(legacy_times, 50) * 1000:.1f} ms, p95 {np.percentile(legacy_times, 95) * 1000:.1f} ms")
+    print(f"batched search  : p50 {np.percentile(new_times, 50) * 1000:.1f} ms, p95 {np.percentile(new_times, 95) * 1000:.1f} ms")
+    return mismatches
+
+def bench_matrix(df, semantic_retriever, queries, col_to_embed, dtypes=["float32", "float16", "int8"]):
+    column_embeddings = export_chroma_embeddings(semantic_retriever.vector_db, df, col_to_embed, semantic_retriever.embed_model.embed_documents)
+    chroma_ranks, chroma_times = [], []
+    for query in queries:
+        rank_df, elapsed = timed(SemanticRanking(semantic_retriever, df).rank, query)
+        chroma_ranks.append(rank_df["semantic_rank"].to_numpy())
+        chroma_times.append(elapsed)
+    print(f"queries: {len(queries)}, catalog rows: {len(df)}")
+    print(f"chroma  : p50 {np.percentile(chroma_times, 50) * 1000:.1f} ms, p95 {np.percentile(chroma_times, 95) * 1000:.1f} ms")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for dtype in dtypes:
+            matrix_path = os.path.join(tmp_dir, dtype)
+            save_matrix_index(matrix_path, column_embeddings, dtype)
+            matrix_retriever = MatrixSemanticIndex(matrix_path, semantic_retriever.embed_model)
+            size = sum(os.path.getsize(os.path.join(matrix_path, name)) for name in os.listdir(matrix_path))
+
+            times, agreements = [], []
+            for query, chroma_rank in zip(queries, chroma_ranks):
+                rank_df, elapsed = timed(SemanticRanking(matrix_retriever, df).rank, query)
+                times.append(elapsed)
+                matrix_top = rank_df.sort_values(by="semantic_rank")["id"].to_list()[0:10]
+                agreements.append(np.mean(chroma_rank[matrix_top] <= 10))
+
+            print(f"{dtype:8}: p50 {np.percentile(times, 50) * 1000:.1f} ms, p95 {np.percentile(times, 95) * 1000:.1f} ms, "
+                  f"{size / 2**20:.1f} MiB on disk, top-10 agreement with chroma {np.mean(agreements):.3f}")
+
+def bench_bm25(df, queries, col_to_embed, legacy_retrievers=None):
+    if legacy_retrievers is None:
+        legacy_retrievers, legacy_build_time = timed(create_legacy_lexical_retrievers, df, col_to_embed)
+        print(f"BM25Retriever build: {legacy_build_time * 1000:.0f} ms")
+    index, build_time = timed(BM25Index.build, df, col_to_embed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index.save(os.path.join(tmp_dir, "bm25"))
+        index, load_time = timed(BM25Index.load, os.path.join(tmp_dir, "bm25"))
+    print(f"sparse index build: {build_time * 1000:.0f} ms, load from disk: {load_time * 1000:.0f} ms")
+
+    legacy_times, new_times = [], []
+    mismatches = 0
+    for query in queries:
+        legacy_rank, legacy_time = timed(LegacyLexicalRanking(legacy_retrievers, df).rank, query)
+        new_rank, new_time = timed(LexicalRanking(index, df).rank, query)
+        legacy_times.append(legacy_time)
+        new_times.append(new_time)
+        if not np.array_equal(legacy_rank["lexical_rank"].to_numpy(), new_rank["lexical_rank"].to_numpy()):
+            mismatches += 1
+
+    print(f"queries: {len(queries)}, rank mismatches: {mismatches}")
+    print(f"BM25Retriever : p50 {np.percentile(legacy_times, 50) * 1000:.1f} ms, p95 {np.percentile(legacy_times, 95) * 1000:.1f} ms")
+    print(f"sparse index  : p50 {np.percentile(new_times, 50) * 1000:.1f} ms, p95 {np.percentile(new_times, 95) * 1000:.1f} ms")
+    return mismatches
+
+def bench_startup(df_path, col_to_embed, n_runs=3):
+    def build_from_csv():
+        df = pd.read_csv(df_path)
+        NgramIndex.build(df, ["Nama Obat", "Manufaktur"])
+        BM25Index.build(df, col_to_embed)
+        return df
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        _, bundle_time = timed(build_bundle, df_path, tmp_dir, col_to_embed)
+        csv_times = [timed(build_from_csv)[1] for _ in range(n_runs)]
+        source_hash = file_hash(df_path)
+        bundle_times = [timed(load_bundle, tmp_dir, source_hash)[1] for _ in range(n_runs)]
+        hash_time = timed(file_hash, df_path)[1]
+
+    print(f"bundle build (offline, without embeddings): {bundle_time:.2f} s")
+    print(f"csv + index build at startup : {np.mean(csv_times) * 1000:.0f} ms")
+    print(f"bundle load at startup       : {np.mean(bundle_times) * 1000:.0f} ms (+ {hash_time * 1000:.0f} ms catalog hash)")
+    print("embedding model load is the same on both paths and is not included")
+
+def bench_topk(df, lexical_retrievers, semantic_retriever, ngram_index, queries, top_n, k=10):
+    from app.chatbot.chatbot import hybrid_retrieve
+
+    semantic_retriever = uncached(semantic_retriever)
+    recalls, full_times, topk_times, full_peaks, topk_peaks = [], [], [], [], []
+    for query in queries:
+        for mode_top_n, times, peaks in [(None, full_times, full_peaks), (top_n, topk_times, topk_peaks)]:
+            tracemalloc.start()
+            (docs, _), elapsed = timed(hybrid_retrieve, df, lexical_retrievers, semantic_retriever, [], query, k, ngram_index, False, mode_top_n)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            times.append(elapsed)
+            if mode_top_n is None:
+                full_ids = {doc.metadata["row_index"] for doc in docs}
+            else:
+                topk_ids = {doc.metadata["row_index"] for doc in docs}
+        recalls.append(len(full_ids & topk_ids) / len(full_ids))
+
+    print(f"queries: {len(queries)}, catalog rows: {len(df)}, top_n: {top_n}")
+    print(f"exhaustive : mean {np.mean(full_times) * 1000:.1f} ms, p95 {np.percentile(full_times, 95) * 1000:.1f} ms, peak {np.mean(full_peaks) / 2**20:.1f} MiB")
+    print(f"top-n      : mean {np.mean(topk_times) * 1000:.1f} ms, p95 {np.percentile(topk_times, 95) * 1000:.1f} ms, peak {np.mean(topk_peaks) / 2**20:.1f} MiB")
+    print(f"recall@{k} against exhaustive: {np.mean(recalls):.3f} (min {np.min(recalls):.2f})")
+    return np.mean(recalls)
+
+def benchmark_embeddings(df, queries, col_to_embed, embedding_db_path=None, dim=1024, seed=0):
+    rng = np.random.default_rng(seed)
+    if embedding_db_path and os.path.isdir(embedding_db_path):
+        from langchain_chroma import Chroma
+        vector_db = Chroma(collection_name="halodoc_embeddings", persist_directory=embedding_db_path)
+        column_embeddings = export_chroma_embeddings(vector_db, df, col_to_embed)
+    else:
+        # ranking cost does not depend on what the vectors mean, random ones of the e5-large size will do
+        column_embeddings = {col: rng.standard_normal((len(df), dim)).astype(np.float32) for col in col_to_embed}
+    dim = next(iter(column_embeddings.values())).shape[1]
+    # query vectors are precomputed so the benchmark measures ranking only, the parent embeds them in production
+    job_vectors = [{text: rng.standard_normal(dim).astype(np.float32) for text in fact_texts(query)} for query in queries]
+    return column_embeddings, job_vectors
+
+def bench_pool(df_path, queries, col_to_embed, top_n, worker_counts=None, embedding_db_path=None, k=10):
+    df = pd.read_csv(df_path)
+    column_embeddings, job_vectors = benchmark_embeddings(df, queries, col_to_embed, embedding_db_path)
+
+    cpu_count = os.cpu_count()
+    worker_counts = worker_counts or sorted({1, 2, 4, 8, cpu_count} & set(range(1, cpu_count + 1)))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        build_bundle(df_path, tmp_dir, col_to_embed, column_embeddings=column_embeddings)
+        bundle = load_bundle(tmp_dir, file_hash(df_path))
+        semantic_retriever = MatrixSemanticIndex(bundle["matrix_path"], None)
+
+        in_process = []
+        start = time.perf_counter()
+        for query, vectors in zip(queries, job_vectors):
+            semantic_retriever.embed_model = PrecomputedEmbeddings(vectors)
+            in_process.append(hybrid_rank(bundle["df"], bundle["bm25_index"], semantic_retriever, query, k, ngram_index=bundle["ngram_index"], top_n=top_n)[0])
+        baseline = len(queries) / (time.perf_counter() - start)
+        print(f"queries: {len(queries)}, catalog rows: {len(df)}, top_n: {top_n}, cores: {cpu_count}")
+        print(f"in-process : {baseline:.1f} queries/s")
+
+        for workers in worker_counts:
+            pool = RetrievalPool.from_artifacts(tmp_dir, file_hash(df_path), workers=workers)
+            pool.warm_up()
+            start = time.perf_counter()
+            futures = [pool.submit(query, k, top_n, vectors) for query, vectors in zip(queries, job_vectors)]
+            results = [future.result() for future in futures]
+            throughput = len(queries) / (time.perf_counter() - start)
+            mismatches = sum(not np.array_equal(top_ids, expected) for (top_ids, _, _, _), expected in zip(results, in_process))
+            stats = pool.stats()
+            pool.shutdown()
+            print(f"{workers:2} workers: {throughput:.1f} queries/s ({throughput / baseline:.2f}x), "
+                  f"max queue depth {stats['max_queue_depth']}, p95 latency {stats['latency_p95'] * 1000:.0f} ms, "
+                  f"mean run {stats['run_time_mean'] * 1000:.1f} ms, mismatches {mismatches}")
+
+def bench_rankers(df_path, queries, col_to_embed, top_n, deadline=None, embedding_db_path=None, k=10):
+    df = pd.read_csv(df_path)
+    column_embeddings, job_vectors = benchmark_embeddings(df, queries, col_to_embed, embedding_db_path)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        build_bundle(df_path, tmp_dir, col_to_embed, column_embeddings=column_embeddings)
+        bundle = load_bundle(tmp_dir, file_hash(df_path))
+        semantic_retriever = MatrixSemanticIndex(bundle["matrix_path"], None)
+
+        print(f"queries: {len(queries)}, catalog rows: {len(df)}, top_n: {top_n}, deadline: {deadline}")
+        expected = []
+        modes = [(False, None), (True, None)] + ([(True, deadline)] if deadline is not None else [])
+        for parallel, mode_deadline in modes:
+            times, reports, mismatches = [], [], 0
+            for i, (query, vectors) in enumerate(zip(queries, job_vectors)):
+                semantic_retriever.embed_model = PrecomputedEmbeddings(vectors)
+                (top_ids, _, report), elapsed = timed(
+                    lambda: hybrid_rank(bundle["df"], bundle["bm25_index"], semantic_retriever, query, k, ngram_index=bundle["ngram_index"], top_n=top_n, parallel=parallel, deadline=mode_deadline)
+                )
+                times.append(elapsed)
+                reports.append(report)
+                if not parallel:
+                    expected.append(top_ids)
+                elif not np.array_equal(top_ids, expected[i]):
+                    mismatches += 1
+
+            ranker_times = {name: np.mean([report["timings"][name] for report in reports if report["timings"][name] is not None] or [np.nan]) for name in reports[0]["timings"]}
+            dropped = sum(len(report["dropped"]) > 0 for report in reports)
+            label = "sequential" if not parallel else f"parallel{'' if mode_deadline is None else f' {mode_deadline * 1000:.0f} ms deadline'}"
+            print(f"{label:28}: mean {np.mean(times) * 1000:.1f} ms, p95 {np.percentile(times, 95) * 1000:.1f} ms, "
+                  f"mismatches {mismatches}, requests with a dropped ranker {dropped}")
+            print(" " * 30 + ", ".join(f"{name} {seconds * 1000:.1f} ms" for name, seconds in ranker_times.items()))
+
+def bench_adaptive(df_path, queries, col_to_embed, top_n, adaptive, embedding_db_path=None, k=10):
+    from app.chatbot.chatbot import hybrid_retrieve
+    from app.chatbot.context_builder import build_context
+
+    df = pd.read_csv(df_path)
+    column_embeddings, job_vectors = benchmark_embeddings(df, queries, col_to_embed, embedding_db_path)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        build_bundle(df_path, tmp_dir, col_to_embed, column_embeddings=column_embeddings)
+        bundle = load_bundle(tmp_dir, file_hash(df_path))
+        semantic_retriever = MatrixSemanticIndex(bundle["matrix_path"], None)
+
+        decisions, fixed_tokens, adaptive_tokens, top1_kept = [], [], [], 0
+        for query, vectors in zip(queries, job_vectors):
+            semantic_retriever.embed_model = PrecomputedEmbeddings(vectors)
+            fixed_docs, _ = hybrid_retrieve(bundle["df"], bundle["bm25_index"], semantic_retriever, [], query, k, ngram_index=bundle["ngram_index"], top_n=top_n)
+            adaptive_docs, report = hybrid_retrieve(bundle["df"], bundle["bm25_index"], semantic_retriever, [], query, k, ngram_index=bundle["ngram_index"], top_n=top_n, adaptive=adaptive)
+            decisions.append(report["k_decision"])
+            top1_kept += adaptive_docs[0].metadata["row_index"] == fixed_docs[0].metadata["row_index"]
+            # full rows without a token budget, the size the generate prompt would get
+            for docs, tokens in [(fixed_docs, fixed_tokens), (adaptive_docs, adaptive_tokens)]:
+                tokens.append(build_context(bundle["df"], [doc.metadata["row_index"] for doc in docs], [], budget=10**9, fold=False)[1]["tokens"])
+
+    print(f"queries: {len(queries)}, catalog rows: {len(df)}, top_n: {top_n}, thresholds: {adaptive}")
+    for decision in ["dominant", "default", "flat", "unknown"]:
+        ks = [item["k"] for item in decisions if item["decision"] == decision]
+        print(f"{decision:8}: {len(ks):4} queries, mean k {np.mean(ks) if ks else float('nan'):.1f}")
+    print(f"context tokens (estimate) fixed k={k}: mean {np.mean(fixed_tokens):.0f}, adaptive: mean {np.mean(adaptive_tokens):.0f} "
+          f"({np.sum(adaptive_tokens) / np.sum(fixed_tokens) - 1:+.1%}), top-1 kept {top1_kept}/{len(queries)}")
+
+def bench_batching(embed_model, queries, concurrency_levels=[1, 2, 4, 8, 16, 32], max_batch=32, waits=[0.002, 0.005, 0.01], requests_per_user=20):
+    from concurrent.futures import ThreadPoolExecutor
+    from app.chatbot.embedding_batcher import BatchingEmbeddings
+
+    # every request embeds the fact strings of one query, made unique so no batch can share a text
+    request_texts = [fact_texts(query) or ["demam"] for query in queries]
+    counter = iter(range(10**9))
+
+    def user(embed):
+        latencies = []
+        for i in range(requests_per_user):
+            texts = [f"{text} {next(counter)}" for text in request_texts[i % len(request_texts)]]
+            start = time.perf_counter()
+            embed.embed_documents(texts)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    embed_model.embed_documents(["pemanasan"])
+    print(f"requests per user: {requests_per_user}, texts per request: {np.mean([len(texts) for texts in request_texts]):.1f}, max batch: {max_batch}")
+    print(f"{'users':>5} {'mode':>14} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'batch':>6}")
+    for users in concurrency_levels:
+        modes = [("direct", None)] + [(f"batched {wait * 1000:g}ms", wait) for wait in waits]
+        for label, wait in modes:
+            embed = embed_model if wait is None else BatchingEmbeddings(embed_model, max_batch, wait)
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=users) as executor:
+                latencies = [latency for result in executor.map(user, [embed] * users) for latency in result]
+            elapsed = time.perf_counter() - start
+            batch = embed.stats()["batch_size_mean"] if wait is not None else 1.0
+            if wait is not None:
+                embed.close()
+            print(f"{users:>5} {label:>14} {len(latencies) / elapsed:>8.1f} {np.percentile(latencies, 50) * 1000:>8.1f} {np.percentile(latencies, 95) * 1000:>8.1f} {batch:>6.1f}")
+
+def embedding_backend_job(df_path, embedding_model, backend, onnx_dir, documents, queries):
+    # runs in a fresh process so the peak RSS is the backend's own
+    import resource
+    df = pd.read_csv(df_path)
+    start = time.perf_counter()
+    embed_model = CreateRetriever(df, COL_TO_EMBED, backend, onnx_dir).create_embedding_model(embedding_model)
+    load_time = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        embed_model.embed_documents([query])
+        latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    query_vectors = np.asarray(embed_model.embed_documents(queries), dtype=np.float32)
+    batch_time = time.perf_counter() - start
+    document_vectors = np.asarray(embed_model.embed_documents(documents), dtype=np.float32)
+    return {
+        "load": load_time,
+        "rss": rss,
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "latencies": latencies,
+        "batch_per_text": batch_time / len(queries),
+        "query_vectors": query_vectors,
+        "document_vectors": document_vectors,
+    }
+
+def bench_embedding_backends(df_path, embedding_model, onnx_dir=None, backends=["torch", "onnx", "onnx-int8"], n_documents=300, n_queries=100):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from app.chatbot.onnx_embeddings import parity_texts, rank_agreement
+
+    documents, queries = parity_texts(pd.read_csv(df_path), COL_TO_EMBED, n_documents, n_queries)
+    results = {}
+    for backend in backends:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results[backend] = executor.submit(embedding_backend_job, df_path, embedding_model, backend, onnx_dir, documents, queries).result()
+
+    reference = results[backends[0]]
+    print(f"documents: {len(documents)}, queries: {len(queries)}, reference: {backends[0]}")
+    for backend, result in results.items():
+        parity = rank_agreement(reference["document_vectors"], reference["query_vectors"], result["query_vectors"])
+        print(f"{backend:9}: load {result['load']:.1f} s, rss after load {result['rss']:.0f} MiB, peak {result['peak_rss']:.0f} MiB, "
+              f"query p50 {np.percentile(result['latencies'], 50) * 1000:.1f} ms, p95 {np.percentile(result['latencies'], 95) * 1000:.1f} ms, "
+              f"batched {result['batch_per_text'] * 1000:.1f} ms/text")
+        print(" " * 11 + ", ".join(f"{name} {value:.4f}" for name, value in parity.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=["jaro_winkler", "ngram", "topk", "fusion", "semantic", "matrix", "bm25", "startup", "pool", "rankers", "adaptive", "batching", "onnx"])
+    parser.add_argument("--df-path", default="./app/chatbot/scrapping_auto_df.csv")
+    parser.add_argument("--embedding-db-path", default="./app/chatbot/halodoc_db")
+    parser.add_argument("--embedding-model", default="intfloat/multilingual-e5-large-instruct")
+    parser.add_argument("-n", "--n-queries", type=int, default=50)
+    parser.add_argument("--top-n", type=int, default=200)
+    parser.add_argument("--deadline-ms", type=float, default=None)
+    parser.add_argument("--confident", type=float, default=0.9)
+    parser.add_argument("--margin", type=float, default=0.01)
+    parser.add_argument("--spread", type=float, default=0.05)
+    parser.add_argument("--max-batch", type=int, default=32)
+    parser.add_argument("--onnx-dir", default=None)
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.df_path)
+
+    if args.benchmark == "jaro_winkler":
+        bench_jaro_winkler(df, args.n_queries)
+    elif args.benchmark == "ngram":
+        bench_ngram(df, args.n_queries)
+    elif args.benchmark == "fusion":
+        bench_fusion(len(df), args.n_queries)
+    elif args.benchmark == "bm25":
+        bench_bm25(df, sample_fact_queries(df, args.n_queries), COL_TO_EMBED)
+    elif args.benchmark == "startup":
+        bench_startup(args.df_path, COL_TO_EMBED)
+    elif args.benchmark == "pool":
+        bench_pool(args.df_path, sample_fact_queries(df, args.n_queries), COL_TO_EMBED, args.top_n, embedding_db_path=args.embedding_db_path)
+    elif args.benchmark == "rankers":
+        deadline = args.deadline_ms / 1000 if args.deadline_ms else None
+        bench_rankers(args.df_path, sample_fact_queries(df, args.n_queries), COL_TO_EMBED, args.top_n or None, deadline, embedding_db_path=args.embedding_db_path)
+    elif args.benchmark == "adaptive":
+        # exact names are where one row should dominate, partial names and facts where the ranking is flatter
+        adaptive = {"min_k": 1, "max_k": 20, "confident": args.confident, "margin": args.margin, "spread": args.spread}
+        exact_queries = [{"Nama Obat": str(name)} for name in df["Nama Obat"].sample(n=args.n_queries, random_state=0)]
+        for label, queries in [("exact name queries", exact_queries), ("name queries", sample_name_queries(df, args.n_queries)), ("fact queries", sample_fact_queries(df, args.n_queries))]:
+            print(label)
+            bench_adaptive(args.df_path, queries, COL_TO_EMBED, args.top_n or None, adaptive, embedding_db_path=args.embedding_db_path)
+    elif args.benchmark == "batching":
+        embed_model = CreateRetriever(df, COL_TO_EMBED).create_embedding_model(args.embedding_model)
+        bench_batching(embed_model, sample_fact_queries(df, args.n_queries), max_batch=args.max_batch)
+    elif args.benchmark == "onnx":
+        bench_embedding_backends(args.df_path, args.embedding_model, args.onnx_dir)
+    elif args.benchmark in ["topk", "semantic", "matrix"]:
+        from app.chatbot.chatbot import init_components
+        df, lexical_retrievers, semantic_retriever, ngram_index, _, _ = init_components(args.df_path, args.embedding_db_path, embedding_model=args.embedding_model)
+        if args.benchmark == "topk":
+            bench_topk(df, lexical_retrievers, semantic_retriever, ngram_index, sample_fact_queries(df, args.n_queries), args.top_n)
+        elif args.benchmark == "semantic":
+            bench_semantic(df, semantic_retriever, sample_fact_queries(df, args.n_queries))
+        else:
+            bench_matrix(df, semantic_retriever, sample_fact_queries(df, args.n_queries), list(lexical_retrievers.keys()))
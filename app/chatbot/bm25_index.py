@@ -0,0 +1,132 @@
+import os
+import json
+import math
+import shutil
+import numpy as np
+import scipy.sparse as sp
+
+from app.chatbot.fusion import top_n_indices
+
+
+def tokenize(text):
+    # same whitespace split BM25Retriever uses by default
+    return str(text).split()
+
+class BM25Column():
+    # Okapi BM25 with the rank_bm25 defaults BM25Retriever builds on (k1=1.5, b=0.75, epsilon=0.25)
+    def __init__(self, vocab, indptr, indices, data, n_docs):
+        self.vocab = vocab
+        # CSR arrays of the term x document matrix holding idf * saturated term frequency
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.n_docs = n_docs
+
+    @classmethod
+    def build(cls, texts, k1=1.5, b=0.75, epsilon=0.25):
+        vocab = {}
+        rows, cols = [], []
+        doc_len = np.zeros(len(texts), dtype=np.float64)
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_len[doc_id] = len(tokens)
+            for token in tokens:
+                rows.append(vocab.setdefault(token, len(vocab)))
+                cols.append(doc_id)
+
+        tf = sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(vocab), len(texts)))
+        tf.sum_duplicates()
+        weights = cls.weigh(tf, doc_len, k1, b, epsilon)
+        return cls(vocab, weights.indptr.astype(np.int64), weights.indices.astype(np.int32), weights.data, len(texts))
+
+    @staticmethod
+    def weigh(tf, doc_len, k1=1.5, b=0.75, epsilon=0.25):
+        # operations are ordered as in rank_bm25 so scores, and therefore tie order, match it exactly
+        n_docs = tf.shape[1]
+        doc_freq = np.diff(tf.indptr)
+        idf = np.array([math.log(n_docs - freq + 0.5) - math.log(freq + 0.5) for freq in doc_freq.tolist()])
+        average_idf = sum(idf.tolist()) / len(idf) if len(idf) else 0.0
+        idf[idf < 0] = epsilon * average_idf
+
+        avgdl = doc_len.sum() / n_docs if n_docs else 0.0
+        norm = k1 * (1 - b + b * doc_len / avgdl) if avgdl else np.full(n_docs, k1)
+        weights = tf.copy()
+        term_freq = tf.data
+        weights.data = np.repeat(idf, doc_freq) * (term_freq * (k1 + 1) / (term_freq + norm[tf.indices]))
+        return weights
+
+    def scores(self, query):
+        # accumulates one sparse term row per query token, repeated tokens count once per occurrence
+        scores = np.zeros(self.n_docs)
+        indptr, indices, data = self.indptr, self.indices, self.data
+        for token in tokenize(query):
+            term_id = self.vocab.get(token)
+            if term_id is not None:
+                scores[indices[indptr[term_id]:indptr[term_id + 1]]] += data[indptr[term_id]:indptr[term_id + 1]]
+        return scores
+
+class BM25Index():
+    def __init__(self, columns, source_hash=""):
+        self.columns = columns
+        self.source_hash = source_hash
+
+    @classmethod
+    def build(cls, df, columns, source_hash=""):
+        return cls({col: BM25Column.build([str(text) for text in df[col].to_list()]) for col in columns}, source_hash)
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def keys(self):
+        return self.columns.keys()
+
+    def search(self, column, query, k=None):
+        scores = self.columns[column].scores(query)
+        if k is None:
+            # full ranking in the order BM25Retriever.invoke returned it
+            doc_ids = np.argsort(scores)[::-1]
+        else:
+            doc_ids = top_n_indices(scores, k)
+        return doc_ids, scores[doc_ids]
+
+    def save(self, path):
+        tmp_path = f"{path.rstrip('/')}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        for i, (col, bm25) in enumerate(self.columns.items()):
+            for name in ["indptr", "indices", "data"]:
+                np.save(os.path.join(tmp_path, f"{name}_{i}.npy"), getattr(bm25, name))
+            with open(os.path.join(tmp_path, f"vocab_{i}.json"), "w", encoding="utf-8") as f:
+                json.dump(bm25.vocab, f, ensure_ascii=False)
+        with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+            json.dump({"columns": list(self.columns.keys()), "n_docs": [bm25.n_docs for bm25 in self.columns.values()], "source_hash": self.source_hash}, f)
+
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, mmap=False):
+        mmap_mode = "r" if mmap else None
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        columns = {}
+        for i, (col, n_docs) in enumerate(zip(manifest["columns"], manifest["n_docs"])):
+            with open(os.path.join(path, f"vocab_{i}.json"), encoding="utf-8") as f:
+                vocab = json.load(f)
+            arrays = [np.load(os.path.join(path, f"{name}_{i}.npy"), mmap_mode=mmap_mode) for name in ["indptr", "indices", "data"]]
+            columns[col] = BM25Column(vocab, *arrays, n_docs)
+        return cls(columns, manifest["source_hash"])
+
+def bm25_index_path(df_path):
+    return f"{os.path.splitext(df_path)[0]}.bm25"
+
+def load_or_build_bm25_index(df_path, df, columns, source_hash):
+    index_path = bm25_index_path(df_path)
+    if os.path.isfile(os.path.join(index_path, "manifest.json")):
+        index = BM25Index.load(index_path)
+        if index.source_hash == source_hash and set(columns) <= set(index.keys()):
+            return index
+
+    index = BM25Index.build(df, columns, source_hash)
+    index.save(index_path)
+    return index
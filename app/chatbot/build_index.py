@@ -0,0 +1,49 @@
+from app.chatbot.chatbot_utils import COL_TO_EMBED, CreateRetriever
+from app.chatbot.artifacts import build_bundle
+from app.chatbot.semantic_index import export_chroma_embeddings
+
+import os
+import json
+import argparse
+import pandas as pd
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="build the versioned retrieval artifact bundle for a catalog csv")
+    parser.add_argument("--df-path", default="./app/chatbot/scrapping_auto_df.csv")
+    parser.add_argument("--artifact-dir", default="./app/chatbot/artifacts")
+    parser.add_argument("--embedding-db-path", default="./app/chatbot/halodoc_db", help="Chroma directory to export embeddings from")
+    parser.add_argument("--embedding-model", default="intfloat/multilingual-e5-large-instruct")
+    parser.add_argument("--matrix-dtype", default="float32", choices=["float32", "float16", "int8"])
+    parser.add_argument("--no-embeddings", action="store_true", help="skip the embedding matrices")
+    parser.add_argument("--force", action="store_true", help="rebuild even if the bundle for this catalog exists")
+    args = parser.parse_args()
+
+    os.makedirs(args.artifact_dir, exist_ok=True)
+    embed_documents, column_embeddings = None, None
+
+    if not args.no_embeddings:
+        create_retriever = CreateRetriever(pd.read_csv(args.df_path), COL_TO_EMBED)
+        if os.path.isdir(args.embedding_db_path):
+            from langchain_chroma import Chroma
+            vector_db = Chroma(collection_name="halodoc_embeddings", persist_directory=args.embedding_db_path)
+            embed_model = None
+
+            def embed_missing(texts):
+                # the model is only loaded when Chroma is missing rows of the csv
+                global embed_model
+                if embed_model is None:
+                    embed_model = create_retriever.create_embedding_model(args.embedding_model)
+                return embed_model.embed_documents(texts)
+
+            column_embeddings = export_chroma_embeddings(vector_db, create_retriever.df, COL_TO_EMBED, embed_missing)
+        else:
+            embed_documents = create_retriever.create_embedding_model(args.embedding_model).embed_documents
+
+    bundle_path = build_bundle(args.df_path, args.artifact_dir, COL_TO_EMBED, embed_documents, column_embeddings, args.matrix_dtype, args.embedding_model, args.force)
+
+    with open(os.path.join(bundle_path, "manifest.json")) as f:
+        manifest = json.load(f)
+    print(f"bundle {manifest['version']} at {bundle_path}")
+    for step, seconds in manifest["build_seconds"].items():
+        print(f"  {step}: {seconds:.2f} s")
@@ -1,6 +1,19 @@
 from app.chatbot.chatbot_utils import *
+from app.chatbot.fuzzy_index import load_or_build_ngram_index
+from app.chatbot.bm25_index import load_or_build_bm25_index
+from app.chatbot.artifacts import load_bundle, current_manifest
+from app.chatbot.embedding_cache import EmbeddingCache, CachedEmbeddings
+from app.chatbot.embedding_batcher import BatchingEmbeddings
+from app.chatbot.answer_cache import answer_cache_key
+from app.chatbot.context_builder import build_context
+from app.chatbot.fusion import adaptive_k
 
 import ast
+import json
+import time
+import asyncio
+import inspect
+import threading
 import regex as re
 import argparse
 import functools
@@ -13,16 +26,27 @@ from langchain_core.documents import Document
 from typing_extensions import List, TypedDict, Dict
 from langchain.prompts import ChatPromptTemplate
 from langgraph.types import interrupt, Command
-from langgraph.checkpoint.mongodb import MongoDBSaver
+from langgraph.checkpoint.mongodb.aio import AsyncMongoDBSaver
 
-from groq import Groq
+from groq import AsyncGroq, BadRequestError
 from langchain_groq import ChatGroq
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
 
 def error_handler(func):
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                print(f"[ERROR] Exception in function: {func.__name__}")
+                traceback.print_exc()
+                return {"failed": func.__name__}
+        return async_wrapper
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         try:
@@ -42,11 +66,92 @@ class State(TypedDict):
     resume: str
     error_log: str
     user_validations: List[tuple]
+    ranker_report: Dict
+    follow_up: str
+    context_report: Dict
+    k_decision: Dict
+
+# fact types the extraction prompts use and the catalog columns they map to
+FACT_COLUMNS = {
+    "Drug Name": "Nama Obat",
+    "Instructions": "Aturan Pakai",
+    "Dosage": "Dosis",
+    "Side Effects": "Efek Samping",
+    "Category": "Golongan Produk",
+    "General Indications": "Indikasi Umum",
+    "Shape and size": "Kemasan",
+    "Composition": "Komposisi",
+    "Contraindications": "Kontra Indikasi",
+    "Manufacturer": "Manufaktur",
+    "Warning": "Perhatian",
+    "Description": "Deskripsi"
+}
+FACT_TYPES = {column: fact_type for fact_type, column in FACT_COLUMNS.items()}
+
+FACT_TYPE_DESCRIPTIONS = """
+Drug Name: name of the drug as listed (eg: Emturnas Drops 15 ml)
+Instructions: when and how the drug is used (eg: after meals)
+Dosage: recommended dosage, can depend on age or condition
+Side Effects: side effects that may arise after taking the drug
+Category: only one of Over-the-Counter Drugs, Limited Over-the-Counter Drugs, Prescription Drugs, Consumer Products
+General Indications: symptoms or diseases the drug treats
+Shape and size: packaging shape and size (eg: Box, Bottle @ 15 ml)
+Composition: active substances
+Contraindications: conditions in which the drug must not be used
+Manufacturer: company that produces the drug
+Warning: special warnings before use
+Description: short general explanation of the drug
+"""
+
+FACTS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "desired_fact": {"type": "array", "items": {"type": "string", "enum": list(FACT_COLUMNS.keys())}},
+        "fact_provided": {
+            "type": "object",
+            # several values of one type (two manufacturers, three indications) come as a list, like the legacy parser gives them
+            "properties": {fact_type: {"anyOf": [{"type": "string"}, {"type": "array", "items": {"type": "string"}}]} for fact_type in FACT_COLUMNS.keys()},
+            "additionalProperties": False
+        }
+    },
+    "required": ["desired_fact", "fact_provided"]
+}
+REVISED_FACTS_SCHEMA = {
+    "type": "object",
+    "properties": {"fact_provided": FACTS_SCHEMA["properties"]["fact_provided"]},
+    "required": ["fact_provided"]
+}
+
+# token usage of the query LLM per helper, reported by /chat/stats and the evaluation
+LLM_USAGE = {}
+LLM_USAGE_LOCK = threading.Lock()
+
+def record_usage(name, query_result=None, retry=False):
+    with LLM_USAGE_LOCK:
+        usage = LLM_USAGE.setdefault(name, {"calls": 0, "retries": 0, "prompt_tokens": 0, "completion_tokens": 0})
+        if query_result is not None:
+            usage["calls"] += 1
+            if getattr(query_result, "usage", None) is not None:
+                usage["prompt_tokens"] += query_result.usage.prompt_tokens
+                usage["completion_tokens"] += query_result.usage.completion_tokens
+        if retry:
+            usage["retries"] += 1
+
+def llm_usage():
+    with LLM_USAGE_LOCK:
+        return {
+            name: {
+                **usage,
+                "prompt_tokens_per_call": usage["prompt_tokens"] / usage["calls"] if usage["calls"] else 0.0,
+                "completion_tokens_per_call": usage["completion_tokens"] / usage["calls"] if usage["calls"] else 0.0,
+            }
+            for name, usage in LLM_USAGE.items()
+        }
 
 @error_handler
-def identify_facts(llm, query):
+async def identify_facts(llm, query):
     print(f"hi_{query}")
-    query_result = llm.chat.completions.create(
+    query_result = await llm.chat.completions.create(
         messages=[{
             "role": "system",
             "content": 
@@ -91,6 +196,7 @@ def identify_facts(llm, query):
         temperature=0,
     )
 
+    record_usage("identify_facts", query_result)
     answer = query_result.choices[0].message.content 
     answer = re.findall(r"\{.*?\}(?=(?:\n|$|\.))", answer, re.DOTALL)[-1]
     answer = ast.literal_eval(answer)
@@ -98,45 +204,15 @@ def identify_facts(llm, query):
     desired_fact = answer["Desired fact"]
     fact_provided = answer["Fact provided"]
 
-    dct = {
-        "Drug Name": "Nama Obat",
-        "Instructions": "Aturan Pakai",
-        "Dosage": "Dosis",
-        "Side Effects": "Efek Samping",
-        "Category": "Golongan Produk",
-        "General Indications": "Indikasi Umum",
-        "Shape and size": "Kemasan",
-        "Composition": "Komposisi",
-        "Contraindications": "Kontra Indikasi",
-        "Manufacturer": "Manufaktur",
-        "Warning": "Perhatian",
-        "Description": "Deskripsi"
-    }
-
-    fact_provided = {dct[fact_type]: fact for fact_type, fact in fact_provided.items() if fact_type in dct.keys()}
+    fact_provided = {FACT_COLUMNS[fact_type]: fact for fact_type, fact in fact_provided.items() if fact_type in FACT_COLUMNS.keys()}
 
     return desired_fact, fact_provided
 
 @error_handler
-def revise_facts(llm, fact_provided, query):
-    rev_dct = {
-        "Nama Obat": "Drug Name",
-        "Aturan Pakai": "Instructions",
-        "Dosis": "Dosage",
-        "Efek Samping": "Side Effects",
-        "Golongan Produk": "Category",
-        "Indikasi Umum": "General Indications",
-        "Kemasan": "Shape and size",
-        "Komposisi": "Composition",
-        "Kontra Indikasi": "Contraindications",
-        "Manufaktur": "Manufacturer",
-        "Perhatian": "Warning",
-        "Deskripsi": "Description"
-    }
-
-    fact_provided = {rev_dct[fact_type]: fact for fact_type, fact in fact_provided.items() if fact_type in rev_dct.keys()}
-
-    query_result = llm.chat.completions.create(
+async def revise_facts(llm, fact_provided, query):
+    fact_provided = {FACT_TYPES[column]: fact for column, fact in fact_provided.items() if column in FACT_TYPES.keys()}
+
+    query_result = await llm.chat.completions.create(
         messages=[{
             "role": "system",
             "content": 
@@ -181,46 +257,107 @@ def revise_facts(llm, fact_provided, query):
         temperature=0,
     )
 
+    record_usage("revise_facts", query_result)
     answer = query_result.choices[0].message.content 
     answer = re.findall(r"\{.*?\}(?=(?:\n|$|\.))", answer, re.DOTALL)[-1]
     answer = ast.literal_eval(answer)
 
     fact_provided = answer["Fact provided"]
 
-    dct = {
-        "Drug Name": "Nama Obat",
-        "Instructions": "Aturan Pakai",
-        "Dosage": "Dosis",
-        "Side Effects": "Efek Samping",
-        "Category": "Golongan Produk",
-        "General Indications": "Indikasi Umum",
-        "Shape and size": "Kemasan",
-        "Composition": "Komposisi",
-        "Contraindications": "Kontra Indikasi",
-        "Manufacturer": "Manufaktur",
-        "Warning": "Perhatian",
-        "Description": "Deskripsi"
-    }
-
-    fact_provided = {dct[fact_type]: fact for fact_type, fact in fact_provided.items() if fact_type in dct.keys()}
+    fact_provided = {FACT_COLUMNS[fact_type]: fact for fact_type, fact in fact_provided.items() if fact_type in FACT_COLUMNS.keys()}
 
     return fact_provided
 
-@error_handler
-def hybrid_retrieve(df, lexical_retrievers, semantic_retriever, desired_fact, fact_provided, k):
-    jaro_winkler_ranking = JaroWinklerRanking(df)
-    lexical_ranking = LexicalRanking(lexical_retrievers, df)
-    semantic_ranking = SemanticRanking(semantic_retriever, df)
+def parse_fact_arguments(arguments, schema):
+    # raises ValueError when the tool arguments do not follow the schema
+    answer = json.loads(arguments)
+    fact_provided = answer.get("fact_provided")
+    if not isinstance(fact_provided, dict) or not all(
+        isinstance(fact, str) or (isinstance(fact, list) and all(isinstance(item, str) for item in fact)) for fact in fact_provided.values()
+    ):
+        raise ValueError(f"invalid fact_provided: {fact_provided!r}")
+    if "desired_fact" in schema["required"]:
+        desired_fact = answer.get("desired_fact")
+        if not isinstance(desired_fact, list) or not all(isinstance(fact_type, str) for fact_type in desired_fact):
+            raise ValueError(f"invalid desired_fact: {desired_fact!r}")
+    return answer
+
+def provided_facts(fact_provided):
+    # tool call facts keyed by catalog column, blank values and blank list items are dropped, a list of one value is the value
+    facts = {}
+    for fact_type, fact in fact_provided.items():
+        if fact_type not in FACT_COLUMNS.keys():
+            continue
+        if isinstance(fact, list):
+            fact = [item for item in fact if item.strip()]
+            fact = fact[0] if len(fact) == 1 else fact
+        if fact if isinstance(fact, list) else fact.strip():
+            facts[FACT_COLUMNS[fact_type]] = fact
+    return facts
+
+async def call_fact_tool(llm, name, messages, schema, retries=2):
+    # the model has to answer with a record_facts tool call, invalid or missing calls are retried up to retries times
+    for attempt in range(retries + 1):
+        try:
+            query_result = await llm.chat.completions.create(
+                messages=messages,
+                model="llama-3.1-8b-instant",
+                temperature=0,
+                tools=[{"type": "function", "function": {"name": "record_facts", "description": "Record the identified facts.", "parameters": schema}}],
+                tool_choice={"type": "function", "function": {"name": "record_facts"}},
+            )
+            record_usage(name, query_result)
+            return parse_fact_arguments(query_result.choices[0].message.tool_calls[0].function.arguments, schema)
+        except (BadRequestError, ValueError, TypeError, IndexError):
+            # groq answers a call that does not match the schema with a 400 tool_use_failed
+            if attempt == retries:
+                raise
+            record_usage(name, retry=True)
 
-    jaro_winkler_rank = jaro_winkler_ranking.rank(fact_provided)
-    lexical_rank = lexical_ranking.rank(fact_provided)
-    semantic_rank = semantic_ranking.rank(fact_provided)
+@error_handler
+async def identify_facts_structured(llm, query, retries=2):
+    answer = await call_fact_tool(llm, "identify_facts_structured", [{
+        "role": "system",
+        "content": "Identify which information the user wants about a drug (desired_fact) and the facts the user gives "
+                   "that help determine which drug they mean (fact_provided). Do not answer the question. "
+                   "Leave out facts the user only asks to confirm. Give several values of one type as a list. Write fact values in Indonesian.\n"
+                   f"Fact types:{FACT_TYPE_DESCRIPTIONS}"
+    }, {
+        "role": "user",
+        "content": query
+    }], FACTS_SCHEMA, retries)
+
+    desired_fact = [fact_type for fact_type in answer["desired_fact"] if fact_type in FACT_COLUMNS.keys()]
+    fact_provided = provided_facts(answer["fact_provided"])
 
-    hybird_rank = pd.merge(left=lexical_rank, right=semantic_rank, how="inner", on="id")
-    hybird_rank = pd.merge(left=hybird_rank, right=jaro_winkler_rank, how="inner", on="id")
-    hybird_rank = ReciprocalRankFusion(hybird_rank, 60, "hybird_rank")
+    return desired_fact, fact_provided
 
-    retrieved_docs = df.loc[hybird_rank.sort_values(by="hybird_rank")["id"].to_list()[0:k]]
+@error_handler
+async def revise_facts_structured(llm, fact_provided, query, retries=2):
+    fact_provided = {FACT_TYPES[column]: fact for column, fact in fact_provided.items() if column in FACT_TYPES.keys()}
+
+    answer = await call_fact_tool(llm, "revise_facts_structured", [{
+        "role": "system",
+        "content": "You get the facts known about the drug the user means and the user's correction. Return the complete corrected "
+                   "fact_provided: change values the user corrects, move a fact to another type when the user says its type is wrong, "
+                   "drop facts the user rejects and keep the rest. Write fact values in Indonesian.\n"
+                   f"Fact types:{FACT_TYPE_DESCRIPTIONS}"
+    }, {
+        "role": "user",
+        "content": f"Known facts: {json.dumps(fact_provided, ensure_ascii=False)}\nCorrection: {query}"
+    }], REVISED_FACTS_SCHEMA, retries)
+
+    return provided_facts(answer["fact_provided"])
+
+def fact_extractors(config: dict):
+    # "structured" (default) uses the schema-constrained tool call, "legacy" the reasoning prompt parsed with a regex
+    if config["configurable"].get("fact_parser", "structured") == "legacy":
+        return identify_facts, revise_facts
+    retries = config["configurable"].get("fact_retries", 2)
+    return functools.partial(identify_facts_structured, retries=retries), functools.partial(revise_facts_structured, retries=retries)
+
+def to_documents(df, top_ids):
+    retrieved_docs = df.loc[top_ids]
 
     retrieved_docs = [
         Document(
@@ -233,17 +370,126 @@ def hybrid_retrieve(df, lexical_retrievers, semantic_retriever, desired_fact, fa
 
     return retrieved_docs
 
-def _retrieve_or_not_(state: State, config: dict):
+@error_handler
+async def route_and_identify_facts(llm, query):
+    # one JSON-mode call deciding whether the question is about a medical object and extracting its facts,
+    # replaces the _retrieve_or_not_ classifier followed by identify_facts
+    query_result = await llm.chat.completions.create(
+        messages=[{
+            "role": "system",
+            "content":
+            """
+                You will be given a prompt from the user. First decide if the user is asking for information about a drug or medical related object.
+                If so, identify the facts that can help determine the object the user is referring to, your job is not to answer the question.
+                The types of informations and their explanations are:
+                1. Drug Name: The name of the drug as listed on the site (eg: Emturnas Drops 15 ml).
+                2. Instructions: Instructions on when and how the drug should be used (eg: After meals).
+                3. Dosage: Information on the recommended dosage or amount of consumption, can be based on age or condition.
+                4. Side Effects: Side effects that may arise after taking the drug.
+                5. Category: Legal category of the drug, it must only include: Over-the-Counter Drugs, Limited Over-the-Counter Drugs, Prescription Drugs, Consumer Products.
+                6. General Indications: General uses of the drug, namely to treat certain symptoms or diseases.
+                7. Shape and size: The shape and size of the product packaging (eg: Box, Bottle @ 15 ml).
+                8. Composition: The content or active substance in the drug.
+                9. Contraindications: Situations or conditions that prevent the drug from being used (eg: severe liver dysfunction).
+                10. Manufacturer: The name of the company or factory that produces the drug.
+                11. Warning: Special warnings before using this drug, such as prohibitions on use in certain conditions, how to handle the drug, and doctor prescription requirements.
+                12. Description: A brief explanation of the drug in general, often including the purpose and how the drug works.
+
+                "Desired fact" lists the types of information the user asks for, "Fact provided" maps a type to the information the user gives about the object.
+                Only use the 12 types above, leave out information the user is only asking to confirm, and keep the facts in the user's language (Indonesian).
+                When the user is not asking about a medical object set "Medical" to false and leave the rest empty.
+
+                Example:
+                Apa efek samping, aturan pakai, dan siapa yang membuat obat untuk meredakan demam yang bernama panadol.
+                Output: {"Medical": true, "Desired fact": ["Side Effects", "Instructions", "Manufacturer"], "Fact provided": {"General Indications": "untuk meredakan demam", "Drug Name": "panadol"}}
+
+                Respond with the JSON object only.
+            """
+        }, {
+            "role": "user",
+            "content": query
+        }],
+        model="llama-3.1-8b-instant",
+        temperature=0,
+        response_format={"type": "json_object"},
+    )
+
+    record_usage("route_and_identify_facts", query_result)
+    answer = json.loads(query_result.choices[0].message.content)
+
+    medical = bool(answer.get("Medical", False))
+    desired_fact = answer.get("Desired fact") or []
+    fact_provided = answer.get("Fact provided") or {}
+
+    fact_provided = {FACT_COLUMNS[fact_type]: fact for fact_type, fact in fact_provided.items() if fact_type in FACT_COLUMNS.keys()}
+
+    return medical, desired_fact, fact_provided
+
+def cached_report(start, score_range=None):
+    return {"timings": {}, "dropped": [], "seconds": time.perf_counter() - start, "cached": True, "score_range": score_range}
+
+def retrieval_k(k, adaptive=None):
+    # the adaptive mode ranks max_k candidates so a flat ranking can widen beyond k
+    return max(k, adaptive.get("max_k", 20)) if adaptive is not None else k
+
+def select_rows(top_ids, scores, report, k, adaptive=None):
+    # adaptive holds the adaptive_k thresholds, the fused score gap then decides how many rows are kept
+    if adaptive is None:
+        return top_ids, None
+    if report.get("score_range") is None:
+        # cache entries written before the score range was stored
+        return top_ids[:k], {"decision": "unknown", "k": min(k, len(top_ids))}
+    chosen, decision = adaptive_k(scores, report["score_range"], k, **adaptive)
+    return top_ids[:chosen], decision
+
+@error_handler
+def hybrid_retrieve(df, lexical_retrievers, semantic_retriever, desired_fact, fact_provided, k, ngram_index=None, full_scan=False, top_n=None, deadline=None, retrieval_cache=None, adaptive=None):
+    start = time.perf_counter()
+    fetch_k = retrieval_k(k, adaptive)
+    key = retrieval_cache.key(df.attrs.get("catalog_hash"), fact_provided, fetch_k, top_n, full_scan) if retrieval_cache is not None else None
+    cached = retrieval_cache.get(key) if retrieval_cache is not None else None
+    if cached is not None:
+        top_ids, scores, score_range = cached
+        report = cached_report(start, score_range)
+    else:
+        top_ids, scores, report = hybrid_rank(df, lexical_retrievers, semantic_retriever, fact_provided, fetch_k, ngram_index=ngram_index, full_scan=full_scan, top_n=top_n, deadline=deadline)
+        # a fusion missing a ranker that hit the deadline is not reused
+        if retrieval_cache is not None and len(report["dropped"]) == 0:
+            retrieval_cache.put(key, top_ids, scores, report["score_range"])
+    top_ids, report["k_decision"] = select_rows(top_ids, scores, report, k, adaptive)
+    return to_documents(df, top_ids), report
+
+@error_handler
+async def pool_retrieve(df, retrieval_pool, desired_fact, fact_provided, k, full_scan=False, top_n=None, deadline=None, retrieval_cache=None, adaptive=None):
+    start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    fetch_k = retrieval_k(k, adaptive)
+    key = retrieval_cache.key(df.attrs.get("catalog_hash"), fact_provided, fetch_k, top_n, full_scan) if retrieval_cache is not None else None
+    cached = await loop.run_in_executor(None, retrieval_cache.get, key) if retrieval_cache is not None else None
+    if cached is not None:
+        top_ids, scores, score_range = cached
+        report = cached_report(start, score_range)
+    else:
+        top_ids, scores, report = await retrieval_pool.retrieve(fact_provided, fetch_k, top_n, deadline, full_scan)
+        if retrieval_cache is not None and len(report["dropped"]) == 0:
+            await loop.run_in_executor(None, retrieval_cache.put, key, top_ids, scores, report["score_range"])
+    top_ids, report["k_decision"] = select_rows(top_ids, scores, report, k, adaptive)
+    return to_documents(df, top_ids), report
+
+async def is_medical(llm, question):
     prompt = ChatPromptTemplate.from_messages([
         ("system", "You are a helpful assistant. Identify if a user is asking for information about medical object or not. If so respond only with 'yes', or 'no' if not or if you are not sure don't answer anything else."),
         ("human", "Query: {question}")
     ])
     messages = prompt.invoke({
-        "question": state["question"]
+        "question": question
     })
-    response = config["configurable"]["llm"].invoke(messages)
+    response = await llm.ainvoke(messages)
     print(response.content)
-    if (response.content.lower() == 'yes') or (response.content.lower() == 'ya'):
+    return (response.content.lower() == 'yes') or (response.content.lower() == 'ya')
+
+async def _retrieve_or_not_(state: State, config: dict):
+    if await is_medical(config["configurable"]["llm"], state["question"]):
         return 'identify_facts'
     else:
         return 'answer_non_medical'
@@ -260,9 +506,10 @@ def _no_fact_(state: State, config: dict):
     question = interrupt("no_fact")
     return {"question": question}
 
-def _identify_facts_(state: State, config: dict):
+async def _identify_facts_(state: State, config: dict):
     query_llm = config["configurable"]["query_llm"]
-    result = identify_facts(query_llm, state["question"])
+    extract_facts, _ = fact_extractors(config)
+    result = await extract_facts(query_llm, state["question"])
     if isinstance(result, dict):
         if "failed" in result.keys():
             return {"resume": "error", "error_log": result["failed"]}
@@ -272,62 +519,140 @@ def _identify_facts_(state: State, config: dict):
     else:
         return {"resume": "retrieve", "desired_fact": desired_fact, "fact_provided": fact_provided}
 
-def _retrieve_(state: State, config: dict):
+async def _retrieve_(state: State, config: dict):
     df = config["configurable"]["df"]
     lexical_retrievers = config["configurable"]["lexical_retrievers"]
     semantic_retriever = config["configurable"]["semantic_retriever"]
+    ngram_index = config["configurable"].get("ngram_index")
+    # exact Jaro-Winkler over every name unless the n-gram shortlist is switched on
+    full_scan = config["configurable"].get("full_scan", False)
+    top_n = config["configurable"].get("top_n")
+    # seconds a ranker may take before the fusion goes ahead without it
+    deadline = config["configurable"].get("ranker_deadline")
+    retrieval_cache = config["configurable"].get("retrieval_cache")
     desired_fact = state["desired_fact"]
     fact_provided = state["fact_provided"]
-    result = hybrid_retrieve(df, lexical_retrievers, semantic_retriever, desired_fact, fact_provided, 10)
+    retrieval_pool = config["configurable"].get("retrieval_pool")
+    # thresholds of the confidence-aware k, None always keeps 10 rows
+    adaptive = config["configurable"].get("adaptive_k")
+    if retrieval_pool is not None:
+        # ranking runs in worker processes sharing the memory-mapped bundle
+        result = await pool_retrieve(df, retrieval_pool, desired_fact, fact_provided, 10, full_scan=full_scan, top_n=top_n, deadline=deadline, retrieval_cache=retrieval_cache, adaptive=adaptive)
+    else:
+        # ranking is CPU bound, it runs on the bounded retrieval pool so the event loop keeps serving other requests
+        executor = config["configurable"].get("retrieval_executor")
+        result = await asyncio.get_running_loop().run_in_executor(
+            executor,
+            functools.partial(hybrid_retrieve, df, lexical_retrievers, semantic_retriever, desired_fact, fact_provided, 10, ngram_index=ngram_index, full_scan=full_scan, top_n=top_n, deadline=deadline, retrieval_cache=retrieval_cache, adaptive=adaptive)
+        )
     if isinstance(result, dict):
         if "failed" in result.keys():
             return {"resume": "error", "error_log": result["failed"]}
-    retrieved_docs = result
-    return {"resume": "generate", "context": retrieved_docs}
-
-
-def _generate_(state: State, config: dict):
-    docs_content = "\n\n".join(doc.page_content for doc in state["context"])
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", "You are a helpful assistant. Use the provided context to answer the user's question and answer in Bahasa. At the end of the answer ask the user if they're satisfied with the answer."),
-        ("human", "Context:\n{context}\n\nQuestion: {question}")
-    ])
-    messages = prompt.invoke({
+    retrieved_docs, ranker_report = result
+    if len(ranker_report["dropped"]) > 0:
+        print(f"rankers dropped by the {deadline}s deadline: {ranker_report['dropped']}")
+
+    answer_cache = config["configurable"].get("answer_cache")
+    if answer_cache is not None:
+        # the same facts retrieving the same rows were already answered, generate is skipped
+        key = answer_cache_key(config["configurable"]["df"].attrs.get("catalog_hash"), desired_fact, fact_provided, [doc.metadata["row_index"] for doc in retrieved_docs])
+        answer = await asyncio.get_running_loop().run_in_executor(None, answer_cache.get, key, state["question"])
+        if answer is not None:
+            return {"resume": "cached", "context": retrieved_docs, "ranker_report": ranker_report, "k_decision": ranker_report["k_decision"], "answer": answer}
+    return {"resume": "generate", "context": retrieved_docs, "ranker_report": ranker_report, "k_decision": ranker_report["k_decision"]}
+
+def state_cache_key(state: State, config: dict):
+    return answer_cache_key(config["configurable"]["df"].attrs.get("catalog_hash"), state.get("desired_fact"), state["fact_provided"], [doc.metadata["row_index"] for doc in state["context"]])
+
+
+def generate_context(state: State, config: dict):
+    # context_budget 0 sends every retrieved document in full
+    budget = config["configurable"].get("context_budget")
+    if not budget:
+        return "\n\n".join(doc.page_content for doc in state["context"]), None
+    desired_columns = [FACT_COLUMNS[fact_type] for fact_type in state.get("desired_fact") or [] if fact_type in FACT_COLUMNS.keys()]
+    return build_context(config["configurable"]["df"], [doc.metadata["row_index"] for doc in state["context"]], desired_columns, budget)
+
+GENERATE_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "You are a helpful assistant. Use the provided context to answer the user's question and answer in Bahasa. At the end of the answer ask the user if they're satisfied with the answer."),
+    ("human", "Context:\n{context}\n\nQuestion: {question}")
+])
+
+async def _generate_(state: State, config: dict):
+    docs_content, context_report = generate_context(state, config)
+    messages = GENERATE_PROMPT.invoke({
         "question": state["question"],
         "context": docs_content
     })
-    response = config["configurable"]["llm"].invoke(messages)
-    return {"answer": response.content}
+    response = await config["configurable"]["llm"].ainvoke(messages)
+
+    answer_cache = config["configurable"].get("answer_cache")
+    if answer_cache is not None:
+        await asyncio.get_running_loop().run_in_executor(None, answer_cache.put, state_cache_key(state, config), response.content, state["question"])
+    return {"answer": response.content, "context_report": context_report}
 
-def _ask_validation_(state: State, config: dict):
+async def _ask_validation_(state: State, config: dict):
     answer = interrupt("ask_revision")
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", "You are a helpful assistant. Identify if a user is asking for information about medical object or not. If so respond only with 'yes', or 'no' if not or if you are not sure don't answer anything else."),
-        ("human", "Query: {question}")
-    ])
-    messages = prompt.invoke({
-        "question": answer
-    })
-    response = config["configurable"]["llm"].invoke(messages)
+    medical = await is_medical(config["configurable"]["llm"], answer)
 
     user_validations = state.get("user_validations", [])
 
     if answer == "tidak":
         user_validations.append((state["question"], "tidak_sesuai"))
+        # a rejected answer is not served again from the cache
+        answer_cache = config["configurable"].get("answer_cache")
+        if answer_cache is not None:
+            answer_cache.invalidate(state_cache_key(state, config))
         return {"resume": "validate", "user_validations": user_validations}
-    elif (response.content.lower() == 'yes') or (response.content.lower() == 'ya'):
+    elif medical:
         return {"resume": "identify_facts", "question": answer}
     else:
         user_validations.append((state["question"], "sesuai"))
         return {"resume": "thank_you", "user_validations": user_validations}
+
+async def _route_(state: State, config: dict):
+    query_llm = config["configurable"]["query_llm"]
+    result = await route_and_identify_facts(query_llm, state["question"])
+    if isinstance(result, dict):
+        if "failed" in result.keys():
+            return {"resume": "error", "error_log": result["failed"]}
+    medical, desired_fact, fact_provided = result
+    if not medical:
+        # a non-medical reply to "is this what you were looking for?" accepts the answer
+        if state.get("follow_up"):
+            user_validations = state.get("user_validations", [])
+            user_validations.append((state["follow_up"], "sesuai"))
+            return {"resume": "thank_you", "user_validations": user_validations, "follow_up": None}
+        return {"resume": "answer_non_medical", "follow_up": None}
+    if len(fact_provided) == 0:
+        return {"resume": "no_fact", "desired_fact": desired_fact, "fact_provided": fact_provided, "follow_up": None}
+    else:
+        return {"resume": "retrieve", "desired_fact": desired_fact, "fact_provided": fact_provided, "follow_up": None}
+
+async def _ask_validation_combined_(state: State, config: dict):
+    # the classifier call moves into _route_, which sees the reply together with its facts
+    answer = interrupt("ask_revision")
+
+    user_validations = state.get("user_validations", [])
+
+    if answer == "tidak":
+        user_validations.append((state["question"], "tidak_sesuai"))
+        # a rejected answer is not served again from the cache
+        answer_cache = config["configurable"].get("answer_cache")
+        if answer_cache is not None:
+            answer_cache.invalidate(state_cache_key(state, config))
+        return {"resume": "validate", "user_validations": user_validations}
+    else:
+        return {"resume": "route", "question": answer, "follow_up": state["question"]}
     
 def _resume_(state: State, config: dict):
     return state["resume"]
     
-def _validate_(state: State, config: dict):
+async def _validate_(state: State, config: dict):
     revised = interrupt("input_revision")
     query_llm = config["configurable"]["query_llm"]
-    result = revise_facts(query_llm, state["fact_provided"], revised)
+    _, correct_facts = fact_extractors(config)
+    result = await correct_facts(query_llm, state["fact_provided"], revised)
     if isinstance(result, dict):
         if "failed" in result.keys():
             return {"resume":"error", "error_log": result["failed"]}
@@ -362,44 +687,137 @@ graph_builder.add_conditional_edges(START, _retrieve_or_not_, {"identify_facts":
 graph_builder.add_edge("answer_non_medical", END)
 graph_builder.add_conditional_edges("identify_facts", _resume_, {"retrieve": "retrieve", "no_fact": "no_fact", "error": "error"})
 graph_builder.add_edge("no_fact", "identify_facts")
-graph_builder.add_conditional_edges("retrieve", _resume_, {"generate": "generate", "error": "error"})
+graph_builder.add_conditional_edges("retrieve", _resume_, {"generate": "generate", "cached": "ask_validation", "error": "error"})
 graph_builder.add_edge("generate", "ask_validation")
 graph_builder.add_conditional_edges("ask_validation", _resume_, {"validate": "validate", "identify_facts": "identify_facts", "thank_you": "thank_you"})
 graph_builder.add_conditional_edges("validate", _resume_, {"retrieve": "retrieve", "no_fact": "no_fact", "error": "error"})
 graph_builder.add_edge("error", END)
 graph_builder.add_edge("thank_you", END)
 
-client = MongoClient("mongodb://localhost:27017")
-db = client["langgraph"]
-collection = db["checkpoints"]
-checkpointer = MongoDBSaver(client=client, collection=collection)
-graph = graph_builder.compile(checkpointer=checkpointer)
-
-def start_qa(question, graph, config):
-    result = graph.invoke({"question": question}, config=config)
+# same conversation with routing and fact extraction done by one LLM call in _route_
+combined_graph_builder = StateGraph(State)
+
+combined_graph_builder.add_node("route", _route_)
+combined_graph_builder.add_node("answer_non_medical", _answer_non_medical_)
+combined_graph_builder.add_node("no_fact", _no_fact_)
+combined_graph_builder.add_node("retrieve", _retrieve_)
+combined_graph_builder.add_node("generate", _generate_)
+combined_graph_builder.add_node("ask_validation", _ask_validation_combined_)
+combined_graph_builder.add_node("validate", _validate_)
+combined_graph_builder.add_node("thank_you", _thank_you_)
+combined_graph_builder.add_node("error", _error_)
+combined_graph_builder.add_edge(START, "route")
+combined_graph_builder.add_conditional_edges("route", _resume_, {"retrieve": "retrieve", "no_fact": "no_fact", "answer_non_medical": "answer_non_medical", "thank_you": "thank_you", "error": "error"})
+combined_graph_builder.add_edge("answer_non_medical", END)
+combined_graph_builder.add_edge("no_fact", "route")
+combined_graph_builder.add_conditional_edges("retrieve", _resume_, {"generate": "generate", "cached": "ask_validation", "error": "error"})
+combined_graph_builder.add_edge("generate", "ask_validation")
+combined_graph_builder.add_conditional_edges("ask_validation", _resume_, {"validate": "validate", "route": "route"})
+combined_graph_builder.add_conditional_edges("validate", _resume_, {"retrieve": "retrieve", "no_fact": "no_fact", "error": "error"})
+combined_graph_builder.add_edge("error", END)
+combined_graph_builder.add_edge("thank_you", END)
+
+def create_checkpointer(mongo_uri="mongodb://localhost:27017"):
+    client = AsyncIOMotorClient(mongo_uri)
+    return AsyncMongoDBSaver(client=client, db_name="langgraph")
+
+def compile_graph(checkpointer, mode="classic"):
+    # "classic": classifier call then identify_facts, "combined": one route + extract call
+    builder = combined_graph_builder if mode == "combined" else graph_builder
+    return builder.compile(checkpointer=checkpointer)
+
+async def start_qa(question, graph, config):
+    result = await graph.ainvoke({"question": question}, config=config)
     return result
 
-def resume_qa(question, graph, config):
-    result = graph.invoke(Command(resume=question), config=config)
+async def resume_qa(question, graph, config):
+    result = await graph.ainvoke(Command(resume=question), config=config)
     return result
 
-def init_components(df_path, embedding_db_path, embedding_model=None, embedding_model_path=None):
+async def stream_qa(question, graph, config, resume=False):
+    # yields ("updates", {node: update}) as nodes finish and ("messages", (chunk, metadata)) as LLM tokens arrive
+    graph_input = Command(resume=question) if resume else {"question": question}
+    async for mode, chunk in graph.astream(graph_input, config=config, stream_mode=["updates", "messages"]):
+        yield mode, chunk
+
+def init_retrieval(df_path, embedding_db_path, embedding_model=None, embedding_model_path=None, semantic_backend="chroma", matrix_dtype="float32", embedding_cache_size=4096, embedding_cache_path=None, artifact_dir=None, embedding_batch_size=0, embedding_batch_wait=0.005, embedding_backend="torch", onnx_dir=None, onnx_threads=None):
     load_dotenv()
-    df = pd.read_csv(df_path) #./app/chatbot/scrapping_auto_df.csv
-    col_to_embed = [
-        "Aturan Pakai", "Dosis", "Efek Samping", "Golongan Produk", "Indikasi Umum",
-        "Kemasan", "Komposisi", "Kontra Indikasi", "Perhatian", "Deskripsi"
-    ]
-    create_retriever = CreateRetriever(df, col_to_embed)
-    lexical_retrievers = create_retriever.create_lexical_retriever()
-    if embedding_model_path:
+    catalog_hash = file_hash(df_path)
+    # a prebuilt bundle (python -m app.chatbot.build_index) for this exact catalog skips every index build
+    bundle = load_bundle(artifact_dir, catalog_hash) if artifact_dir else None
+    if bundle:
+        df = bundle["df"]
+        ngram_index = bundle["ngram_index"]
+        lexical_retrievers = bundle["bm25_index"]
+    else:
+        df = pd.read_csv(df_path) #./app/chatbot/scrapping_auto_df.csv
+        ngram_index = load_or_build_ngram_index(df_path, df, ["Nama Obat", "Manufaktur"], source_hash=catalog_hash)
+        lexical_retrievers = load_or_build_bm25_index(df_path, df, COL_TO_EMBED, catalog_hash)
+    df.attrs["catalog_hash"] = catalog_hash
+    if bundle and bundle["chroma_path"]:
+        embedding_db_path = bundle["chroma_path"]
+    elif bundle and "update" in bundle["manifest"] and semantic_backend != "matrix":
+        # the shared collection holds the doc_ids of the build_index bundle, not of an updated one
+        raise ValueError(f"bundle {bundle['manifest']['version']} has no Chroma collection of its own, use SEMANTIC_BACKEND=matrix or rebuild with python -m app.chatbot.build_index")
+    col_to_embed = COL_TO_EMBED
+    create_retriever = CreateRetriever(df, col_to_embed, embedding_backend, onnx_dir, onnx_threads)
+    if semantic_backend == "matrix":
+        # per-column embedding matrices next to the Chroma directory, exported from it when it exists
+        matrix_path = bundle["matrix_path"] if bundle and bundle["matrix_path"] else f"{embedding_db_path.rstrip('/')}_matrix_{matrix_dtype}"
+        semantic_retriever = create_retriever.create_matrix_retriever(matrix_path, embedding_model_path or embedding_model, matrix_dtype, chroma_path=embedding_db_path)
+    elif embedding_model_path:
         semantic_retriever = create_retriever.create_semantic_retriever(embedding_db_path, embedding_model_path) #./app/chatbot/halodoc_db || ./app/chatbot/embedding_model/e5
     else:
         semantic_retriever = create_retriever.create_semantic_retriever(embedding_db_path, embedding_model) #./app/chatbot/halodoc_db || intfloat/multilingual-e5-large-instruct
-    query_llm = Groq(api_key=os.getenv("GROQ_KEY"))
+    df.attrs["embedding_space"] = embedding_space(semantic_retriever.embed_model, embedding_model_path or embedding_model)
+    if embedding_batch_size > 1:
+        # cache misses of concurrent requests share one forward pass
+        semantic_retriever.embed_model = BatchingEmbeddings(semantic_retriever.embed_model, embedding_batch_size, embedding_batch_wait)
+    # repeated fact strings ("demam", "sakit kepala") are embedded once, optionally across restarts
+    embedding_cache = EmbeddingCache(embedding_cache_size, embedding_cache_path)
+    # cached vectors of one backend are not served to another, an int8 model gives slightly different ones
+    cache_model = embedding_model_path or embedding_model if embedding_backend == "torch" else f"{embedding_model_path or embedding_model}|{embedding_backend}"
+    semantic_retriever.embed_model = CachedEmbeddings(semantic_retriever.embed_model, cache_model, embedding_cache)
+    return df, lexical_retrievers, semantic_retriever, ngram_index
+
+def reload_retrieval(artifact_dir, semantic_retriever, embedding_space, semantic_backend="chroma"):
+    # loads the bundle CURRENT points to next to the running catalog, the query embedding model (with its
+    # cache and batcher) is reused. Bundles written by update_index keep doc_ids stable, so graph states
+    # holding row ids stay valid across the swap
+    manifest = current_manifest(artifact_dir)
+    if manifest is None:
+        raise ValueError(f"no current bundle in {artifact_dir}, build one with python -m app.chatbot.build_index")
+    bundle = load_bundle(artifact_dir, manifest["source_hash"])
+    df = bundle["df"]
+    df.attrs["catalog_hash"] = manifest["source_hash"]
+    df.attrs["embedding_space"] = embedding_space
+    if semantic_backend == "matrix":
+        if bundle["matrix_path"] is None or manifest["embedding_model"] != embedding_space:
+            raise ValueError(f"bundle {manifest['version']} has no {embedding_space} embeddings for the matrix backend")
+        semantic_retriever = MatrixSemanticIndex(bundle["matrix_path"], semantic_retriever.embed_model)
+    else:
+        # the collection being served holds the doc_ids of the old catalog, only a collection written
+        # for this bundle (by update_index) matches the new one
+        if bundle["chroma_path"] is None or manifest["embedding_model"] != embedding_space:
+            raise ValueError(f"bundle {manifest['version']} has no {embedding_space} Chroma collection of its own, restart the workers or use the matrix backend")
+        vector_db = Chroma(
+            collection_name="halodoc_embeddings",
+            embedding_function=semantic_retriever.embed_model,
+            persist_directory=bundle["chroma_path"],
+        )
+        semantic_retriever = ChromaSemanticIndex(vector_db, semantic_retriever.embed_model)
+    return df, bundle["bm25_index"], semantic_retriever, bundle["ngram_index"], manifest
+
+def init_llms():
+    load_dotenv()
+    query_llm = AsyncGroq(api_key=os.getenv("GROQ_KEY"))
     llm = ChatGroq(model="llama-3.1-8b-instant", temperature=0, api_key=os.getenv("GROQ_KEY"))
-    return df, lexical_retrievers, semantic_retriever, query_llm, llm
+    return query_llm, llm
 
+def init_components(df_path, embedding_db_path, **kwargs):
+    df, lexical_retrievers, semantic_retriever, ngram_index = init_retrieval(df_path, embedding_db_path, **kwargs)
+    query_llm, llm = init_llms()
+    return df, lexical_retrievers, semantic_retriever, ngram_index, query_llm, llm
 
 if __name__ == "__main__":
     import argparse
@@ -410,18 +828,20 @@ if __name__ == "__main__":
     if args.query:
         query = args.query
 
-        df, lexical_retrievers, semantic_retriever, query_llm, llm = init_components()
+        df, lexical_retrievers, semantic_retriever, ngram_index, query_llm, llm = init_components()
 
         state = {
             "df": df,
             "lexical_retrievers": lexical_retrievers,
             "semantic_retriever": semantic_retriever,
+            "ngram_index": ngram_index,
             "query_llm": query_llm,
             "question": query,
             "llm": llm
         }
 
-        result = graph.invoke(state)
+        graph = compile_graph(create_checkpointer())
+        result = asyncio.run(graph.ainvoke(state, config={"configurable": {"thread_id": str(uuid.uuid4())}}))
         # print(f'Context: {result["context"]}\\n\\n')
         # print(f'Answer: {result["answer"]}')
     else:
@@ -1,127 +1,45 @@
+import numpy as np
 import pandas as pd
 import os
+import time
 import torch
 from langchain_chroma import Chroma
 from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.retrievers import BM25Retriever
 
+from app.chatbot.checksum import file_hash
+from app.chatbot.bm25_index import BM25Index
+from app.chatbot.semantic_index import ChromaSemanticIndex, MatrixSemanticIndex, save_matrix_index, export_chroma_embeddings
+from app.chatbot.fusion import HYBRID_WEIGHTS, rank_descending, top_n_indices, rank_columns, rrf_rank, fuse_rank_df, rrf_score_range
+# the rankers import neither torch nor langchain, retrieval worker processes import them from app.chatbot.ranking
+from app.chatbot.ranking import RANKER_POOL, SUBQUERY_POOL, ReciprocalRankFusion, fill_missing_ranks, JaroWinklerRanking, LexicalRanking, SemanticRanking, timed_rank, run_rankers, hybrid_rank
+
+from rapidfuzz import process
 from rapidfuzz.distance import JaroWinkler
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 
-def ReciprocalRankFusion(rank_df, k, name):
-    rank_df[name] = rank_df.apply(lambda x: sum(1 / (k + x[col]) if "jaro_winkler" not in col else 2 / (k + x[col]) for col in rank_df.columns if "rank" in col), axis=1).rank(ascending=False, method="min")
-    return rank_df
-
-class JaroWinklerRanking():
-    def __init__(self, doc_df):
-        self.doc_df = doc_df
-        self.doc_len = len(doc_df)
-        self.df = pd.DataFrame({"id": [i for i in range(self.doc_len)]})
-
-    def rank(self, query_dict):
-        for query_type, query in query_dict.items():
-            if query_type in ["Nama Obat", "Manufaktur"]:
-                if isinstance(query, list):
-                    for i, item in enumerate(query):
-                        results = self.doc_df[[query_type]].copy()
-                        results["score"] = results[query_type].apply(lambda x: JaroWinkler.similarity(x, item))
-                        results_id = results.sort_values(by="score", ascending=False).index.to_list()
-                        results_score = results.sort_values(by="score", ascending=False)["score"].to_list()
-
-                        col_df = pd.DataFrame({"id": results_id, f"{query_type}_{i}_score": results_score})
-                        col_df["id"] = col_df["id"].astype(int)
-                        self.df = pd.merge(left=self.df, right=col_df, how="left", on="id")
-                        self.df[f"{query_type}_{i}_score"] = self.df[f"{query_type}_{i}_score"].fillna(self.df[f"{query_type}_{i}_score"].min())
-                else:
-                    results = self.doc_df[[query_type]].copy()
-                    results["score"] = results[query_type].apply(lambda x: JaroWinkler.similarity(x, query))
-                    results_id = results.sort_values(by="score", ascending=False).index.to_list()
-                    results_score = results.sort_values(by="score", ascending=False)["score"].to_list()
-
-                    col_df = pd.DataFrame({"id": results_id, f"{query_type}_score": results_score})
-                    col_df["id"] = col_df["id"].astype(int)
-                    self.df = pd.merge(left=self.df, right=col_df, how="left", on="id")
-                    self.df[f"{query_type}_score"] = self.df[f"{query_type}_score"].fillna(self.df[f"{query_type}_score"].min())
-
-        rank_df = self.df.copy()
-        rank_df["jaro_winkler_rank"] = rank_df.apply(lambda x: sum(x[col] for col in rank_df.columns if "score" in col) / len(query_dict), axis=1).rank(ascending=False, method="min")
-
-        return rank_df[["id", "jaro_winkler_rank"]]        
-
-
-class LexicalRanking():
-    def __init__(self, retrievers, doc_df):
-        self.retrievers = retrievers
-        self.doc_df = doc_df
-        self.doc_len = len(doc_df)
-        self.df = pd.DataFrame({"id": [i for i in range(self.doc_len)]})
-
-    def rank(self, query_dict):
-        for query_type, query in query_dict.items():
-            if query_type not in ["Nama Obat", "Manufaktur"]:
-                if isinstance(query, list):
-                    for i, item in enumerate(query):
-                        results = self.retrievers[query_type].invoke(item)
-                        results_id = [result.metadata["doc_id"] for result in results]
-                        results_rank = [i for i in range(1, self.doc_len + 1)]
-
-                        col_df = pd.DataFrame({"id": results_id, f"{query_type}_{i}_rank": results_rank})
-                        col_df["id"] = col_df["id"].astype(int)
-                        self.df = pd.merge(left=self.df, right=col_df, how="left", on="id")
-                else:
-                    results = self.retrievers[query_type].invoke(query)
-                    results_id = [result.metadata["doc_id"] for result in results]
-                    results_rank = [i for i in range(1, self.doc_len + 1)]
-
-                    col_df = pd.DataFrame({"id": results_id, f"{query_type}_rank": results_rank})
-                    col_df["id"] = col_df["id"].astype(int)
-                    self.df = pd.merge(left=self.df, right=col_df, how="left", on="id")
-
-        rank_df = ReciprocalRankFusion(self.df, 60, "lexical_rank")
-
-        return rank_df[["id", "lexical_rank"]]
-    
-class SemanticRanking():
-    def __init__(self, retriever, doc_df):
-        self.retriever = retriever
-        self.doc_df = doc_df
-        self.doc_len = len(doc_df)
-        self.df = pd.DataFrame({"id": [i for i in range(self.doc_len)]})
-
-    def rank(self, query_dict):
-        for query_type, query in query_dict.items():
-            if query_type not in ["Nama Obat", "Manufaktur"]:
-                if isinstance(query, list):
-                    for i, item in enumerate(query):
-                        results = self.retriever.similarity_search_with_relevance_scores(item, filter={"column": query_type}, k=self.doc_len)
-                        results_id = [result[0].metadata["doc_id"] for result in results]
-                        results_score = [result[1] for result in results]
-
-                        col_df = pd.DataFrame({"id": results_id, f"{query_type}_{i}_score": results_score})
-                        col_df["id"] = col_df["id"].astype(int)
-                        self.df = pd.merge(left=self.df, right=col_df, how="left", on="id")
-                        self.df[f"{query_type}_{i}_score"] = self.df[f"{query_type}_{i}_score"].fillna(self.df[f"{query_type}_{i}_score"].min())
-                else:
-                    results = self.retriever.similarity_search_with_relevance_scores(query, filter={"column": query_type}, k=self.doc_len)
-                    results_id = [result[0].metadata["doc_id"] for result in results]
-                    results_score = [result[1] for result in results]
-
-                    col_df = pd.DataFrame({"id": results_id, f"{query_type}_score": results_score})
-                    col_df["id"] = col_df["id"].astype(int)
-                    self.df = pd.merge(left=self.df, right=col_df, how="left", on="id")
-                    self.df[f"{query_type}_score"] = self.df[f"{query_type}_score"].fillna(self.df[f"{query_type}_score"].min())
-
-        rank_df = self.df.copy()
-        rank_df["semantic_rank"] = rank_df.apply(lambda x: sum(x[col] for col in rank_df.columns if "score" in col) / len(query_dict), axis=1).rank(ascending=False, method="min")
-
-        return rank_df[["id", "semantic_rank"]]
-    
+COL_TO_EMBED = [
+    "Aturan Pakai", "Dosis", "Efek Samping", "Golongan Produk", "Indikasi Umum",
+    "Kemasan", "Komposisi", "Kontra Indikasi", "Perhatian", "Deskripsi"
+]
+
+def embedding_space(embed_model, embedding_model):
+    # document vectors are only reused by a query model of the same space
+    return getattr(embed_model, "space", embedding_model)
+
 class CreateRetriever():
-    def __init__(self, df, col_to_embed):
+    def __init__(self, df, col_to_embed, embedding_backend="torch", onnx_dir=None, onnx_threads=None):
         self.df = df
         self.col_to_embed = col_to_embed
-
-    def create_semantic_retriever(self, chroma_path, embedding_model):
+        # "torch" (HuggingFaceEmbeddings), "onnx" or "onnx-int8" (onnxruntime, exported on first use)
+        self.embedding_backend = embedding_backend
+        self.onnx_dir = onnx_dir
+        self.onnx_threads = onnx_threads
+
+    def create_embedding_model(self, embedding_model):
+        if self.embedding_backend in ["onnx", "onnx-int8"]:
+            from app.chatbot.onnx_embeddings import load_onnx_embeddings
+            return load_onnx_embeddings(embedding_model, self.onnx_dir, self.embedding_backend == "onnx-int8", self.onnx_threads, self.df, self.col_to_embed)
         device = 'cuda' if torch.cuda.is_available() else 'cpu'
         model_kwargs = {'device': device}
         encode_kwargs = {'normalize_embeddings': False}
@@ -130,6 +48,14 @@ class CreateRetriever():
             model_kwargs=model_kwargs,
             encode_kwargs=encode_kwargs
         )
+        return embed_model
+
+    def create_semantic_retriever(self, chroma_path, embedding_model):
+        embed_model = self.create_embedding_model(embedding_model)
+        space = embedding_space(embed_model, embedding_model)
+        if space != embedding_model:
+            # the collection holds vectors of the original model, another space gets its own collection
+            chroma_path = f"{chroma_path.rstrip('/')}_{space.rsplit('@', 1)[-1]}"
 
         if os.path.isdir(chroma_path):
             vector_db = Chroma(
@@ -160,34 +86,31 @@ class CreateRetriever():
                 persist_directory=chroma_path
             )
 
-        return vector_db
+        return ChromaSemanticIndex(vector_db, embed_model)
+
+    def create_matrix_retriever(self, matrix_path, embedding_model, dtype="float32", chroma_path=None):
+        embed_model = self.create_embedding_model(embedding_model)
+        space = embedding_space(embed_model, embedding_model)
+        if space != embedding_model:
+            # Chroma and the fp32 matrices hold vectors of the original model, the catalog is re-embedded next to them
+            matrix_path = f"{matrix_path.rstrip('/')}_{space.rsplit('@', 1)[-1]}"
+            chroma_path = None
+
+        if not os.path.isdir(matrix_path):
+            if chroma_path and os.path.isdir(chroma_path):
+                # reuse the vectors already stored in Chroma instead of re-embedding the catalog
+                vector_db = Chroma(
+                    collection_name="halodoc_embeddings",
+                    embedding_function=embed_model,
+                    persist_directory=chroma_path,
+                )
+                column_embeddings = export_chroma_embeddings(vector_db, self.df, self.col_to_embed, embed_model.embed_documents)
+            else:
+                column_embeddings = {col: embed_model.embed_documents([str(text) for text in self.df[col].to_list()]) for col in self.col_to_embed}
+
+            save_matrix_index(matrix_path, column_embeddings, dtype, space)
+
+        return MatrixSemanticIndex(matrix_path, embed_model)
     
-    def create_lexical_retriever(self):
-        texts = []
-        metadatas = []
-        ids = []
-
-        lexical_retrievers = {col:"" for col in self.col_to_embed}
-
-        for col in self.col_to_embed:
-            
-            for _, row in self.df.iterrows():
-                doc_id = str(row.name)  # or another unique key
-                text = str(row[col])
-                texts.append(text)
-                metadatas.append({"doc_id": doc_id, "column": col})
-                ids.append(f"{doc_id}_{col}")
-
-            lexical_retrievers[col] = BM25Retriever.from_texts(
-                texts=texts,
-                metadatas=metadatas,
-                ids=ids,
-            )
-
-            lexical_retrievers[col].k = len(self.df)
-
-            texts = []
-            metadatas = []
-            ids = []
-
-        return lexical_retrievers
\ No newline at end of file
+    def create_lexical_retriever(self, source_hash=""):
+        return BM25Index.build(self.df, self.col_to_embed, source_hash)
@@ -0,0 +1,10 @@
+import hashlib
+
+
+# kept free of the model and vector store imports, index modules and retrieval workers hash the catalog too
+def file_hash(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
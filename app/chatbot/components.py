@@ -0,0 +1,239 @@
+import time
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Components():
+    # chatbot components are loaded on first use (or by a background warm-up) instead of at import,
+    # app.chatbot.chatbot pulls in torch and the embedding model so it is only imported by the loaders
+    def __init__(self, settings):
+        # settings: a ChatbotSettings, see app.chatbot.settings
+        self.settings = settings
+        # bounds how many hybrid_retrieve calls run at once, the rest queue instead of oversubscribing the cpu
+        self.retrieval_executor = ThreadPoolExecutor(max_workers=settings.ranking.workers, thread_name_prefix="retrieval")
+        # worker processes sharing the memory-mapped artifact bundle, only in the "process" ranking mode
+        self.retrieval_pool = None
+
+        self.answer_cache = None
+        self.retrieval_cache = None
+        self.embedding_batcher = None
+
+        self.retrieval = None
+        self.llms = None
+        self.graph = None
+        self.locks = {name: threading.Lock() for name in ["retrieval", "llm", "graph", "reload"]}
+        # held while a request snapshots the retrieval components and while a reload swaps them
+        self.swap_lock = threading.Lock()
+        self.catalog = {"version": None, "loaded_at": None, "swaps": 0, "last_swap": None, "reloading": False, "error": None}
+        self.watcher_stop = threading.Event()
+        self.failed_version = None
+        self.status = {name: {"loaded": False, "seconds": None, "error": None} for name in ["retrieval", "llm", "graph"]}
+
+    def _load(self, name, loader):
+        with self.locks[name]:
+            if self.status[name]["loaded"]:
+                return
+            start = time.perf_counter()
+            try:
+                loader()
+            except Exception as e:
+                self.status[name]["error"] = repr(e)
+                raise
+            self.status[name] = {"loaded": True, "seconds": time.perf_counter() - start, "error": None}
+            print(f"{name} loaded in {self.status[name]['seconds']:.2f}s")
+
+    def load_retrieval(self):
+        def loader():
+            from app.chatbot.chatbot import init_retrieval
+            df, lexical_retrievers, semantic_retriever, ngram_index = init_retrieval(self.settings.df_path, self.settings.embedding_db_path, **self.settings.retrieval.init_kwargs())
+            self.retrieval = {
+                "df": df,
+                "lexical_retrievers": lexical_retrievers,
+                "semantic_retriever": semantic_retriever,
+                "ngram_index": ngram_index,
+            }
+            from app.chatbot.embedding_batcher import BatchingEmbeddings
+            if isinstance(semantic_retriever.embed_model.embed_model, BatchingEmbeddings):
+                self.embedding_batcher = semantic_retriever.embed_model.embed_model
+            cache = self.settings.cache
+            if cache.retrieval_size > 0:
+                from app.chatbot.retrieval_cache import RetrievalCache
+                if cache.retrieval_uri:
+                    self.retrieval_cache = RetrievalCache.with_mongo(cache.retrieval_uri, cache.retrieval_size)
+                else:
+                    self.retrieval_cache = RetrievalCache(cache.retrieval_size)
+                self.retrieval_cache.check_version(df.attrs["catalog_hash"])
+            if cache.answer_size > 0:
+                from app.chatbot.answer_cache import AnswerCache
+                self.answer_cache = AnswerCache(cache.answer_size, cache.answer_ttl, cache.answer_similarity, embed=semantic_retriever.embed_model.embed_documents)
+                self.answer_cache.check_version(df.attrs["catalog_hash"])
+            self.retrieval_pool = self.create_retrieval_pool(df, semantic_retriever)
+            self.catalog.update({"version": df.attrs["catalog_hash"][:16], "loaded_at": time.strftime("%Y-%m-%dT%H:%M:%S")})
+        self._load("retrieval", loader)
+
+    def create_retrieval_pool(self, df, semantic_retriever):
+        if self.settings.ranking.mode != "process":
+            return None
+        from app.chatbot.retrieval_pool import RetrievalPool
+        retrieval_pool = RetrievalPool.from_artifacts(self.settings.retrieval.artifact_dir, df.attrs["catalog_hash"], semantic_retriever.embed, self.settings.ranking.workers, df.attrs.get("embedding_space"))
+        if retrieval_pool is None:
+            print("no artifact bundle with embeddings for this catalog, retrieval stays on threads")
+        else:
+            retrieval_pool.warm_up()
+        return retrieval_pool
+
+    def reload_retrieval(self):
+        # loads the bundle CURRENT points to while the old one keeps serving, then swaps it in. Requests that
+        # already took their config finish on the old catalog (and the old worker processes)
+        from app.chatbot.artifacts import current_version
+        from app.chatbot.chatbot import reload_retrieval
+
+        self.load_retrieval()
+        if not self.locks["reload"].acquire(blocking=False):
+            return {"reloaded": False, "reason": "a reload is already running", **self.catalog_status()}
+        try:
+            version = current_version(self.settings.retrieval.artifact_dir)
+            if version is None or version == self.catalog["version"]:
+                return {"reloaded": False, "reason": "up to date", **self.catalog_status()}
+            self.catalog["reloading"] = True
+            start = time.perf_counter()
+            try:
+                old = self.retrieval
+                df, lexical_retrievers, semantic_retriever, ngram_index, manifest = reload_retrieval(
+                    self.settings.retrieval.artifact_dir, old["semantic_retriever"], old["df"].attrs.get("embedding_space"), self.settings.retrieval.semantic_backend
+                )
+                retrieval = {
+                    "df": df,
+                    "lexical_retrievers": lexical_retrievers,
+                    "semantic_retriever": semantic_retriever,
+                    "ngram_index": ngram_index,
+                }
+                retrieval_pool = self.create_retrieval_pool(df, semantic_retriever)
+            except Exception as e:
+                self.catalog.update({"reloading": False, "error": repr(e)})
+                self.failed_version = version
+                raise
+            load_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            with self.swap_lock:
+                old_pool = self.retrieval_pool
+                self.retrieval = retrieval
+                self.retrieval_pool = retrieval_pool
+                # entries of the old catalog are dropped before the first request on the new one
+                for cache in [self.retrieval_cache, self.answer_cache]:
+                    if cache is not None:
+                        cache.check_version(df.attrs["catalog_hash"])
+            swap_seconds = time.perf_counter() - start
+
+            self.catalog.update({
+                "version": manifest["version"],
+                "loaded_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "swaps": self.catalog["swaps"] + 1,
+                "last_swap": {"from": old["df"].attrs["catalog_hash"][:16], "to": manifest["version"], "load_seconds": load_seconds, "swap_seconds": swap_seconds},
+                "reloading": False,
+                "error": None,
+            })
+            print(f"catalog {manifest['version']} loaded in {load_seconds:.2f}s, swapped in {swap_seconds * 1000:.3f}ms")
+            if old_pool is not None:
+                # requests that took their config before the swap may still submit to the old workers
+                # (retrieval runs after the fact extraction call), they are retired after a grace period
+                def retire():
+                    time.sleep(self.settings.reload_grace)
+                    old_pool.shutdown(wait=True)
+                threading.Thread(target=retire, name="retrieval-pool-retire", daemon=True).start()
+            return {"reloaded": True, **self.catalog_status()}
+        finally:
+            self.locks["reload"].release()
+
+    def watch_catalog(self, interval):
+        # polls CURRENT, which update_index and build_index switch only once a bundle is complete
+        from app.chatbot.artifacts import current_version
+
+        def watch():
+            while not self.watcher_stop.wait(interval):
+                if not self.status["retrieval"]["loaded"]:
+                    continue
+                # a bundle that failed to load is not retried until CURRENT changes again
+                if current_version(self.settings.retrieval.artifact_dir) in [None, self.catalog["version"], self.failed_version]:
+                    continue
+                try:
+                    self.reload_retrieval()
+                except Exception as e:
+                    # the old catalog keeps serving, the next change of CURRENT is tried again
+                    print(f"catalog reload failed: {e!r}")
+        thread = threading.Thread(target=watch, name="catalog-watcher", daemon=True)
+        thread.start()
+        return thread
+
+    def catalog_status(self):
+        return dict(self.catalog)
+
+    def load_llms(self):
+        def loader():
+            from app.chatbot.chatbot import init_llms
+            query_llm, llm = init_llms()
+            self.llms = {"query_llm": query_llm, "llm": llm}
+        self._load("llm", loader)
+
+    def load_graph(self):
+        def loader():
+            from app.chatbot.chatbot import create_checkpointer, compile_graph
+            self.graph = compile_graph(create_checkpointer(self.settings.llm.checkpoint_uri), self.settings.llm.graph_mode)
+        self._load("graph", loader)
+
+    def load_all(self):
+        self.load_llms()
+        self.load_graph()
+        self.load_retrieval()
+
+    def warm_up_in_background(self):
+        def warm_up():
+            try:
+                self.load_all()
+            except Exception as e:
+                # the first chat request retries the failed component
+                print(f"warm-up failed: {e!r}")
+        thread = threading.Thread(target=warm_up, name="chatbot-warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    def shutdown(self):
+        self.watcher_stop.set()
+        self.retrieval_executor.shutdown(wait=False, cancel_futures=True)
+        if self.retrieval_pool is not None:
+            self.retrieval_pool.shutdown()
+        if self.embedding_batcher is not None:
+            self.embedding_batcher.close()
+
+    def ready(self):
+        return all(status["loaded"] for status in self.status.values())
+
+    def readiness(self):
+        return {"ready": self.ready(), "components": self.status}
+
+    def chat_config(self, thread_id):
+        self.load_all()
+        with self.swap_lock:
+            retrieval, retrieval_pool = self.retrieval, self.retrieval_pool
+        ranking, llm = self.settings.ranking, self.settings.llm
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                **self.llms,
+                **retrieval,
+                "top_n": ranking.top_n,
+                # the n-gram shortlist trades Jaro-Winkler recall for a few ms, off means the exact scan over every name
+                "full_scan": not ranking.ngram_shortlist,
+                "ranker_deadline": ranking.ranker_deadline,
+                "fact_parser": llm.fact_parser,
+                "fact_retries": llm.fact_retries,
+                "context_budget": llm.context_budget,
+                "adaptive_k": ranking.adaptive_k,
+                "retrieval_executor": self.retrieval_executor,
+                "retrieval_pool": retrieval_pool,
+                "answer_cache": self.answer_cache,
+                "retrieval_cache": self.retrieval_cache
+            }
+        }
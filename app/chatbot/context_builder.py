@@ -0,0 +1,81 @@
+import math
+import numpy as np
+
+from app.chatbot.embedding_cache import normalize_text
+
+
+# always kept so the model can tell which product a fact belongs to
+IDENTIFYING_COLUMNS = ["Nama Obat", "Manufaktur", "Kemasan"]
+EXCLUDED_COLUMNS = ["Link Obat", "Check", "Link Gambar"]
+
+def count_tokens(text):
+    # the llama tokenizer is not available here, about four characters per token for latin text
+    return math.ceil(len(text) / 4)
+
+def truncate_tokens(text, max_tokens):
+    if count_tokens(text) <= max_tokens:
+        return text, False
+    return text[:max_tokens * 4].rsplit(" ", 1)[0] + " ...", True
+
+def project_row(row, columns):
+    return {col: str(row[col]) for col in columns if col in row.index and not (isinstance(row[col], float) and np.isnan(row[col]))}
+
+def context_columns(df, desired_columns):
+    # no desired fact (or an unknown one) keeps every column, as before the compaction
+    columns = [col for col in df.columns if col not in EXCLUDED_COLUMNS]
+    desired_columns = [col for col in desired_columns if col in columns]
+    if len(desired_columns) == 0:
+        return columns
+    return list(dict.fromkeys([col for col in IDENTIFYING_COLUMNS if col in columns] + desired_columns))
+
+def build_context(df, row_ids, desired_columns, budget=1500, max_field_tokens=400, fold=True):
+    # projects the retrieved rows onto the desired columns, folds variants of the same drug (rows whose
+    # desired facts are the same text up to case and spacing) into one entry and stops adding rows at the
+    # token budget. Facts differing only in a dose or strength are never folded
+    columns = context_columns(df, desired_columns)
+    fact_columns = [col for col in columns if col not in IDENTIFYING_COLUMNS] or columns
+
+    entries = []
+    for row_id in row_ids:
+        fields = project_row(df.loc[row_id], columns)
+        facts = tuple(normalize_text(fields.get(col, "")) for col in fact_columns)
+        for entry in entries:
+            if fold and entry["facts"] == facts:
+                entry["variants"].append(fields)
+                break
+        else:
+            entries.append({"fields": fields, "facts": facts, "variants": [], "row_id": row_id})
+
+    blocks, tokens, truncated = [], 0, 0
+    for entry in entries:
+        lines = []
+        for col, value in entry["fields"].items():
+            if col in IDENTIFYING_COLUMNS:
+                # identifying fields of the folded variants are listed next to the first one
+                values = list(dict.fromkeys([value] + [variant[col] for variant in entry["variants"] if col in variant]))
+                value = "; ".join(values)
+            value, cut = truncate_tokens(value, max_field_tokens)
+            truncated += cut
+            lines.append(f"{col}: {value}")
+        block = "\n".join(lines)
+        block_tokens = count_tokens(block)
+        if tokens + block_tokens > budget:
+            if len(blocks) > 0:
+                break
+            # the best row is always kept, cut down to the budget
+            block, _ = truncate_tokens(block, budget)
+            block_tokens = count_tokens(block)
+            truncated += 1
+        blocks.append(block)
+        tokens += block_tokens
+
+    report = {
+        "rows": len(row_ids),
+        "entries": len(blocks),
+        "merged": sum(len(entry["variants"]) for entry in entries),
+        "dropped": len(entries) - len(blocks),
+        "truncated": truncated,
+        "tokens": tokens,
+        "columns": columns,
+    }
+    return "\n\n".join(blocks), report
@@ -0,0 +1,120 @@
+import time
+import queue
+import threading
+import numpy as np
+
+from collections import deque
+from concurrent.futures import Future
+
+
+class BatchingEmbeddings():
+    # collects the embed_documents calls of concurrent requests for up to max_wait seconds (or max_batch texts)
+    # and runs them through the model in one forward pass, each caller blocks until its own vectors are back
+    def __init__(self, embed_model, max_batch=32, max_wait=0.005, history=1000):
+        self.embed_model = embed_model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "texts": 0, "batches": 0, "failed": 0}
+        self.batch_sizes = deque(maxlen=history)
+        self.waits = deque(maxlen=history)
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self.thread.start()
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        if len(texts) == 0:
+            return []
+        if self.closed:
+            return self.embed_model.embed_documents(texts)
+        future = Future()
+        self.requests.put((texts, future, time.perf_counter()))
+        return future.result()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    def _collect(self):
+        # blocks for the first request, then takes whatever arrives within max_wait up to max_batch texts
+        first = self.requests.get()
+        if first is None:
+            return None
+        batch, size = [first], len(first[0])
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self.requests.put(None)
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                self._drain()
+                return
+            start = time.perf_counter()
+            # the same fact string from several requests is embedded once
+            texts = list(dict.fromkeys(text for request_texts, _, _ in batch for text in request_texts))
+            try:
+                vectors = dict(zip(texts, self.embed_model.embed_documents(texts)))
+            except Exception as e:
+                with self.lock:
+                    self.counters["failed"] += len(batch)
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            with self.lock:
+                self.counters["requests"] += len(batch)
+                self.counters["texts"] += len(texts)
+                self.counters["batches"] += 1
+                self.batch_sizes.append(len(texts))
+                self.waits.extend(start - enqueued for _, _, enqueued in batch)
+            for request_texts, future, _ in batch:
+                future.set_result([vectors[text] for text in request_texts])
+
+    def _drain(self):
+        # requests queued behind the close marker are served one by one
+        while True:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            if request is None:
+                continue
+            texts, future, _ = request
+            try:
+                future.set_result(self.embed_model.embed_documents(texts))
+            except Exception as e:
+                future.set_exception(e)
+
+    def close(self):
+        # requests already queued are still served, later calls go straight to the model
+        self.closed = True
+        self.requests.put(None)
+        self.thread.join(timeout=5)
+
+    def stats(self):
+        with self.lock:
+            waits = np.array(self.waits)
+            return {
+                **self.counters,
+                "max_batch": self.max_batch,
+                "max_wait": self.max_wait,
+                "queue_depth": self.requests.qsize(),
+                "batch_size_mean": float(np.mean(self.batch_sizes)) if len(self.batch_sizes) else None,
+                "wait_p50": float(np.percentile(waits, 50)) if len(waits) else None,
+                "wait_p95": float(np.percentile(waits, 95)) if len(waits) else None,
+            }
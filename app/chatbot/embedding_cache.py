@@ -0,0 +1,102 @@
+import os
+import sqlite3
+import threading
+import numpy as np
+
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    return " ".join(str(text).split()).casefold()
+
+class EmbeddingCache():
+    def __init__(self, max_size=4096, db_path=None):
+        self.max_size = max_size
+        self.db_path = db_path
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+        self.db = None
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (model TEXT, text TEXT, vector BLOB, PRIMARY KEY (model, text))")
+            self.db.commit()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return self.entries[key]
+
+            if self.db is not None:
+                row = self.db.execute("SELECT vector FROM embeddings WHERE model = ? AND text = ?", key).fetchone()
+                if row is not None:
+                    self.counters["disk_hits"] += 1
+                    vector = np.frombuffer(row[0], dtype=np.float32)
+                    self._put(key, vector)
+                    return vector
+
+            self.counters["misses"] += 1
+            return None
+
+    def put_many(self, keys, vectors):
+        with self.lock:
+            for key, vector in zip(keys, vectors):
+                self._put(key, vector)
+            if self.db is not None:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                    [(*key, vector.tobytes()) for key, vector in zip(keys, vectors)],
+                )
+                self.db.commit()
+
+    def _put(self, key, vector):
+        self.entries[key] = vector
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counters["hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            return {
+                **self.counters,
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hit_rate": (self.counters["hits"] + self.counters["disk_hits"]) / lookups if lookups else 0.0,
+            }
+
+class CachedEmbeddings():
+    # sits in front of the query embedding model, catalog documents are never routed through it
+    def __init__(self, embed_model, model_name, cache):
+        self.embed_model = embed_model
+        self.model_name = model_name
+        self.cache = cache
+
+    def embed_documents(self, texts):
+        # the normalized text is only the cache key, the model sees the text as it was given
+        texts = [str(text) for text in texts]
+        keys = [normalize_text(text) for text in texts]
+        vectors = [self.cache.get((self.model_name, key)) for key in keys]
+
+        missing = {}
+        for key, text, vector in zip(keys, texts, vectors):
+            if vector is None:
+                missing.setdefault(key, text)
+        if len(missing) > 0:
+            computed = np.asarray(self.embed_model.embed_documents(list(missing.values())), dtype=np.float32)
+            self.cache.put_many([(self.model_name, key) for key in missing], computed)
+            computed = dict(zip(missing, computed))
+            vectors = [computed[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+
+        return [vector.tolist() for vector in vectors]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    def stats(self):
+        return self.cache.stats()
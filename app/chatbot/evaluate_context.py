@@ -0,0 +1,122 @@
+from app.chatbot.chatbot import identify_facts_structured, hybrid_retrieve, generate_context, init_retrieval, init_llms, GENERATE_PROMPT
+from app.chatbot.context_builder import count_tokens
+from app.chatbot.evaluate_routing import load_examples
+
+import time
+import asyncio
+import functools
+import argparse
+import numpy as np
+
+
+JUDGE_PROMPT = """You compare two answers to the same question about a drug. Answer A was written from the full product
+pages, answer B from a shortened context. Reply only with "yes" if B gives the same facts for what the question asks
+(it may be shorter or worded differently), or "no" if B misses or contradicts facts in A."""
+
+async def generate(llm, question, context):
+    start = time.perf_counter()
+    response = await llm.ainvoke(GENERATE_PROMPT.invoke({"question": question, "context": context}))
+    usage = getattr(response, "usage_metadata", None) or {}
+    return response.content, usage.get("input_tokens"), time.perf_counter() - start
+
+async def same_facts(query_llm, question, full_answer, compact_answer):
+    query_result = await query_llm.chat.completions.create(
+        messages=[
+            {"role": "system", "content": JUDGE_PROMPT},
+            {"role": "user", "content": f"Question: {question}\n\nAnswer A:\n{full_answer}\n\nAnswer B:\n{compact_answer}"}
+        ],
+        model="llama-3.1-8b-instant",
+        temperature=0,
+    )
+    return query_result.choices[0].message.content.strip().lower().startswith("yes")
+
+async def evaluate(examples, retrieval, query_llm, llm, budget, adaptive, generate_answers):
+    # variants: full rows of the fixed 10 (the baseline), the same rows compacted to the budget and, with
+    # adaptive thresholds, the full rows the adaptive k keeps
+    rows = []
+    for example in examples:
+        result = await identify_facts_structured(query_llm, example["question"])
+        if isinstance(result, dict):
+            continue
+        desired_fact, fact_provided = result
+        if len(fact_provided) == 0:
+            continue
+        retrieve = functools.partial(hybrid_retrieve, retrieval["df"], retrieval["lexical_retrievers"], retrieval["semantic_retriever"], desired_fact, fact_provided, 10, ngram_index=retrieval["ngram_index"])
+        result = retrieve()
+        if isinstance(result, dict):
+            # hybrid_retrieve failed, its error is already printed
+            continue
+        docs, _ = result
+
+        # the contexts _generate_ builds with context_budget 0 and with the budget
+        state = {"question": example["question"], "context": docs, "desired_fact": desired_fact}
+        contexts = {
+            "full": generate_context(state, {"configurable": {"df": retrieval["df"], "context_budget": 0}})[0],
+            "compact": generate_context(state, {"configurable": {"df": retrieval["df"], "context_budget": budget}})[0],
+        }
+        row = {"question": example["question"]}
+        if adaptive is not None:
+            result = retrieve(adaptive=adaptive)
+            if isinstance(result, dict):
+                continue
+            adaptive_docs, report = result
+            contexts["adaptive"] = generate_context({**state, "context": adaptive_docs}, {"configurable": {"df": retrieval["df"], "context_budget": 0}})[0]
+            row["k_decision"] = report["k_decision"]
+
+        for name, context in contexts.items():
+            row[f"{name}_tokens"] = count_tokens(context)
+        if generate_answers:
+            answers = {}
+            for name, context in contexts.items():
+                answers[name], row[f"{name}_prompt_tokens"], row[f"{name}_seconds"] = await generate(llm, example["question"], context)
+            for name in contexts:
+                if name != "full":
+                    row[f"{name}_same_facts"] = await same_facts(query_llm, example["question"], answers["full"], answers[name])
+        rows.append(row)
+    return rows
+
+def report(rows, generate_answers):
+    variants = [name for name in ["full", "compact", "adaptive"] if f"{name}_tokens" in rows[0]]
+    print(f"questions: {len(rows)}")
+    if "k_decision" in rows[0]:
+        decisions = [row["k_decision"]["decision"] for row in rows]
+        print("adaptive k decisions: " + ", ".join(f"{decision} {decisions.count(decision)}" for decision in sorted(set(decisions)))
+              + f", mean k {np.mean([row['k_decision']['k'] for row in rows]):.1f}")
+
+    full = np.sum([row["full_tokens"] for row in rows])
+    for name in variants:
+        line = f"{name:8}: context tokens (estimate) mean {np.mean([row[f'{name}_tokens'] for row in rows]):.0f} ({np.sum([row[f'{name}_tokens'] for row in rows]) / full - 1:+.1%})"
+        if generate_answers:
+            prompt_tokens = [row[f"{name}_prompt_tokens"] for row in rows if row[f"{name}_prompt_tokens"] is not None]
+            seconds = np.array([row[f"{name}_seconds"] for row in rows])
+            line += (f", prompt tokens mean {np.mean(prompt_tokens) if prompt_tokens else float('nan'):.0f}, "
+                     f"generate latency mean {seconds.mean() * 1000:.0f} ms, p95 {np.percentile(seconds, 95) * 1000:.0f} ms")
+            if name != "full":
+                line += f", same facts as full {np.mean([row[f'{name}_same_facts'] for row in rows]):.3f}"
+        print(line)
+
+async def main(args):
+    examples = [example for example in load_examples(args.eval_path) if example["medical"]]
+    df, lexical_retrievers, semantic_retriever, ngram_index = init_retrieval(
+        args.df_path, args.embedding_db_path, embedding_model=args.embedding_model, semantic_backend=args.semantic_backend, artifact_dir=args.artifact_dir
+    )
+    retrieval = {"df": df, "lexical_retrievers": lexical_retrievers, "semantic_retriever": semantic_retriever, "ngram_index": ngram_index}
+    query_llm, llm = init_llms()
+    adaptive = {"min_k": 1, "max_k": 20, "confident": 0.9, "margin": 0.01, "spread": 0.05} if args.adaptive_k else None
+    report(await evaluate(examples, retrieval, query_llm, llm, args.budget, adaptive, not args.no_generate), not args.no_generate)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--eval-path", default="./app/chatbot/routing_eval.jsonl")
+    parser.add_argument("--df-path", default="./app/chatbot/scrapping_auto_df.csv")
+    parser.add_argument("--embedding-db-path", default="./app/chatbot/halodoc_db")
+    parser.add_argument("--embedding-model", default="intfloat/multilingual-e5-large-instruct")
+    parser.add_argument("--semantic-backend", default="chroma")
+    parser.add_argument("--artifact-dir", default="./app/chatbot/artifacts")
+    parser.add_argument("--budget", type=int, default=1500)
+    parser.add_argument("--adaptive-k", action="store_true", help="also compare the rows kept by the adaptive k")
+    parser.add_argument("--no-generate", action="store_true", help="only compare context sizes, no answer generation")
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,84 @@
+from app.chatbot.chatbot import is_medical, identify_facts, identify_facts_structured, route_and_identify_facts, init_llms, llm_usage
+
+import json
+import time
+import asyncio
+import argparse
+import numpy as np
+
+
+def load_examples(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+async def classic_turn(llm, query_llm, question, extract_facts=identify_facts):
+    # the calls the classic graph makes before retrieval: _retrieve_or_not_ then identify_facts
+    medical = await is_medical(llm, question)
+    if not medical:
+        return medical, {}, 1
+    result = await extract_facts(query_llm, question)
+    if isinstance(result, dict):
+        return medical, None, 2
+    return medical, result[1], 2
+
+async def combined_turn(llm, query_llm, question):
+    result = await route_and_identify_facts(query_llm, question)
+    if isinstance(result, dict):
+        return None, None, 1
+    return result[0], result[2], 1
+
+async def structured_turn(llm, query_llm, question):
+    return await classic_turn(llm, query_llm, question, identify_facts_structured)
+
+TURNS = {"classic": classic_turn, "structured": structured_turn, "combined": combined_turn}
+# the helper whose token usage is reported for each mode
+EXTRACTORS = {"classic": "identify_facts", "structured": "identify_facts_structured", "combined": "route_and_identify_facts"}
+
+async def evaluate(examples, mode, llm, query_llm):
+    turn = TURNS[mode]
+    rows = []
+    for example in examples:
+        start = time.perf_counter()
+        medical, fact_provided, calls = await turn(llm, query_llm, example["question"])
+        rows.append({
+            "medical": medical,
+            "fact_types": None if fact_provided is None else set(fact_provided.keys()),
+            "seconds": time.perf_counter() - start,
+            "calls": calls,
+        })
+    return rows
+
+def report(mode, examples, rows):
+    routed = np.mean([row["medical"] == example["medical"] for example, row in zip(examples, rows)])
+    failed = sum(row["fact_types"] is None for row in rows)
+    # fact types are only compared on medical questions both the label and the mode routed to retrieval
+    overlaps = [
+        len(row["fact_types"] & set(example["fact_types"])) / len(row["fact_types"] | set(example["fact_types"]))
+        for example, row in zip(examples, rows)
+        if example["medical"] and row["medical"] and row["fact_types"] is not None and len(row["fact_types"] | set(example["fact_types"])) > 0
+    ]
+    seconds = [row["seconds"] for row in rows]
+    print(f"{mode:9}: routing accuracy {routed:.3f}, fact type jaccard {np.mean(overlaps) if overlaps else float('nan'):.3f}, "
+          f"failed extractions {failed}, llm calls/turn {np.mean([row['calls'] for row in rows]):.2f}, "
+          f"latency/turn mean {np.mean(seconds) * 1000:.0f} ms, p95 {np.percentile(seconds, 95) * 1000:.0f} ms")
+
+    usage = llm_usage().get(EXTRACTORS[mode])
+    if usage is not None:
+        print(f"{'':9}  {EXTRACTORS[mode]}: {usage['calls']} calls, {usage['retries']} retries, "
+              f"prompt tokens/call {usage['prompt_tokens_per_call']:.0f}, completion tokens/call {usage['completion_tokens_per_call']:.0f}")
+
+async def main(args):
+    examples = load_examples(args.eval_path)
+    query_llm, llm = init_llms()
+    print(f"examples: {len(examples)} ({sum(example['medical'] for example in examples)} medical)")
+    for mode in list(TURNS.keys()) if args.mode == "all" else [args.mode]:
+        report(mode, examples, await evaluate(examples, mode, llm, query_llm))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--eval-path", default="./app/chatbot/routing_eval.jsonl")
+    parser.add_argument("--mode", choices=["classic", "structured", "combined", "all"], default="all")
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
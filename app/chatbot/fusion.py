@@ -0,0 +1,79 @@
+import numpy as np
+
+
+# per-ranker weights of the hybrid fusion, name matching is the most precise signal
+HYBRID_WEIGHTS = {"lexical_rank": 1.0, "semantic_rank": 1.0, "jaro_winkler_rank": 2.0}
+
+def rank_descending(scores):
+    # equivalent to pd.Series(scores).rank(ascending=False, method="min")
+    sorted_scores = np.sort(-scores)
+    return np.searchsorted(sorted_scores, -scores, side="left") + 1.0
+
+def top_n_indices(scores, n):
+    top = np.arange(len(scores)) if n >= len(scores) else np.argpartition(-scores, n - 1)[:n]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+def rrf_scores(rank_matrix, weights=None, k=60):
+    # rank_matrix: documents x rankers
+    rank_matrix = np.asarray(rank_matrix, dtype=np.float64)
+    weights = np.ones(rank_matrix.shape[1]) if weights is None else np.asarray(weights, dtype=np.float64)
+    return (weights / (k + rank_matrix)).sum(axis=1)
+
+def rrf_rank(rank_matrix, weights=None, k=60):
+    return rank_descending(rrf_scores(rank_matrix, weights, k))
+
+def rrf_top_k(rank_matrix, top_k, weights=None, k=60):
+    # returns row positions of the top_k fused documents, best first, and their fused scores
+    scores = rrf_scores(rank_matrix, weights, k)
+    top = top_n_indices(scores, top_k)
+    return top, scores[top]
+
+def rank_columns(rank_df, weights):
+    # weights: {rank column: weight}, only the columns it names are fused, a dropped ranker's column is skipped
+    columns = [col for col in weights if col in rank_df.columns]
+    return columns, [weights[col] for col in columns]
+
+def fuse_rank_df(rank_df, top_k, weights, k=60):
+    # returns the "id" values of the top_k fused documents and their fused scores
+    columns, column_weights = rank_columns(rank_df, weights)
+    top, scores = rrf_top_k(rank_df[columns].to_numpy(), top_k, column_weights, k)
+    return rank_df["id"].to_numpy()[top].astype(int), scores
+
+def rrf_score_range(rank_matrix, weights=None, k=60):
+    # (base, max) of the fused scores: base is what rankers giving every document the same rank add to all of
+    # them, max is base plus what a document every other ranker puts first gets
+    rank_matrix = np.asarray(rank_matrix, dtype=np.float64)
+    weights = np.ones(rank_matrix.shape[1]) if weights is None else np.asarray(weights, dtype=np.float64)
+    if len(rank_matrix) == 0:
+        return 0.0, float(weights.sum()) / (k + 1)
+    constant = (rank_matrix == rank_matrix[:1]).all(axis=0)
+    base = float((weights[constant] / (k + rank_matrix[0, constant])).sum())
+    return base, base + float(weights[~constant].sum()) / (k + 1)
+
+def adaptive_k(scores, score_range, k=10, min_k=1, max_k=20, confident=0.9, margin=0.01, spread=0.05):
+    # scores: fused scores best first, at least max_k of them when available, rescaled to [0, 1] by score_range.
+    # A best candidate near 1 (the informative rankers agree on it) with fewer than k candidates within margin
+    # keeps only those, a ranking whose k-th candidate is still within spread of the best widens to all
+    # candidates within spread (up to max_k), otherwise k is kept
+    if len(scores) == 0:
+        return 0, {"decision": "empty", "k": 0, "top_score": None, "gap": None, "ties": 0, "close": 0}
+    base, top = score_range
+    scores = np.asarray(scores, dtype=np.float64)
+    normalized = (scores - base) / (top - base) if top > base else np.ones(len(scores))
+    ties = int((normalized >= normalized[0] - margin).sum())
+    close = int((normalized >= normalized[0] - spread).sum())
+    if normalized[0] >= confident and ties < k:
+        decision, chosen = "dominant", max(min_k, ties)
+    elif close >= k:
+        decision, chosen = "flat", min(max_k, close)
+    else:
+        decision, chosen = "default", k
+    chosen = min(chosen, len(scores))
+    return chosen, {
+        "decision": decision,
+        "k": chosen,
+        "top_score": float(normalized[0]),
+        "gap": float(normalized[0] - normalized[1]) if len(scores) > 1 else None,
+        "ties": ties,
+        "close": close,
+    }
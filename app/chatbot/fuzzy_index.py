@@ -0,0 +1,115 @@
+from app.chatbot.checksum import file_hash
+
+import os
+import numpy as np
+import pandas as pd
+
+
+def ngrams(text, n=3):
+    if pd.isna(text):
+        return set()
+    text = f" {' '.join(str(text).lower().split())} "
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+class NgramIndex():
+    def __init__(self, columns, n=3, source_hash=""):
+        # columns: {col: {"values", "value_of_doc", "vocab", "indptr", "indices", "value_gram_count"}}
+        self.columns = columns
+        self.n = n
+        self.source_hash = source_hash
+
+    @classmethod
+    def build(cls, df, columns, n=3, source_hash=""):
+        # grams are indexed per distinct value so low-cardinality columns (Manufaktur)
+        # shortlist whole groups of rows instead of an arbitrary subset of them
+        index = {}
+        for col in columns:
+            value_of_doc, values = pd.factorize(df[col].astype(object), use_na_sentinel=True)
+            values = np.array([str(value) for value in values], dtype=str)
+            grams, value_ids = [], []
+            value_gram_count = np.zeros(len(values), dtype=np.int32)
+
+            for value_id, value in enumerate(values):
+                value_grams = ngrams(value, n)
+                grams.extend(value_grams)
+                value_ids.extend([value_id] * len(value_grams))
+                value_gram_count[value_id] = len(value_grams)
+
+            vocab, gram_ids = np.unique(np.array(grams, dtype=f"<U{n}"), return_inverse=True)
+            value_ids = np.array(value_ids, dtype=np.int32)
+            order = np.lexsort((value_ids, gram_ids))
+
+            index[col] = {
+                "values": values,
+                "value_of_doc": value_of_doc.astype(np.int32),
+                "vocab": vocab,
+                "indptr": np.concatenate([[0], np.cumsum(np.bincount(gram_ids, minlength=len(vocab)))]).astype(np.int64),
+                "indices": value_ids[order],
+                "value_gram_count": value_gram_count,
+            }
+
+        return cls(index, n, source_hash)
+
+    def save(self, path):
+        arrays = {"n": np.array(self.n), "source_hash": np.array(self.source_hash), "columns": np.array(list(self.columns.keys()))}
+        for col, col_index in self.columns.items():
+            for name, array in col_index.items():
+                arrays[f"{col}__{name}"] = array
+        # write then rename so concurrently booting workers never read a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            columns = {
+                str(col): {name: data[f"{col}__{name}"] for name in ["values", "value_of_doc", "vocab", "indptr", "indices", "value_gram_count"]}
+                for col in data["columns"]
+            }
+            return cls(columns, int(data["n"]), str(data["source_hash"]))
+
+    def candidates(self, column, queries, max_candidates=200):
+        # returns ids into self.columns[column]["values"]
+        col_index = self.columns[column]
+        vocab = col_index["vocab"]
+
+        query_grams = set()
+        for query in queries:
+            query_grams |= ngrams(query, self.n)
+        if len(query_grams) == 0 or len(vocab) == 0:
+            return np.array([], dtype=np.int64)
+
+        query_grams = np.array(sorted(query_grams), dtype=vocab.dtype)
+        pos = np.minimum(np.searchsorted(vocab, query_grams), len(vocab) - 1)
+        gram_ids = pos[vocab[pos] == query_grams]
+        if len(gram_ids) == 0:
+            return np.array([], dtype=np.int64)
+
+        indptr, indices = col_index["indptr"], col_index["indices"]
+        postings = np.concatenate([indices[indptr[g]:indptr[g + 1]] for g in gram_ids])
+        shared = np.bincount(postings, minlength=len(col_index["values"]))
+        candidates = np.flatnonzero(shared)
+
+        if len(candidates) > max_candidates:
+            overlap = shared[candidates] / (len(query_grams) + col_index["value_gram_count"][candidates])
+            candidates = np.sort(candidates[np.argpartition(-overlap, max_candidates - 1)[:max_candidates]])
+
+        return candidates
+
+def ngram_index_path(df_path):
+    return f"{os.path.splitext(df_path)[0]}.ngram.npz"
+
+def load_or_build_ngram_index(df_path, df, columns=["Nama Obat", "Manufaktur"], n=3, source_hash=None):
+    index_path = ngram_index_path(df_path)
+    source_hash = source_hash or file_hash(df_path)
+
+    if os.path.isfile(index_path):
+        index = NgramIndex.load(index_path)
+        if index.source_hash == source_hash and index.n == n and set(columns) <= set(index.columns.keys()):
+            return index
+
+    index = NgramIndex.build(df, columns, n, source_hash)
+    index.save(index_path)
+    return index
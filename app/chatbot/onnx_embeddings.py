@@ -0,0 +1,206 @@
+import os
+import re
+import json
+import time
+import shutil
+import argparse
+import numpy as np
+
+
+# an int8 model whose query vectors keep at least this top-10 agreement with the fp32 model on the catalog
+# searches the existing fp32 document embeddings, otherwise the documents are re-embedded with it
+INT8_MIN_AGREEMENT = 0.9
+
+def model_slug(model_name):
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", model_name.strip("/"))
+
+def default_onnx_dir(model_name):
+    return os.path.join("./app/chatbot/embedding_model/onnx", model_slug(model_name))
+
+def parity_texts(df, columns, n_documents=300, n_queries=100, seed=0):
+    # catalog values as documents and their first words as the short fact strings queries usually are
+    rng = np.random.default_rng(seed)
+    values = [str(value) for col in columns for value in df[col].dropna().to_list()]
+    documents = [values[i] for i in rng.choice(len(values), min(n_documents, len(values)), replace=False)]
+    queries = [" ".join(values[i].split()[:rng.integers(2, 6)]) for i in rng.choice(len(values), min(n_queries, len(values)), replace=False)]
+    return documents, queries
+
+def rank_agreement(reference_documents, reference_queries, candidate_queries, k=10):
+    # both query sets search the reference document vectors, as the catalog embeddings stay fp32
+    reference_documents = np.asarray(reference_documents, dtype=np.float64)
+    reference_queries = np.asarray(reference_queries, dtype=np.float64)
+    candidate_queries = np.asarray(candidate_queries, dtype=np.float64)
+    k = min(k, len(reference_documents))
+
+    def top_k(queries):
+        distances = (queries ** 2).sum(axis=1)[:, None] - 2 * queries @ reference_documents.T + (reference_documents ** 2).sum(axis=1)[None, :]
+        return np.argsort(distances, axis=1, kind="stable")[:, :k]
+
+    expected, found = top_k(reference_queries), top_k(candidate_queries)
+    cosine = (reference_queries * candidate_queries).sum(axis=1) / (np.linalg.norm(reference_queries, axis=1) * np.linalg.norm(candidate_queries, axis=1))
+    return {
+        f"top{k}_agreement": float(np.mean([len(set(a) & set(b)) / k for a, b in zip(expected, found)])),
+        "top1_agreement": float(np.mean(expected[:, 0] == found[:, 0])),
+        "cosine_min": float(cosine.min()),
+        "cosine_mean": float(cosine.mean()),
+    }
+
+def export_onnx(model_name, output_dir, quantize=True, documents=None, queries=None, opset=17):
+    # exports the transformer of a sentence-transformers model to ONNX (plus a dynamically quantized int8 copy),
+    # with pooling done in numpy by OnnxEmbeddings. documents/queries run the parity check against the fp32 model
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device="cpu")
+    transformer = model[0]
+    pooling = model[1].get_pooling_mode_str() if len(model) > 1 else "mean"
+    if pooling not in ["mean", "cls"]:
+        raise ValueError(f"pooling {pooling} is not supported by the onnx backend")
+
+    tmp_dir = f"{output_dir.rstrip('/')}.{os.getpid()}.tmp"
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    class LastHiddenState(torch.nn.Module):
+        def __init__(self, auto_model):
+            super().__init__()
+            self.auto_model = auto_model
+
+        def forward(self, input_ids, attention_mask):
+            return self.auto_model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+    timings = {}
+    start = time.perf_counter()
+    sample = transformer.tokenizer(["contoh kalimat"], return_tensors="pt")
+    axes = {0: "batch", 1: "sequence"}
+    with torch.no_grad():
+        # models over 2 GB (e5-large) are written with external data next to model.onnx
+        torch.onnx.export(
+            LastHiddenState(transformer.auto_model).eval(),
+            (sample["input_ids"], sample["attention_mask"]),
+            os.path.join(tmp_dir, "model.onnx"),
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={"input_ids": axes, "attention_mask": axes, "last_hidden_state": axes},
+            opset_version=opset,
+        )
+    transformer.tokenizer.save_pretrained(tmp_dir)
+    timings["export"] = time.perf_counter() - start
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        start = time.perf_counter()
+        quantize_dynamic(os.path.join(tmp_dir, "model.onnx"), os.path.join(tmp_dir, "model_int8.onnx"), weight_type=QuantType.QInt8)
+        timings["quantize"] = time.perf_counter() - start
+
+    manifest = {
+        "model": model_name,
+        "pooling": pooling,
+        "normalize": any(type(module).__name__ == "Normalize" for module in model),
+        "max_seq_length": transformer.max_seq_length,
+        "dim": model.get_sentence_embedding_dimension(),
+        "quantized": quantize,
+        "parity": {},
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "build_seconds": timings,
+    }
+    with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    if documents is not None and queries is not None:
+        reference_documents = model.encode(documents, normalize_embeddings=False)
+        reference_queries = model.encode(queries, normalize_embeddings=False)
+        for quantized in [False, True] if quantize else [False]:
+            candidate = OnnxEmbeddings(tmp_dir, quantized)
+            manifest["parity"]["onnx-int8" if quantized else "onnx"] = rank_agreement(reference_documents, reference_queries, candidate.embed_documents(queries))
+        with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(os.path.dirname(os.path.abspath(output_dir)), exist_ok=True)
+    os.rename(tmp_dir, output_dir)
+    return manifest
+
+class OnnxEmbeddings():
+    # drop-in for HuggingFaceEmbeddings on an exported model, embed_documents returns lists of floats
+    def __init__(self, model_dir, quantized=False, threads=None, batch_size=32):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(model_dir, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        if quantized and not self.manifest["quantized"]:
+            raise ValueError(f"{model_dir} has no int8 model, export it with quantize")
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, "model_int8.onnx" if quantized else "model.onnx"), options, providers=["CPUExecutionProvider"]
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.quantized = quantized
+        self.batch_size = batch_size
+
+        # document embeddings built by the fp32 model stay usable unless the int8 model failed its parity check
+        parity = self.manifest["parity"].get("onnx-int8", {})
+        compatible = not quantized or parity.get("top10_agreement", 0.0) >= INT8_MIN_AGREEMENT
+        self.space = self.manifest["model"] if compatible else f"{self.manifest['model']}@onnx-int8"
+
+    def embed_documents(self, texts):
+        texts = [str(text) for text in texts]
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            encoded = self.tokenizer(
+                texts[start:start + self.batch_size], padding=True, truncation=True,
+                max_length=self.manifest["max_seq_length"], return_tensors="np"
+            )
+            mask = encoded["attention_mask"].astype(np.int64)
+            hidden = self.session.run(None, {"input_ids": encoded["input_ids"].astype(np.int64), "attention_mask": mask})[0]
+            if self.manifest["pooling"] == "cls":
+                pooled = hidden[:, 0]
+            else:
+                pooled = (hidden * mask[:, :, None]).sum(axis=1) / np.clip(mask.sum(axis=1, keepdims=True), 1, None)
+            if self.manifest["normalize"]:
+                pooled = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            vectors.append(pooled.astype(np.float32))
+        return np.concatenate(vectors).tolist() if vectors else []
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+def load_onnx_embeddings(model_name, model_dir=None, quantized=False, threads=None, df=None, columns=None):
+    # exports on first use, with the parity check on catalog texts when df is given
+    model_dir = model_dir or default_onnx_dir(model_name)
+    manifest_path = os.path.join(model_dir, "manifest.json")
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    if not os.path.isfile(manifest_path) or manifest["model"] != model_name or (quantized and not manifest["quantized"]):
+        print(f"exporting {model_name} to onnx in {model_dir}")
+        documents, queries = parity_texts(df, columns) if df is not None else (None, None)
+        export_onnx(model_name, model_dir, quantize=True, documents=documents, queries=queries)
+    return OnnxEmbeddings(model_dir, quantized, threads)
+
+
+if __name__ == "__main__":
+    import pandas as pd
+    from app.chatbot.chatbot_utils import COL_TO_EMBED
+
+    parser = argparse.ArgumentParser(description="export the embedding model to onnx (+ int8) and check rank parity on the catalog")
+    parser.add_argument("--embedding-model", default="intfloat/multilingual-e5-large-instruct")
+    parser.add_argument("--output-dir", default=None)
+    parser.add_argument("--df-path", default="./app/chatbot/scrapping_auto_df.csv")
+    parser.add_argument("--parity-documents", type=int, default=300)
+    parser.add_argument("--parity-queries", type=int, default=100)
+    parser.add_argument("--no-quantize", action="store_true")
+    args = parser.parse_args()
+
+    documents, queries = parity_texts(pd.read_csv(args.df_path), COL_TO_EMBED, args.parity_documents, args.parity_queries)
+    manifest = export_onnx(args.embedding_model, args.output_dir or default_onnx_dir(args.embedding_model), not args.no_quantize, documents, queries)
+    for step, seconds in manifest["build_seconds"].items():
+        print(f"{step}: {seconds:.1f} s")
+    for backend, parity in manifest["parity"].items():
+        print(f"{backend:9}: " + ", ".join(f"{name} {value:.4f}" for name, value in parity.items()))
@@ -0,0 +1,232 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+
+from app.chatbot.fusion import HYBRID_WEIGHTS, rank_descending, top_n_indices, rank_columns, rrf_rank, fuse_rank_df, rrf_score_range
+
+from rapidfuzz import process
+from rapidfuzz.distance import JaroWinkler
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+# the three rankers and their per-fact sub-queries get separate pools,
+# so a ranker never waits on a sub-query queued behind other rankers
+RANKER_POOL = ThreadPoolExecutor(max_workers=12, thread_name_prefix="ranker")
+SUBQUERY_POOL = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="subquery")
+
+def ReciprocalRankFusion(rank_df, k, name, weights):
+    columns, column_weights = rank_columns(rank_df, weights)
+    rank_df[name] = rrf_rank(rank_df[columns].to_numpy(), column_weights, k)
+    return rank_df
+
+def fill_missing_ranks(rank_df, columns):
+    # documents a top-n ranker did not return are ranked just below its last returned document
+    for col in columns:
+        if col in rank_df.columns:
+            rank_df[col] = rank_df[col].fillna(rank_df[col].max() + 1 if rank_df[col].notna().any() else 1)
+    return rank_df
+
+class JaroWinklerRanking():
+    def __init__(self, doc_df, workers=-1, ngram_index=None, max_candidates=200, full_scan=False, top_n=None):
+        self.doc_df = doc_df
+        self.doc_len = len(doc_df)
+        self.top_n = top_n
+        self.workers = workers
+        self.ngram_index = ngram_index
+        self.max_candidates = max_candidates
+        self.full_scan = full_scan
+
+    def score_column(self, query_type, queries):
+        choices = self.doc_df[query_type].to_numpy()
+
+        if self.ngram_index is not None and not self.full_scan:
+            col_index = self.ngram_index.columns[query_type]
+            candidates = self.ngram_index.candidates(query_type, queries, self.max_candidates)
+            # queries sharing no n-gram with the catalog fall back to the full scan
+            if len(candidates) > 0:
+                candidate_scores = process.cdist(queries, col_index["values"][candidates].tolist(), scorer=JaroWinkler.similarity, dtype=np.float64, workers=self.workers)
+                # values outside the shortlist get the lowest shortlisted score, like the fillna(min) of the full ranking
+                value_scores = np.repeat(candidate_scores.min(axis=1, keepdims=True), len(col_index["values"]) + 1, axis=1)
+                value_scores[:, candidates] = candidate_scores
+                value_scores[:, -1] = 0.0
+                return value_scores[:, col_index["value_of_doc"]]
+
+        return process.cdist(queries, choices.tolist(), scorer=JaroWinkler.similarity, dtype=np.float64, workers=self.workers)
+
+    def score(self, query_dict):
+        scores = []
+        for query_type, query in query_dict.items():
+            if query_type in ["Nama Obat", "Manufaktur"]:
+                queries = query if isinstance(query, list) else [query]
+                scores.append(self.score_column(query_type, queries))
+
+        if len(scores) == 0:
+            return np.zeros((0, self.doc_len))
+        return np.vstack(scores)
+
+    def rank(self, query_dict):
+        scores = self.score(query_dict)
+        total = np.zeros(self.doc_len)
+        for row in scores:
+            total += row
+
+        ranks = rank_descending(total / len(query_dict))
+
+        if self.top_n is None:
+            rank_df = pd.DataFrame({"id": np.arange(self.doc_len), "jaro_winkler_rank": ranks})
+        elif len(scores) == 0:
+            rank_df = pd.DataFrame({"id": [], "jaro_winkler_rank": []})
+        else:
+            top = top_n_indices(total, self.top_n)
+            rank_df = pd.DataFrame({"id": top, "jaro_winkler_rank": ranks[top]})
+
+        return rank_df[["id", "jaro_winkler_rank"]]
+
+
+class LexicalRanking():
+    def __init__(self, retrievers, doc_df, top_n=None, executor=None):
+        self.retrievers = retrievers
+        self.doc_df = doc_df
+        self.doc_len = len(doc_df)
+        self.top_n = top_n
+        self.executor = executor
+        self.df = pd.DataFrame({"id": [i for i in range(self.doc_len)] if top_n is None else []}, dtype=int)
+
+    def search(self, query_type, query):
+        doc_ids, _ = self.retrievers.search(query_type, query, self.top_n)
+        return doc_ids
+
+    def rank(self, query_dict):
+        how = "left" if self.top_n is None else "outer"
+        items = []
+        for query_type, query in query_dict.items():
+            if query_type not in ["Nama Obat", "Manufaktur"]:
+                items += [(query_type, f"{query_type}_{i}_rank", item) for i, item in enumerate(query)] if isinstance(query, list) else [(query_type, f"{query_type}_rank", query)]
+
+        # sub-queries are scored concurrently but merged in query order, so the result does not depend on the executor
+        search = lambda item: self.search(item[0], item[2])
+        results = list(self.executor.map(search, items)) if self.executor is not None else [search(item) for item in items]
+        for (_, col_name, _), results_id in zip(items, results):
+            results_rank = [i for i in range(1, len(results_id) + 1)]
+
+            col_df = pd.DataFrame({"id": results_id, col_name: results_rank})
+            col_df["id"] = col_df["id"].astype(int)
+            self.df = pd.merge(left=self.df, right=col_df, how=how, on="id")
+
+        if self.top_n is not None and len(self.df) == 0:
+            return pd.DataFrame({"id": [], "lexical_rank": []})
+
+        # every sub-query counts the same
+        weights = {col_name: 1.0 for _, col_name, _ in items}
+        rank_df = ReciprocalRankFusion(fill_missing_ranks(self.df, weights), 60, "lexical_rank", weights)
+
+        return rank_df[["id", "lexical_rank"]]
+    
+class SemanticRanking():
+    def __init__(self, retriever, doc_df, top_n=None, executor=None):
+        self.retriever = retriever
+        self.doc_df = doc_df
+        self.doc_len = len(doc_df)
+        self.top_n = top_n
+        self.executor = executor
+
+    def search(self, query_dict):
+        facts = []
+        for query_type, query in query_dict.items():
+            if query_type not in ["Nama Obat", "Manufaktur"]:
+                items = query if isinstance(query, list) else [query]
+                facts += [(query_type, item) for item in items]
+
+        if len(facts) == 0:
+            return []
+
+        k = self.doc_len if self.top_n is None else min(self.top_n, self.doc_len)
+        embeddings = self.retriever.embed([item for _, item in facts])
+        results = [None for _ in facts]
+        columns = [(query_type, [i for i, (fact_type, _) in enumerate(facts) if fact_type == query_type]) for query_type in dict.fromkeys(query_type for query_type, _ in facts)]
+        search = lambda column: self.retriever.search(column[0], embeddings[column[1]], k)
+        column_results = self.executor.map(search, columns) if self.executor is not None else map(search, columns)
+        for (_, positions), column_result in zip(columns, column_results):
+            for i, result in zip(positions, column_result):
+                results[i] = result
+
+        return results
+
+    def rank(self, query_dict):
+        # a collection ahead of the served catalog can return doc_ids it does not have
+        results = [(result_ids[result_ids < self.doc_len], result_scores[result_ids < self.doc_len]) for result_ids, result_scores in self.search(query_dict)]
+        results = [result for result in results if len(result[0]) > 0]
+
+        if self.top_n is None:
+            ids = np.arange(self.doc_len)
+        elif len(results) == 0:
+            return pd.DataFrame({"id": [], "semantic_rank": []})
+        else:
+            ids = np.unique(np.concatenate([result_ids for result_ids, _ in results]))
+
+        total = np.zeros(len(ids))
+        for result_ids, result_scores in results:
+            scores = np.full(len(ids), np.nan)
+            scores[np.searchsorted(ids, result_ids)] = result_scores
+            # documents missing from a fact's results get that fact's lowest score
+            total += np.where(np.isnan(scores), np.nanmin(scores), scores)
+
+        rank_df = pd.DataFrame({"id": ids, "semantic_rank": rank_descending(total / len(query_dict))})
+
+        return rank_df[["id", "semantic_rank"]]
+
+def timed_rank(ranker, query_dict):
+    start = time.perf_counter()
+    rank_df = ranker.rank(query_dict)
+    return rank_df, time.perf_counter() - start
+
+def run_rankers(rankers, query_dict, deadline=None, executor=None):
+    # runs {name: ranker} concurrently and keeps the ones finished within deadline seconds,
+    # if none is, the first to finish. Returns the kept rank frames in the order of rankers and a report
+    start = time.perf_counter()
+    if executor is None:
+        results = {name: timed_rank(ranker, query_dict) for name, ranker in rankers.items()}
+        return [results[name][0] for name in rankers], {"timings": {name: results[name][1] for name in rankers}, "dropped": [], "seconds": time.perf_counter() - start}
+
+    futures = {name: executor.submit(timed_rank, ranker, query_dict) for name, ranker in rankers.items()}
+    done, _ = wait(futures.values(), timeout=deadline)
+    if len(done) == 0:
+        done, _ = wait(futures.values(), return_when=FIRST_COMPLETED)
+
+    # a dropped ranker keeps running on its thread, its result is discarded
+    kept = [name for name in rankers if futures[name] in done]
+    dropped = [name for name in rankers if futures[name] not in done]
+    results = {name: futures[name].result() for name in kept}
+    report = {
+        "timings": {name: results[name][1] if name in results else None for name in rankers},
+        "dropped": dropped,
+        "seconds": time.perf_counter() - start,
+    }
+    return [results[name][0] for name in kept], report
+
+def hybrid_rank(df, lexical_retrievers, semantic_retriever, fact_provided, k, ngram_index=None, full_scan=False, top_n=None, parallel=True, deadline=None):
+    # returns the row ids of the k best fused documents, their fused scores and the ranker report
+    # (per-ranker seconds and the rankers dropped by the deadline)
+    subquery_pool = SUBQUERY_POOL if parallel else None
+    rankers = {
+        "lexical_rank": LexicalRanking(lexical_retrievers, df, top_n=top_n, executor=subquery_pool),
+        "semantic_rank": SemanticRanking(semantic_retriever, df, top_n=top_n, executor=subquery_pool),
+        "jaro_winkler_rank": JaroWinklerRanking(df, ngram_index=ngram_index, full_scan=full_scan, top_n=top_n),
+    }
+    rank_dfs, report = run_rankers(rankers, fact_provided, deadline, RANKER_POOL if parallel else None)
+
+    # top-n rankers only return their own candidates, so fuse over the union of them
+    how = "inner" if top_n is None else "outer"
+    hybird_rank = rank_dfs[0].copy()
+    for rank_df in rank_dfs[1:]:
+        hybird_rank = pd.merge(left=hybird_rank, right=rank_df, how=how, on="id")
+    hybird_rank = fill_missing_ranks(hybird_rank, HYBRID_WEIGHTS)
+    tombstones = df.attrs.get("tombstones")
+    if tombstones is not None and len(tombstones) > 0:
+        # rows removed from the catalog keep their doc_id but are never returned
+        hybird_rank = hybird_rank[~hybird_rank["id"].isin(tombstones)]
+    top_ids, scores = fuse_rank_df(hybird_rank, k, HYBRID_WEIGHTS, 60)
+    columns, column_weights = rank_columns(hybird_rank, HYBRID_WEIGHTS)
+    report["score_range"] = rrf_score_range(hybird_rank[columns].to_numpy(), column_weights, 60)
+    return top_ids, scores, report
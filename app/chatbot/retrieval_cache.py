@@ -0,0 +1,94 @@
+import json
+import threading
+import numpy as np
+
+from datetime import datetime
+from collections import OrderedDict
+
+
+def canonical_facts(fact_provided):
+    # fact order does not change the fusion, the fact strings themselves are kept verbatim
+    # since fuzzy matching and BM25 are case and spacing sensitive
+    return json.dumps(fact_provided, sort_keys=True, ensure_ascii=False)
+
+class RetrievalCache():
+    # fused row ids, scores and score range of hybrid_rank per (catalog, fact_provided, k, top_n),
+    # optionally shared between worker processes through a mongo collection
+    def __init__(self, max_size=4096, collection=None):
+        self.max_size = max_size
+        self.collection = collection
+        self.version = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "shared_hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    @classmethod
+    def with_mongo(cls, mongo_uri, max_size=4096, ttl=86400):
+        from pymongo import MongoClient, ASCENDING
+        collection = MongoClient(mongo_uri)["chatbot_cache"]["retrieval"]
+        collection.create_index([("created_at", ASCENDING)], expireAfterSeconds=ttl)
+        return cls(max_size, collection)
+
+    def key(self, catalog_hash, fact_provided, k, top_n=None, full_scan=False):
+        # the catalog of the config serving the request, a reload can swap the cache version under a running one
+        return f"{catalog_hash}|{k}|{top_n}|{int(full_scan)}|{canonical_facts(fact_provided)}"
+
+    def check_version(self, catalog_hash):
+        with self.lock:
+            if catalog_hash == self.version:
+                return
+            if self.version is not None:
+                self.counters["invalidations"] += len(self.entries)
+            self.entries.clear()
+            self.version = catalog_hash
+        if self.collection is not None:
+            self.collection.delete_many({"catalog_hash": {"$ne": catalog_hash}})
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return self.entries[key]
+
+        if self.collection is not None:
+            document = self.collection.find_one({"_id": key})
+            if document is not None:
+                entry = (np.array(document["ids"], dtype=np.int64), np.array(document["scores"], dtype=np.float64), tuple(document.get("score_range") or ()) or None)
+                with self.lock:
+                    self.counters["shared_hits"] += 1
+                    self._put(key, entry)
+                return entry
+
+        with self.lock:
+            self.counters["misses"] += 1
+        return None
+
+    def put(self, key, top_ids, scores, score_range=None):
+        entry = (np.asarray(top_ids, dtype=np.int64), np.asarray(scores, dtype=np.float64), score_range)
+        with self.lock:
+            self._put(key, entry)
+        if self.collection is not None:
+            self.collection.replace_one(
+                {"_id": key},
+                {"_id": key, "catalog_hash": key.split("|", 1)[0], "ids": entry[0].tolist(), "scores": entry[1].tolist(), "score_range": list(score_range) if score_range is not None else None, "created_at": datetime.utcnow()},
+                upsert=True,
+            )
+
+    def _put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counters["hits"] + self.counters["shared_hits"] + self.counters["misses"]
+            return {
+                **self.counters,
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "shared": self.collection is not None,
+                "hit_rate": (self.counters["hits"] + self.counters["shared_hits"]) / lookups if lookups else 0.0,
+            }
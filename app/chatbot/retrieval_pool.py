@@ -0,0 +1,139 @@
+import os
+import time
+import asyncio
+import threading
+import multiprocessing
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from app.chatbot.artifacts import bundle_version, load_catalog, load_manifest
+from app.chatbot.fuzzy_index import NgramIndex
+from app.chatbot.bm25_index import BM25Index
+from app.chatbot.semantic_index import MatrixSemanticIndex
+
+
+# per-process state of a retrieval worker, set once by init_worker
+_worker = {}
+
+class PrecomputedEmbeddings():
+    # the embedding model stays in the parent process, workers only receive the vectors of a job
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def embed_documents(self, texts):
+        return [self.vectors[text] for text in texts]
+
+def fact_texts(fact_provided):
+    # the strings SemanticRanking embeds for a request
+    texts = []
+    for query_type, query in fact_provided.items():
+        if query_type not in ["Nama Obat", "Manufaktur"]:
+            texts += query if isinstance(query, list) else [query]
+    return list(dict.fromkeys(texts))
+
+def init_worker(bundle_path):
+    from app.chatbot.ranking import hybrid_rank
+
+    # only the name columns are materialised per process, BM25 postings and embedding matrices are
+    # memory-mapped from the bundle so every worker reads the same page cache
+    _worker["df"] = load_catalog(os.path.join(bundle_path, "catalog"), columns=["Nama Obat", "Manufaktur"])
+    _worker["ngram_index"] = NgramIndex.load(os.path.join(bundle_path, "ngram.npz"))
+    _worker["lexical_retrievers"] = BM25Index.load(os.path.join(bundle_path, "bm25"), mmap=True)
+    _worker["semantic_retriever"] = MatrixSemanticIndex(os.path.join(bundle_path, "embeddings"), None, mmap=True)
+    _worker["hybrid_rank"] = hybrid_rank
+
+def run_job(fact_provided, k, top_n, vectors, deadline=None, full_scan=False):
+    start = time.perf_counter()
+    semantic_retriever = _worker["semantic_retriever"]
+    semantic_retriever.embed_model = PrecomputedEmbeddings(vectors)
+    top_ids, scores, report = _worker["hybrid_rank"](
+        _worker["df"], _worker["lexical_retrievers"], semantic_retriever, fact_provided, k,
+        ngram_index=_worker["ngram_index"], full_scan=full_scan, top_n=top_n, deadline=deadline
+    )
+    return top_ids, scores, report, time.perf_counter() - start
+
+class RetrievalPool():
+    def __init__(self, bundle_path, embed=None, workers=None, history=1000):
+        self.bundle_path = bundle_path
+        self.embed = embed
+        self.workers = workers or os.cpu_count()
+        # spawn rather than fork, the parent holds torch and background threads
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(bundle_path,)
+        )
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.counters = {"jobs": 0, "failed": 0, "max_queue_depth": 0}
+        self.latencies = deque(maxlen=history)
+        self.run_times = deque(maxlen=history)
+
+    @classmethod
+    def from_artifacts(cls, artifact_dir, source_hash, embed=None, workers=None, embedding_space=None):
+        # pool mode needs a bundle with embeddings for this catalog (of the query model's space when given),
+        # None lets the caller fall back to threads
+        manifest = load_manifest(artifact_dir, source_hash)
+        if manifest is None or manifest["embedding_model"] is None:
+            return None
+        if embedding_space is not None and manifest["embedding_model"] != embedding_space:
+            return None
+        return cls(os.path.join(artifact_dir, bundle_version(source_hash)), embed, workers)
+
+    def warm_up(self):
+        # starts every worker so the first requests do not pay for loading the bundle
+        list(self.executor.map(time.sleep, [0.1] * self.workers))
+
+    def vectors(self, fact_provided):
+        texts = fact_texts(fact_provided)
+        if len(texts) == 0:
+            return {}
+        return dict(zip(texts, np.asarray(self.embed(texts), dtype=np.float32)))
+
+    def submit(self, fact_provided, k, top_n=None, vectors=None, deadline=None, full_scan=False):
+        vectors = self.vectors(fact_provided) if vectors is None else vectors
+        start = time.perf_counter()
+        with self.lock:
+            self.in_flight += 1
+            self.counters["max_queue_depth"] = max(self.counters["max_queue_depth"], self.in_flight)
+        future = self.executor.submit(run_job, fact_provided, k, top_n, vectors, deadline, full_scan)
+
+        def done(future):
+            with self.lock:
+                self.in_flight -= 1
+                self.counters["jobs"] += 1
+                if future.exception() is not None:
+                    self.counters["failed"] += 1
+                    return
+                self.latencies.append(time.perf_counter() - start)
+                self.run_times.append(future.result()[3])
+        future.add_done_callback(done)
+        return future
+
+    async def retrieve(self, fact_provided, k, top_n=None, deadline=None, full_scan=False):
+        loop = asyncio.get_running_loop()
+        # query embedding stays in the parent (and its cache), off the event loop
+        vectors = await loop.run_in_executor(None, self.vectors, fact_provided)
+        top_ids, scores, report, _ = await asyncio.wrap_future(self.submit(fact_provided, k, top_n, vectors, deadline, full_scan))
+        return top_ids, scores, report
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            run_times = np.array(self.run_times)
+            return {
+                **self.counters,
+                "workers": self.workers,
+                "queue_depth": self.in_flight,
+                "latency_p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "latency_p95": float(np.percentile(latencies, 95)) if len(latencies) else None,
+                # time spent ranking inside a worker, the rest of the latency is queueing and transfer
+                "run_time_mean": float(run_times.mean()) if len(run_times) else None,
+            }
+
+    def shutdown(self, wait=False):
+        # wait lets the queued jobs finish, as when a reload retires the pool of the old catalog
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
@@ -0,0 +1,323 @@
+import os
+import json
+import time
+import argparse
+import threading
+import regex as re
+import pandas as pd
+
+from html.parser import HTMLParser
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+PRODUCT_URL = "https://www.halodoc.com/obat-dan-vitamin/{}"
+CATEGORY_URL = "https://www.halodoc.com/obat-dan-vitamin/kategori/obat-dan-perawatan"
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0"
+
+def product_link(drug_name):
+    slug = re.sub(r"&", "dan", drug_name.lower())
+    slug = re.sub(r"((?<=-)-|^-|-$)", "", re.sub(r"[^A-Za-z0-9]", "-", slug))
+    return PRODUCT_URL.format(slug)
+
+def link_slug(link):
+    return os.path.basename(urlparse(link).path.rstrip("/"))
+
+class ProductPageParser(HTMLParser):
+    # the fields get_feature reads with selenium: div.property boxes holding a div.drug-list label and
+    # a div.drug-detail value, img.product-image and the div.hd-banner-p404 of a missing product
+    BLOCK_TAGS = ["p", "li", "br", "div", "ul", "ol", "tr"]
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.depth = 0
+        self.property_depth = None
+        self.field = None
+        self.label = None
+        self.parts = []
+        self.features = {}
+        self.image = None
+        self.not_found = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        css_class = attrs.get("class") or ""
+        if tag == "img" and css_class == "product-image" and self.image is None:
+            self.image = attrs.get("src")
+        if self.field is not None and tag in self.BLOCK_TAGS:
+            self.parts.append("\n")
+        if tag != "div":
+            return
+        self.depth += 1
+        if "hd-banner-p404" in css_class:
+            self.not_found = True
+        if css_class == "property":
+            self.property_depth, self.label = self.depth, None
+        elif self.property_depth is not None and self.field is None and css_class in ["drug-list", "drug-detail"]:
+            self.field, self.parts = (css_class, self.depth), []
+
+    def handle_endtag(self, tag):
+        if tag != "div":
+            return
+        if self.field is not None and self.field[1] == self.depth:
+            # whitespace collapsed per line, the way WebElement.text renders a block
+            lines = [" ".join(line.split()) for line in "".join(self.parts).split("\n")]
+            text = "\n".join(line for line in lines if line)
+            if self.field[0] == "drug-list":
+                self.label = text
+            elif self.label is not None:
+                self.features[self.label] = text
+            self.field = None
+        if self.property_depth == self.depth:
+            self.property_depth = None
+        self.depth -= 1
+
+    def handle_data(self, data):
+        if self.field is not None:
+            self.parts.append(data)
+
+def parse_product_page(html, feature_names):
+    # the values get_feature returns: the image first, then every other feature, "No Info" when missing
+    parser = ProductPageParser()
+    parser.feed(html)
+    parser.close()
+    if parser.not_found:
+        return "not_found", {}
+    values = {"Link Gambar": parser.image or "No Info"}
+    for feature_name in feature_names:
+        if feature_name != "Link Gambar":
+            values[feature_name] = parser.features.get(feature_name, "No Info")
+    # a 200 page without any product field is rendered client-side, only a browser can read it
+    status = "found" if parser.features or parser.image else "empty"
+    return status, values
+
+class RateLimiter():
+    # spaces request starts at least 1 / rate seconds apart across all fetch threads, rate 0 disables it
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        if self.interval == 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+    def pause(self, seconds):
+        # a 429 pushes every thread back, not only the one that got it
+        with self.lock:
+            self.next_time = max(self.next_time, time.monotonic() + seconds)
+
+class HttpFetcher():
+    def __init__(self, timeout=15, save_dir=None):
+        self.timeout = timeout
+        self.save_dir = save_dir
+        self.local = threading.local()
+        if save_dir:
+            os.makedirs(save_dir, exist_ok=True)
+
+    def fetch(self, link):
+        import requests
+        # one keep-alive session per fetch thread
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+            session.headers["User-Agent"] = USER_AGENT
+        response = session.get(link, timeout=self.timeout)
+        if self.save_dir and response.status_code in [200, 404]:
+            # saved pages are fixtures for --fixtures-dir
+            with open(os.path.join(self.save_dir, f"{link_slug(link)}.html"), "w", encoding="utf-8") as f:
+                f.write(response.text)
+        return response.status_code, response.text, response.headers.get("Retry-After")
+
+class FixtureFetcher():
+    # serves {slug}.html from a directory of saved pages, a missing file is a 404
+    def __init__(self, fixtures_dir):
+        self.fixtures_dir = fixtures_dir
+
+    def fetch(self, link):
+        path = os.path.join(self.fixtures_dir, f"{link_slug(link)}.html")
+        if not os.path.isfile(path):
+            return 404, "", None
+        with open(path, encoding="utf-8") as f:
+            return 200, f.read(), None
+
+class Checkpoint():
+    # one json line per finished page, appended as soon as it is parsed so an interrupted run loses
+    # at most the pages in flight. A torn last line is ignored on resume
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = {}
+        if os.path.isfile(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.records[record["link"]] = record
+        self.file = open(path, "a", encoding="utf-8")
+
+    def add(self, record):
+        with self.lock:
+            self.records[record["link"]] = record
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def scrape_page(fetcher, rate_limiter, link, feature_names, retries=3, backoff=2.0):
+    for attempt in range(retries + 1):
+        rate_limiter.wait()
+        try:
+            status_code, html, retry_after = fetcher.fetch(link)
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+            continue
+        if status_code == 404:
+            return "not_found", {}, attempt
+        if status_code == 200:
+            status, values = parse_product_page(html, feature_names)
+            return status, values, attempt
+        if attempt == retries:
+            raise RuntimeError(f"{link} returned {status_code}")
+        # 429 and 5xx back off, honouring Retry-After when the server sends seconds
+        delay = float(retry_after) if retry_after and retry_after.isdigit() else backoff * 2 ** attempt
+        if status_code == 429:
+            rate_limiter.pause(delay)
+        time.sleep(delay)
+
+def scrape_pages(links, feature_names, fetcher, checkpoint, workers=8, rate=2.0, retries=3, report_every=50):
+    # fetches and parses every link not in the checkpoint yet (or only fetched empty), returns the run stats
+    pending = [link for link in dict.fromkeys(links) if checkpoint.records.get(link, {}).get("status") in [None, "empty"]]
+    rate_limiter = RateLimiter(rate)
+    stats = {"pages": len(pending), "skipped": len(links) - len(pending), "found": 0, "not_found": 0, "empty": 0, "failed": 0, "retries": 0}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scraper") as executor:
+        futures = {executor.submit(scrape_page, fetcher, rate_limiter, link, feature_names, retries): link for link in pending}
+        for done, future in enumerate(as_completed(futures), 1):
+            link = futures[future]
+            try:
+                status, values, attempts = future.result()
+            except Exception as e:
+                # failed pages stay out of the checkpoint and are fetched again by the next run
+                stats["failed"] += 1
+                print(f"failed {link}: {e!r}")
+            else:
+                stats[status] += 1
+                stats["retries"] += attempts
+                checkpoint.add({"link": link, "status": status, "values": values})
+            if done % report_every == 0:
+                elapsed = time.perf_counter() - start
+                print(f"{done}/{len(pending)} pages, {done / elapsed:.2f} pages/s")
+    stats["seconds"] = time.perf_counter() - start
+    stats["pages_per_second"] = len(pending) / stats["seconds"] if stats["seconds"] > 0 else None
+    return stats
+
+def browser_fallback(checkpoint, feature_names):
+    # pages whose fields are rendered client-side go through selenium, one at a time as before
+    from selenium import webdriver
+    from app.chatbot.scrapping_auto import check_link, get_feature
+
+    links = [link for link, record in checkpoint.records.items() if record["status"] == "empty"]
+    if len(links) == 0:
+        return
+    options = webdriver.FirefoxOptions()
+    options.add_argument('--headless')
+    driver = webdriver.Firefox(options=options)
+    try:
+        for link in links:
+            if check_link(link, driver) == -1:
+                checkpoint.add({"link": link, "status": "not_found", "values": {}})
+            else:
+                values = dict(zip(feature_names, get_feature(driver, feature_names)))
+                checkpoint.add({"link": link, "status": "browser", "values": values})
+    finally:
+        driver.close()
+
+def merge_results(old_df, drug_names, feature_names, records):
+    # rows of the old catalog are updated in place (by link), new drugs are appended; Check is 1 for a
+    # scraped page, -1 for a missing product and 0 for a page still to fetch, as scrapping_auto writes it.
+    # An empty page the browser fallback did not read stays 0, so the next run fetches it again
+    df = old_df.copy()
+    position = {link: i for i, link in zip(df.index, df["Link Obat"].to_list())}
+    new_rows, added = [], set()
+    for drug_name in drug_names:
+        link = product_link(drug_name)
+        record = records.get(link)
+        status = None if record is None else record["status"]
+        check = {"found": 1, "browser": 1, "not_found": -1}.get(status, 0)
+        values = record["values"] if check == 1 else {}
+        row = {"Nama Obat": drug_name, "Link Obat": link, "Check": check}
+        row.update({feature: values.get(feature, "No Info") for feature in feature_names})
+        if link in position:
+            if record is not None:
+                df.loc[position[link], list(row.keys())] = list(row.values())
+        elif link not in added:
+            # two names with the same slug are the same product page
+            new_rows.append(row)
+            added.add(link)
+    return pd.concat([df, pd.DataFrame(new_rows, columns=df.columns)]).reset_index(drop=True)
+
+def load_drug_names(names_path):
+    if names_path.endswith(".csv"):
+        return pd.read_csv(names_path)["Nama Obat"].dropna().to_list()
+    with open(names_path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fetch the product pages of new (or unfinished) drugs concurrently over plain HTTP, resumable from a checkpoint")
+    parser.add_argument("--old-path", default="./app/chatbot/scrapping_auto_df.csv")
+    parser.add_argument("--output-path", default=None, help="defaults to --old-path")
+    parser.add_argument("--names-path", default=None, help="drug names, one per line or a csv with Nama Obat; listed from the category page with selenium when missing")
+    parser.add_argument("--checkpoint-path", default="./app/chatbot/scrape_checkpoint.jsonl")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=2.0, help="requests per second across all workers, 0 for no limit")
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--fixtures-dir", default=None, help="read pages from saved {slug}.html files instead of the site, e.g. app/chatbot/scraper_fixtures with its names.txt")
+    parser.add_argument("--save-html", default=None, help="save fetched pages here, usable as --fixtures-dir later")
+    parser.add_argument("--browser-fallback", action="store_true", help="read client-side rendered pages with selenium")
+    args = parser.parse_args()
+
+    old_df = pd.read_csv(args.old_path)
+    feature_names = old_df.drop(columns=["Nama Obat", "Link Obat", "Check"]).columns.to_list()
+    if args.names_path:
+        drug_names = load_drug_names(args.names_path)
+    else:
+        from app.chatbot.scrapping_auto import list_drug_names
+        drug_names = list_drug_names(CATEGORY_URL)
+
+    # drugs the catalog does not have yet plus rows a previous run left unfinished
+    known = set(old_df.loc[old_df["Check"] != 0, "Nama Obat"].to_list())
+    drug_names = [drug_name for drug_name in dict.fromkeys(drug_names + old_df.loc[old_df["Check"] == 0, "Nama Obat"].to_list()) if drug_name not in known]
+    print(f"{len(drug_names)} drugs to scrape")
+
+    checkpoint = Checkpoint(args.checkpoint_path)
+    fetcher = FixtureFetcher(args.fixtures_dir) if args.fixtures_dir else HttpFetcher(save_dir=args.save_html)
+    stats = scrape_pages([product_link(drug_name) for drug_name in drug_names], feature_names, fetcher, checkpoint, args.workers, args.rate, args.retries)
+    if args.browser_fallback:
+        browser_fallback(checkpoint, feature_names)
+    checkpoint.close()
+
+    output_path = args.output_path or args.old_path
+    new_df = merge_results(old_df, drug_names, feature_names, checkpoint.records)
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    new_df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, output_path)
+    if stats["failed"] == 0:
+        os.remove(args.checkpoint_path)
+
+    print(", ".join(f"{name} {value}" for name, value in stats.items() if name not in ["seconds", "pages_per_second"]))
+    if stats["pages_per_second"] is not None:
+        print(f"{stats['pages']} pages in {stats['seconds']:.1f} s, {stats['pages_per_second']:.2f} pages/s")
+    print(f"wrote {len(new_df)} rows to {output_path}, update the index with python -m app.chatbot.update_index")
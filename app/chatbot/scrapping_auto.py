@@ -1,4 +1,5 @@
 from app.chatbot.chatbot_utils import CreateRetriever
+from app.chatbot.scraper import product_link
 
 from selenium import webdriver
 from selenium.webdriver.common.by import By
@@ -49,9 +50,7 @@ def get_feature(driver, feature_names):
     return feature_values
 
 def create_new_drug_df(drug_names, features, old_drug_df, driver):
-    drug_links = [re.sub(r"&", "dan", drug_name.lower()) for drug_name in drug_names]
-    drug_links = [re.sub(r"((?<=-)-|^-|-$)", "", re.sub(r"[^A-Za-z0-9]", "-", drug_link.lower())) for drug_link in drug_links]
-    drug_links = [f"https://www.halodoc.com/obat-dan-vitamin/{drug_link}" for drug_link in drug_links]
+    drug_links = [product_link(drug_name) for drug_name in drug_names]
 
     df = {"Nama Obat": drug_names,
           "Link Obat": drug_links,
@@ -86,12 +85,11 @@ def create_new_drug_df(drug_names, features, old_drug_df, driver):
 
     return new_df
 
-if __name__ == "__main__":
-
-    scrapping_df = pd.read_csv("scrapping_obat_final.csv")
-    all_drugs = scrapping_df["Nama Obat"].to_list()
-
-    link = "https://www.halodoc.com/obat-dan-vitamin/kategori/obat-dan-perawatan"
+def list_drug_names(link, options=None):
+    # the category page paginates client-side, so the listing needs the browser
+    if options is None:
+        options = webdriver.FirefoxOptions()
+        options.add_argument('--headless')
 
     button_xpath = "//button[@class='custom-container__pagination--btn']"
     drug_name_xpath = "//p[@class='hd-base-product-search-card__title']"
@@ -102,9 +100,6 @@ if __name__ == "__main__":
 
     button_exist = True
 
-    options = webdriver.FirefoxOptions()
-    options.add_argument('--headless')
-
     driver = webdriver.Firefox(options=options)
     driver.get(link)
 
@@ -133,6 +128,20 @@ if __name__ == "__main__":
             button_exist = False
 
     driver.close()
+
+    return drug_names
+
+if __name__ == "__main__":
+
+    scrapping_df = pd.read_csv("scrapping_obat_final.csv")
+    all_drugs = scrapping_df["Nama Obat"].to_list()
+
+    link = "https://www.halodoc.com/obat-dan-vitamin/kategori/obat-dan-perawatan"
+
+    options = webdriver.FirefoxOptions()
+    options.add_argument('--headless')
+
+    drug_names = list_drug_names(link, options)
     driver = webdriver.Firefox(options=options)
 
     new_drugs = [drug_name for drug_name in drug_names if drug_name not in all_drugs]
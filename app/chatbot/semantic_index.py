@@ -0,0 +1,147 @@
+import os
+import json
+import math
+import shutil
+import numpy as np
+
+from app.chatbot.fusion import top_n_indices
+
+
+class ChromaSemanticIndex():
+    def __init__(self, vector_db, embed_model):
+        self.vector_db = vector_db
+        self.embed_model = embed_model
+        # same distance -> relevance mapping similarity_search_with_relevance_scores applies
+        self.relevance_score_fn = vector_db._select_relevance_score_fn()
+
+    def embed(self, texts):
+        # one batched forward pass for every fact string of a request
+        return np.asarray(self.embed_model.embed_documents(list(texts)))
+
+    def search(self, column, query_embeddings, k):
+        # one collection query for every fact filtered on the same column
+        results = self.vector_db._collection.query(
+            query_embeddings=np.asarray(query_embeddings).tolist(),
+            n_results=k,
+            where={"column": column},
+            include=["metadatas", "distances"],
+        )
+        return [
+            (np.array([int(metadata["doc_id"]) for metadata in metadatas], dtype=np.int64),
+             np.array([self.relevance_score_fn(distance) for distance in distances], dtype=np.float64))
+            for metadatas, distances in zip(results["metadatas"], results["distances"])
+        ]
+
+class MatrixSemanticIndex():
+    def __init__(self, matrix_path, embed_model, mmap=True, chunk_size=4096):
+        self.matrix_path = matrix_path
+        self.embed_model = embed_model
+        self.chunk_size = chunk_size
+
+        with open(os.path.join(matrix_path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+
+        # memory-mapped so every worker process shares the same page cache
+        mmap_mode = "r" if mmap else None
+        self.columns = {}
+        for i, col in enumerate(self.manifest["columns"]):
+            self.columns[col] = {
+                "embeddings": np.load(os.path.join(matrix_path, f"embeddings_{i}.npy"), mmap_mode=mmap_mode),
+                "sq_norms": np.load(os.path.join(matrix_path, f"sq_norms_{i}.npy")),
+                "scales": np.load(os.path.join(matrix_path, f"scales_{i}.npy")) if self.manifest["dtype"] == "int8" else None,
+            }
+
+    def embed(self, texts):
+        return np.asarray(self.embed_model.embed_documents(list(texts)))
+
+    def dot(self, column, query_embeddings):
+        col_index = self.columns[column]
+        embeddings = col_index["embeddings"]
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+
+        if embeddings.dtype == np.float32:
+            dots = embeddings @ query_embeddings.T
+        else:
+            # float16/int8 have no BLAS path, upcast a chunk of rows at a time
+            dots = np.empty((len(embeddings), len(query_embeddings)), dtype=np.float32)
+            for start in range(0, len(embeddings), self.chunk_size):
+                dots[start:start + self.chunk_size] = embeddings[start:start + self.chunk_size].astype(np.float32) @ query_embeddings.T
+
+        if col_index["scales"] is not None:
+            dots *= col_index["scales"][:, None]
+        return dots
+
+    def search(self, column, query_embeddings, k):
+        dots = self.dot(column, query_embeddings).astype(np.float64)
+        query_sq_norms = (np.asarray(query_embeddings, dtype=np.float64) ** 2).sum(axis=1)
+        results = []
+        for i in range(dots.shape[1]):
+            # squared l2 distance and relevance exactly as Chroma's l2 space reports them
+            distances = query_sq_norms[i] - 2 * dots[:, i] + self.columns[column]["sq_norms"]
+            relevance = 1.0 - distances / math.sqrt(2)
+            top = top_n_indices(relevance, k)
+            results.append((top.astype(np.int64), relevance[top]))
+        return results
+
+def save_matrix_index(matrix_path, column_embeddings, dtype="float32", model_name=""):
+    # column_embeddings: {col: float array of shape (documents, dim) ordered by doc_id}
+    # written to a temporary directory first so a concurrently booting worker never loads half an index
+    tmp_path = f"{matrix_path.rstrip('/')}.{os.getpid()}.tmp"
+    os.makedirs(tmp_path, exist_ok=True)
+    for i, (col, embeddings) in enumerate(column_embeddings.items()):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        np.save(os.path.join(tmp_path, f"sq_norms_{i}.npy"), (embeddings.astype(np.float64) ** 2).sum(axis=1))
+        if dtype == "int8":
+            scales = np.abs(embeddings).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            np.save(os.path.join(tmp_path, f"scales_{i}.npy"), scales.astype(np.float32))
+            embeddings = np.round(embeddings / scales[:, None]).astype(np.int8)
+        np.save(os.path.join(tmp_path, f"embeddings_{i}.npy"), embeddings.astype(dtype))
+
+    with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+        json.dump({"columns": list(column_embeddings.keys()), "dtype": dtype, "model": model_name}, f)
+
+    if os.path.isdir(matrix_path):
+        shutil.rmtree(tmp_path)
+    else:
+        os.rename(tmp_path, matrix_path)
+
+def load_matrix_embeddings(matrix_path):
+    # {col: float32 array} of a saved matrix index, int8 rows are scaled back
+    index = MatrixSemanticIndex(matrix_path, None, mmap=False)
+    column_embeddings = {}
+    for col, col_index in index.columns.items():
+        embeddings = col_index["embeddings"].astype(np.float32)
+        if col_index["scales"] is not None:
+            embeddings *= col_index["scales"][:, None]
+        column_embeddings[col] = embeddings
+    return column_embeddings, index.manifest
+
+def export_chroma_embeddings(vector_db, df, columns, embed_documents=None):
+    # rows the collection does not hold, or holds with another text (a collection built from an older csv),
+    # are embedded with embed_documents instead of exported, without it they are refused
+    column_embeddings = {}
+    for col in columns:
+        texts = [str(text) for text in df[col].to_list()]
+        results = vector_db._collection.get(where={"column": col}, include=["embeddings", "metadatas", "documents"])
+        embeddings = None
+        exported = np.zeros(len(texts), dtype=bool)
+        for embedding, metadata, document in zip(results["embeddings"], results["metadatas"], results["documents"]):
+            doc_id = int(metadata["doc_id"])
+            if doc_id < len(texts) and document == texts[doc_id]:
+                if embeddings is None:
+                    embeddings = np.zeros((len(texts), len(embedding)), dtype=np.float32)
+                embeddings[doc_id] = embedding
+                exported[doc_id] = True
+
+        missing = np.flatnonzero(~exported)
+        if len(missing) > 0:
+            if embed_documents is None:
+                raise ValueError(f"Chroma holds {len(texts) - len(missing)} of the {len(texts)} {col} rows of the catalog, rebuild it or pass an embedding model")
+            print(f"  {col}: {len(missing)} rows missing from Chroma, embedded")
+            vectors = np.asarray(embed_documents([texts[i] for i in missing]), dtype=np.float32)
+            if embeddings is None:
+                embeddings = np.zeros((len(texts), vectors.shape[1]), dtype=np.float32)
+            embeddings[missing] = vectors
+        column_embeddings[col] = embeddings
+    return column_embeddings
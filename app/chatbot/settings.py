@@ -0,0 +1,102 @@
+from dataclasses import dataclass, field, asdict
+
+
+@dataclass
+class RetrievalSettings():
+    # the init_retrieval keyword arguments: embedding model, semantic backend, query embedding cache and artifact bundles
+    embedding_model: str = None
+    semantic_backend: str = "chroma"
+    matrix_dtype: str = "float32"
+    embedding_cache_size: int = 4096
+    embedding_cache_path: str = None
+    embedding_batch_size: int = 0
+    embedding_batch_wait: float = 0.005
+    embedding_backend: str = "torch"
+    onnx_dir: str = None
+    onnx_threads: int = None
+    artifact_dir: str = None
+
+    def init_kwargs(self):
+        return asdict(self)
+
+@dataclass
+class RankingSettings():
+    # how a request is ranked: candidates per ranker, the n-gram shortlist, deadline, adaptive k and where it runs
+    top_n: int = None
+    ngram_shortlist: bool = False
+    ranker_deadline: float = None
+    adaptive_k: dict = None
+    workers: int = 4
+    mode: str = "thread"
+
+@dataclass
+class CacheSettings():
+    # a size of 0 disables a cache, answer_similarity enables the near-duplicate lookup, retrieval_uri shares
+    # the retrieval cache through mongo
+    answer_size: int = 1024
+    answer_ttl: int = 3600
+    answer_similarity: float = None
+    retrieval_size: int = 4096
+    retrieval_uri: str = None
+
+@dataclass
+class LLMSettings():
+    checkpoint_uri: str = "mongodb://localhost:27017"
+    graph_mode: str = "classic"
+    fact_parser: str = "structured"
+    fact_retries: int = 2
+    context_budget: int = 1500
+
+@dataclass
+class ChatbotSettings():
+    df_path: str
+    embedding_db_path: str
+    retrieval: RetrievalSettings = field(default_factory=RetrievalSettings)
+    ranking: RankingSettings = field(default_factory=RankingSettings)
+    cache: CacheSettings = field(default_factory=CacheSettings)
+    llm: LLMSettings = field(default_factory=LLMSettings)
+    reload_grace: int = 120
+
+    @classmethod
+    def from_config(cls, df_path, embedding_db_path, embedding_model=None):
+        from app import config
+        return cls(
+            df_path,
+            embedding_db_path,
+            retrieval=RetrievalSettings(
+                embedding_model=embedding_model,
+                semantic_backend=config.SEMANTIC_BACKEND,
+                matrix_dtype=config.SEMANTIC_MATRIX_DTYPE,
+                embedding_cache_size=config.EMBEDDING_CACHE_SIZE,
+                embedding_cache_path=config.EMBEDDING_CACHE_PATH,
+                embedding_batch_size=config.EMBEDDING_BATCH_SIZE,
+                embedding_batch_wait=config.EMBEDDING_BATCH_WAIT,
+                embedding_backend=config.EMBEDDING_BACKEND,
+                onnx_dir=config.ONNX_MODEL_DIR,
+                onnx_threads=config.ONNX_THREADS,
+                artifact_dir=config.ARTIFACT_DIR,
+            ),
+            ranking=RankingSettings(
+                top_n=config.RETRIEVAL_TOP_N,
+                ngram_shortlist=config.NGRAM_SHORTLIST,
+                ranker_deadline=config.RANKER_DEADLINE,
+                adaptive_k=config.ADAPTIVE_K,
+                workers=config.RETRIEVAL_WORKERS,
+                mode=config.RETRIEVAL_MODE,
+            ),
+            cache=CacheSettings(
+                answer_size=config.ANSWER_CACHE_SIZE,
+                answer_ttl=config.ANSWER_CACHE_TTL,
+                answer_similarity=config.ANSWER_CACHE_SIMILARITY,
+                retrieval_size=config.RETRIEVAL_CACHE_SIZE,
+                retrieval_uri=config.RETRIEVAL_CACHE_URI,
+            ),
+            llm=LLMSettings(
+                checkpoint_uri=config.CHECKPOINT_URI,
+                graph_mode=config.GRAPH_MODE,
+                fact_parser=config.FACT_PARSER,
+                fact_retries=config.FACT_RETRIES,
+                context_budget=config.CONTEXT_BUDGET,
+            ),
+            reload_grace=config.CATALOG_RELOAD_GRACE,
+        )
@@ -0,0 +1,256 @@
+from app.chatbot.chatbot_utils import CreateRetriever, embedding_space
+from app.chatbot.checksum import file_hash
+from app.chatbot.artifacts import ARTIFACT_FORMAT, bundle_version, current_version, load_catalog, save_catalog, set_current_version
+from app.chatbot.fuzzy_index import NgramIndex
+from app.chatbot.bm25_index import BM25Index
+from app.chatbot.semantic_index import load_matrix_embeddings, save_matrix_index
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+
+
+# a drug is the same drug across scrapes when its link (or, without a link, its name) is the same
+KEY_COLUMNS = ["Link Obat", "Nama Obat"]
+# scraper bookkeeping, a change there is not a change of the drug
+IGNORED_COLUMNS = ["Check"]
+
+def row_keys(df):
+    keys, seen = [], {}
+    for link, name in zip(df["Link Obat"].to_list(), df["Nama Obat"].to_list()):
+        key = link if isinstance(link, str) and link.strip() else f"name:{name}"
+        # the same link listed twice stays two rows
+        seen[key] = seen.get(key, 0) + 1
+        keys.append(key if seen[key] == 1 else f"{key}#{seen[key] - 1}")
+    return keys
+
+def row_hashes(df):
+    columns = [col for col in df.columns if col not in IGNORED_COLUMNS]
+    return [
+        hashlib.sha1(json.dumps([None if pd.isna(value) else str(value) for value in row], ensure_ascii=False).encode("utf-8")).hexdigest()
+        for row in df[columns].itertuples(index=False)
+    ]
+
+def diff_catalog(indexed, tombstones, new_df):
+    # indexed: the catalog in doc_id order, new_df: the scraped csv. Returns the new catalog in doc_id order
+    # (changed rows in place, added rows appended, removed rows blanked), its tombstones and the diff
+    if set(new_df.columns) != set(indexed.columns):
+        raise ValueError(f"catalog columns changed ({sorted(set(new_df.columns) ^ set(indexed.columns))}), rebuild with python -m app.chatbot.build_index --force")
+    columns = indexed.columns.to_list()
+    doc_id_of = {key: doc_id for doc_id, key in enumerate(row_keys(indexed))}
+    indexed_hashes = row_hashes(indexed)
+    tombstones = set(tombstones)
+
+    added, changed, changed_rows, seen = [], [], [], set()
+    for position, (key, row_hash) in enumerate(zip(row_keys(new_df), row_hashes(new_df[columns]))):
+        doc_id = doc_id_of.get(key)
+        if doc_id is None:
+            added.append(position)
+            continue
+        seen.add(doc_id)
+        # a drug scraped again after its removal gets its old doc_id back
+        if doc_id in tombstones or row_hash != indexed_hashes[doc_id]:
+            changed.append(doc_id)
+            changed_rows.append(position)
+    removed = [doc_id for doc_id in range(len(indexed)) if doc_id not in seen and doc_id not in tombstones]
+
+    catalog = indexed.copy()
+    catalog.attrs = {}
+    if len(changed) > 0:
+        catalog.loc[changed, columns] = new_df.iloc[changed_rows][columns].to_numpy()
+    blank = [col for col in columns if col not in KEY_COLUMNS and not pd.api.types.is_numeric_dtype(catalog[col])]
+    if len(removed) > 0:
+        catalog.loc[removed, blank] = np.nan
+    catalog = pd.concat([catalog, new_df.iloc[added][columns]], ignore_index=True)
+
+    report = {
+        "added": list(range(len(indexed), len(indexed) + len(added))),
+        "changed": changed,
+        "removed": removed,
+        "unchanged": len(seen) - len(changed),
+    }
+    return catalog, sorted((tombstones - set(changed)) | set(removed)), report
+
+def save_array(path, array):
+    tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+def embed_rows(catalog, doc_ids, columns, embed_documents, work_dir, chunk_size):
+    # vectors are written per (column, chunk) so an interrupted job only embeds the chunks it did not finish
+    vectors = {}
+    for i, col in enumerate(columns):
+        chunks = []
+        for start in range(0, len(doc_ids), chunk_size):
+            chunk_path = os.path.join(work_dir, f"embeddings_{i}_{start // chunk_size}.npy")
+            if not os.path.isfile(chunk_path):
+                texts = [str(catalog.at[doc_id, col]) for doc_id in doc_ids[start:start + chunk_size]]
+                save_array(chunk_path, np.asarray(embed_documents(texts), dtype=np.float32))
+                print(f"  {col}: {min(start + chunk_size, len(doc_ids))}/{len(doc_ids)} rows embedded")
+            chunks.append(np.load(chunk_path))
+        vectors[col] = np.concatenate(chunks) if chunks else None
+    return vectors
+
+def update_chroma(base_chroma_path, chroma_path, catalog, doc_ids, removed, vectors, columns, batch_size=1000):
+    # the collection of the base is copied into the new bundle and updated there, workers still serving
+    # the base keep a collection whose doc_ids match their catalog
+    from langchain_chroma import Chroma
+    shutil.copytree(base_chroma_path, chroma_path)
+    collection = Chroma(collection_name="halodoc_embeddings", persist_directory=chroma_path)._collection
+    for col in columns:
+        for start in range(0, len(doc_ids), batch_size):
+            batch = doc_ids[start:start + batch_size]
+            collection.upsert(
+                ids=[f"{doc_id}_{col}" for doc_id in batch],
+                embeddings=vectors[col][start:start + batch_size].tolist(),
+                documents=[str(catalog.at[doc_id, col]) for doc_id in batch],
+                metadatas=[{"doc_id": str(doc_id), "column": col} for doc_id in batch],
+            )
+    if len(removed) > 0:
+        collection.delete(ids=[f"{doc_id}_{col}" for doc_id in removed for col in columns])
+
+def update_index(df_path, artifact_dir, chroma_path=None, embedding_model=None, embedding_backend="torch", chunk_size=256):
+    # builds the bundle of df_path from the current bundle: only added and changed rows are embedded,
+    # removed rows are tombstoned and every other doc_id stays what it was
+    base_version = current_version(artifact_dir)
+    if base_version is None:
+        print("no bundle to update, build one with python -m app.chatbot.build_index")
+        return None
+    source_hash = file_hash(df_path)
+    version = bundle_version(source_hash)
+    bundle_path = os.path.join(artifact_dir, version)
+    if version == base_version:
+        print(f"bundle {version} is up to date")
+        return bundle_path
+    base_path = os.path.join(artifact_dir, base_version)
+    with open(os.path.join(base_path, "manifest.json")) as f:
+        base_manifest = json.load(f)
+    if base_manifest["embedding_model"] is None:
+        # without base vectors the added and changed rows would be served without (or with stale) embeddings
+        raise ValueError(f"bundle {base_version} has no embeddings to update, rebuild with python -m app.chatbot.build_index --force")
+
+    work_dir = os.path.join(artifact_dir, f"update-{version}.work")
+    state_path = os.path.join(work_dir, "state.json")
+    state = {}
+    if os.path.isfile(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+    if state.get("base_version") != base_version:
+        # chunks embedded against another base do not line up with this diff
+        shutil.rmtree(work_dir, ignore_errors=True)
+        state = {"base_version": base_version, "timings": {}}
+    else:
+        print(f"resuming update to {version}")
+    os.makedirs(work_dir, exist_ok=True)
+
+    def finished(step, start):
+        state["timings"][step] = state["timings"].get(step, 0.0) + time.perf_counter() - start
+        with open(state_path, "w") as f:
+            json.dump(state, f)
+
+    start = time.perf_counter()
+    indexed = load_catalog(os.path.join(base_path, "catalog"))
+    new_df = pd.read_csv(df_path)
+    catalog, tombstones, report = diff_catalog(indexed, indexed.attrs.get("tombstones", []), new_df)
+    to_embed = sorted(report["added"] + report["changed"])
+    print(f"{base_version} -> {version}: {len(report['added'])} added, {len(report['changed'])} changed, "
+          f"{len(report['removed'])} removed, {report['unchanged']} unchanged")
+    finished("diff", start)
+
+    col_to_embed = base_manifest["col_to_embed"]
+    embedding_model = embedding_model or base_manifest["embedding_model"]
+    start = time.perf_counter()
+    embed_model = None
+
+    def embed_documents(texts):
+        # the model is only loaded when a chunk is actually missing
+        nonlocal embed_model
+        if embed_model is None:
+            embed_model = CreateRetriever(catalog, col_to_embed, embedding_backend).create_embedding_model(embedding_model)
+            if embedding_space(embed_model, embedding_model) != base_manifest["embedding_model"]:
+                raise ValueError(f"{embedding_backend} vectors of {embedding_model} do not match the bundle embeddings of {base_manifest['embedding_model']}, rebuild with python -m app.chatbot.build_index --force")
+        return embed_model.embed_documents(texts)
+
+    vectors = embed_rows(catalog, to_embed, col_to_embed, embed_documents, work_dir, chunk_size)
+    base_embeddings, matrix_manifest = load_matrix_embeddings(os.path.join(base_path, "embeddings"))
+    column_embeddings = {}
+    for col in col_to_embed:
+        embeddings = np.zeros((len(catalog), base_embeddings[col].shape[1]), dtype=np.float32)
+        embeddings[:len(base_embeddings[col])] = base_embeddings[col]
+        if len(to_embed) > 0:
+            embeddings[to_embed] = vectors[col]
+        embeddings[tombstones] = 0.0
+        column_embeddings[col] = embeddings
+    finished("embed", start)
+
+    start = time.perf_counter()
+    tmp_path = f"{bundle_path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    save_catalog(catalog, os.path.join(tmp_path, "catalog"), tombstones)
+    NgramIndex.build(catalog, ["Nama Obat", "Manufaktur"], source_hash=source_hash).save(os.path.join(tmp_path, "ngram.npz"))
+    BM25Index.build(catalog, col_to_embed, source_hash).save(os.path.join(tmp_path, "bm25"))
+    save_matrix_index(os.path.join(tmp_path, "embeddings"), column_embeddings, base_manifest["matrix_dtype"], matrix_manifest["model"])
+    finished("write", start)
+
+    # a bundle made by update_index carries its own collection, a build_index bundle shares the one at chroma_path
+    base_chroma_path = os.path.join(base_path, "chroma")
+    if not os.path.isdir(base_chroma_path):
+        base_chroma_path = chroma_path
+    if base_chroma_path and os.path.isdir(base_chroma_path):
+        start = time.perf_counter()
+        update_chroma(base_chroma_path, os.path.join(tmp_path, "chroma"), catalog, to_embed, report["removed"], vectors, col_to_embed)
+        finished("chroma", start)
+    else:
+        print(f"no Chroma collection of {base_version} to update, bundle {version} only serves SEMANTIC_BACKEND=matrix")
+
+    manifest = {
+        **base_manifest,
+        "format": ARTIFACT_FORMAT,
+        "version": version,
+        "source_hash": source_hash,
+        "source_path": os.path.abspath(df_path),
+        "rows": len(catalog),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "build_seconds": state["timings"],
+        "update": {
+            "base_version": base_version,
+            "added": len(report["added"]),
+            "changed": len(report["changed"]),
+            "removed": len(report["removed"]),
+            "unchanged": report["unchanged"],
+            "tombstones": len(tombstones),
+        },
+    }
+    with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    shutil.rmtree(bundle_path, ignore_errors=True)
+    os.rename(tmp_path, bundle_path)
+    set_current_version(artifact_dir, version)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return bundle_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="update the current retrieval bundle to a re-scraped catalog csv, embedding only new and changed rows")
+    parser.add_argument("--df-path", default="./app/chatbot/scrapping_auto_df.csv")
+    parser.add_argument("--artifact-dir", default="./app/chatbot/artifacts")
+    parser.add_argument("--embedding-db-path", default="./app/chatbot/halodoc_db", help="Chroma directory of the base bundle, copied into the new bundle and updated there; skipped when missing")
+    parser.add_argument("--embedding-model", default=None, help="defaults to the model of the current bundle")
+    parser.add_argument("--embedding-backend", default="torch", choices=["torch", "onnx", "onnx-int8"])
+    parser.add_argument("--chunk-size", type=int, default=256)
+    args = parser.parse_args()
+
+    bundle_path = update_index(args.df_path, args.artifact_dir, args.embedding_db_path, args.embedding_model, args.embedding_backend, args.chunk_size)
+    if bundle_path is not None:
+        with open(os.path.join(bundle_path, "manifest.json")) as f:
+            manifest = json.load(f)
+        print(f"bundle {manifest['version']} at {bundle_path}")
+        for step, seconds in manifest["build_seconds"].items():
+            print(f"  {step}: {seconds:.2f} s")
@@ -7,3 +7,64 @@ MONGO_URI = os.getenv("MONGO_URI")
 MONGO_DB = os.getenv("MONGO_DB")
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
+# candidates each ranker returns before fusion, 0 ranks the whole catalog. Top-n changes the fused ranking,
+# check its recall on the catalog with python -m app.chatbot.benchmark topk before turning it on
+RETRIEVAL_TOP_N = int(os.getenv("RETRIEVAL_TOP_N", "0")) or None
+# NGRAM_SHORTLIST=1 scores Jaro-Winkler only on the names sharing the most trigrams with the query, 0 scans every name
+NGRAM_SHORTLIST = os.getenv("NGRAM_SHORTLIST", "0") == "1"
+# "chroma" or "matrix" (memory-mapped embedding matrices), matrix dtype float32/float16/int8
+SEMANTIC_BACKEND = os.getenv("SEMANTIC_BACKEND", "chroma")
+SEMANTIC_MATRIX_DTYPE = os.getenv("SEMANTIC_MATRIX_DTYPE", "float32")
+# query embedding LRU cache, persisted to a sqlite file when a path is set
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH")
+# prebuilt retrieval bundles, see python -m app.chatbot.build_index
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", "./app/chatbot/artifacts")
+# langgraph checkpoints, kept on the local mongo unless overridden
+CHECKPOINT_URI = os.getenv("CHECKPOINT_URI", "mongodb://localhost:27017")
+# load the chatbot components in the background at startup, otherwise on the first chat request
+WARMUP = os.getenv("WARMUP", "1") == "1"
+# concurrent hybrid_retrieve calls per worker process, "process" mode runs them in that many
+# processes sharing the memory-mapped artifact bundle instead of threads
+RETRIEVAL_WORKERS = int(os.getenv("RETRIEVAL_WORKERS", "4"))
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "thread")
+# milliseconds the three rankers get before fusion goes ahead without the late ones, 0 waits for all
+RANKER_DEADLINE = int(os.getenv("RANKER_DEADLINE_MS", "0")) / 1000 or None
+# "classic" classifies then extracts facts in two LLM calls, "combined" does both in one JSON-mode call
+GRAPH_MODE = os.getenv("GRAPH_MODE", "classic")
+# generated answers cached per (facts, retrieved rows), 0 disables; a cosine threshold such as 0.95 also
+# serves near-duplicate questions over the same rows
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0")) or None
+# fused row ids per (fact_provided, k), 0 disables; with a mongo uri the cache is shared between workers
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "4096"))
+RETRIEVAL_CACHE_URI = os.getenv("RETRIEVAL_CACHE_URI")
+# "structured" extracts facts with a schema-constrained tool call (retried FACT_RETRIES times), "legacy" parses the reasoning prompt
+FACT_PARSER = os.getenv("FACT_PARSER", "structured")
+FACT_RETRIES = int(os.getenv("FACT_RETRIES", "2"))
+# approximate token budget of the generate prompt context (retrieved rows projected on the desired facts), 0 sends full rows
+CONTEXT_BUDGET = int(os.getenv("CONTEXT_BUDGET", "1500"))
+# ADAPTIVE_K=1 keeps fewer than 10 rows when one candidate clearly leads the fused ranking and up to
+# ADAPTIVE_K_MAX when it is flat, see fusion.adaptive_k for the thresholds
+ADAPTIVE_K = {
+    "min_k": 1,
+    "max_k": int(os.getenv("ADAPTIVE_K_MAX", "20")),
+    "confident": float(os.getenv("ADAPTIVE_K_CONFIDENT", "0.9")),
+    "margin": float(os.getenv("ADAPTIVE_K_MARGIN", "0.01")),
+    "spread": float(os.getenv("ADAPTIVE_K_SPREAD", "0.05")),
+} if os.getenv("ADAPTIVE_K", "0") == "1" else None
+# query embeddings of concurrent requests are batched up to this many texts, waiting at most EMBEDDING_BATCH_WAIT_MS
+# for the batch to fill; 0 or 1 embeds every request on its own
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+EMBEDDING_BATCH_WAIT = float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5")) / 1000
+# "torch", "onnx" or "onnx-int8" query embedding model, see python -m app.chatbot.onnx_embeddings to export ahead of time
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR")
+ONNX_THREADS = int(os.getenv("ONNX_THREADS", "0")) or None
+# seconds between checks of the artifact CURRENT file, a new bundle is loaded and swapped in without a restart; 0 disables
+CATALOG_WATCH_INTERVAL = int(os.getenv("CATALOG_WATCH_INTERVAL", "0"))
+# seconds the worker processes of a swapped-out catalog keep serving requests that started before the swap
+CATALOG_RELOAD_GRACE = int(os.getenv("CATALOG_RELOAD_GRACE", "120"))
+# X-Admin-Token of POST /chat/catalog/reload, the endpoint is disabled when unset
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
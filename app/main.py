@@ -1,8 +1,21 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from app.routes import auth, chatbot_routes
+from app.config import WARMUP, CATALOG_WATCH_INTERVAL
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the server accepts requests right away, /ready reports when the chatbot can answer them
+    if WARMUP:
+        chatbot_routes.components.warm_up_in_background()
+    if CATALOG_WATCH_INTERVAL > 0:
+        chatbot_routes.components.watch_catalog(CATALOG_WATCH_INTERVAL)
+    yield
+    chatbot_routes.components.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -18,3 +31,8 @@ app.include_router(chatbot_routes.router, prefix="/chat", tags=["chat"])
 @app.get("/")
 def root():
     return {"message": "Chatbot backend active!"}
+
+@app.get("/ready")
+def ready():
+    readiness = chatbot_routes.components.readiness()
+    return JSONResponse(readiness, status_code=200 if readiness["ready"] else 503)
@@ -1,18 +1,32 @@
 import pandas as pd
 import os
+import json
 
-from fastapi import APIRouter, HTTPException, Query, Depends
+from fastapi import APIRouter, HTTPException, Query, Depends, Header
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
 from uuid import UUID, uuid4
 from datetime import datetime
 
-from app.chatbot.chatbot import graph, init_components, start_qa, resume_qa
+from app.chatbot.components import Components
+from app.chatbot.settings import ChatbotSettings
 from app.models.chat_model import ChatMessage
 from app.database import db
+from app.config import ADMIN_TOKEN
 from app.utils.security import get_current_user
 
-df, lexical_retrievers, semantic_retriever, query_llm, llm = init_components("./app/chatbot/scrapping_auto_df.csv", "./app/chatbot/halodoc_db", embedding_model="intfloat/multilingual-e5-large-instruct")#./app/chatbot/halodoc_db || intfloat/multilingual-e5-large-instruct
+components = Components(ChatbotSettings.from_config(
+    "./app/chatbot/scrapping_auto_df.csv",
+    "./app/chatbot/halodoc_db",
+    embedding_model="intfloat/multilingual-e5-large-instruct" #./app/chatbot/halodoc_db || intfloat/multilingual-e5-large-instruct
+))
+
+async def get_components():
+    # loads whatever the background warm-up has not finished yet without blocking the event loop
+    await run_in_threadpool(components.load_all)
+    return components
 
 router = APIRouter()
 chat_collection = db["chat_history"]
@@ -24,42 +38,31 @@ class ChatRequest(BaseModel):
 @router.post("/", summary="Tanya ke chatbot")
 async def ask_chatbot(
     req: ChatRequest,
-    user_id: str = Depends(get_current_user)
+    user_id: str = Depends(get_current_user),
+    chatbot: Components = Depends(get_components)
 ):
     try:
+        from app.chatbot.chatbot import start_qa, resume_qa
         if req.threadid:
-            config = {
-                "configurable": {
-                    "thread_id":req.threadid,
-                    "query_llm": query_llm,
-                    "llm": llm,
-                    "df": df,
-                    "lexical_retrievers": lexical_retrievers,
-                    "semantic_retriever": semantic_retriever
-                }
-            }
-
-            result = resume_qa(question=req.query, graph=graph, config=config)
+            config = chatbot.chat_config(req.threadid)
+            result = await resume_qa(question=req.query, graph=chatbot.graph, config=config)
         else:
-            config = {
-                "configurable": {
-                    "thread_id":uuid4(),
-                    "query_llm": query_llm,
-                    "llm": llm,
-                    "df": df,
-                    "lexical_retrievers": lexical_retrievers,
-                    "semantic_retriever": semantic_retriever
-                }
-            }
-
-            result = start_qa(question=req.query, graph=graph, config=config)
+            config = chatbot.chat_config(uuid4())
+            result = await start_qa(question=req.query, graph=chatbot.graph, config=config)
     except Exception:
-        error_log = pd.DataFrame({"state": [req.query], "error": ["backend"]})
-        error_log.to_csv("./app/chatbot/error_log.csv", mode="a", index=False, header=not os.path.exists("./app/chatbot/error_log.csv"))
-        return {
-            "answer": "Maaf kami tidak menemukan obat yang anda maksud"
-        }
+        return backend_error(req)
+
+    return await finish_turn(req, user_id, result, config)
+
+def backend_error(req):
+    error_log = pd.DataFrame({"state": [req.query], "error": ["backend"]})
+    error_log.to_csv("./app/chatbot/error_log.csv", mode="a", index=False, header=not os.path.exists("./app/chatbot/error_log.csv"))
+    return {
+        "answer": "Maaf kami tidak menemukan obat yang anda maksud"
+    }
 
+async def finish_turn(req, user_id, result, config):
+    # stores the turn in the chat history, logs errors and validations and builds the response
     now = datetime.utcnow()
     session_id = f"session-{user_id}"
 
@@ -132,6 +135,104 @@ async def ask_chatbot(
             "answer": result["answer"]
         }
 
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str, ensure_ascii=False)}\n\n"
+
+def progress_event(node, update):
+    # what the client is told about each finished node, documents themselves are not sent
+    event = {"node": node}
+    if node in ["identify_facts", "route", "validate"]:
+        event["fact_provided"] = update.get("fact_provided")
+    if node in ["identify_facts", "route"]:
+        # identify_facts only runs for questions classified as medical, route reports its decision in "next"
+        event["desired_fact"] = update.get("desired_fact")
+    if node == "retrieve":
+        event["documents"] = len(update.get("context", []))
+        event["cached_answer"] = update.get("resume") == "cached"
+        event["ranker_report"] = update.get("ranker_report")
+        event["k_decision"] = update.get("k_decision")
+    if node == "generate":
+        event["context_report"] = update.get("context_report")
+    if "resume" in update:
+        event["next"] = update["resume"]
+    return event
+
+@router.post("/stream", summary="Tanya ke chatbot, jawaban dikirim bertahap (server-sent events)")
+async def ask_chatbot_stream(
+    req: ChatRequest,
+    user_id: str = Depends(get_current_user),
+    chatbot: Components = Depends(get_components)
+):
+    # events: "progress" per finished graph node, "token" per answer chunk of the generate node,
+    # then one "interrupt" (the graph waits for the user, resume with thread_id) or "done" carrying the /chat/ response
+    from app.chatbot.chatbot import stream_qa
+    config = chatbot.chat_config(req.threadid or uuid4())
+
+    async def events():
+        try:
+            async for mode, chunk in stream_qa(req.query, chatbot.graph, config, resume=bool(req.threadid)):
+                if mode == "messages":
+                    message, metadata = chunk
+                    if metadata.get("langgraph_node") == "generate" and message.content:
+                        yield sse("token", {"content": message.content})
+                else:
+                    for node, update in chunk.items():
+                        if node != "__interrupt__" and isinstance(update, dict):
+                            yield sse("progress", progress_event(node, update))
+
+            snapshot = await chatbot.graph.aget_state(config)
+            result = dict(snapshot.values)
+            interrupts = [interrupt for task in snapshot.tasks for interrupt in task.interrupts]
+            if len(interrupts) > 0:
+                result["__interrupt__"] = interrupts
+        except Exception:
+            yield sse("done", backend_error(req))
+            return
+
+        # the history is written once the answer has been streamed
+        response = await finish_turn(req, user_id, result, config)
+        if "__interrupt__" in result and "error_log" not in result:
+            yield sse("interrupt", {**response, "interrupt": result["__interrupt__"][0].value})
+        else:
+            yield sse("done", response)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@router.get("/stats", summary="Statistik cache retrieval")
+async def get_stats(
+    user_id: str = Depends(get_current_user),
+    chatbot: Components = Depends(get_components)
+):
+    from app.chatbot.chatbot import llm_usage
+    return {
+        "embedding_cache": chatbot.retrieval["semantic_retriever"].embed_model.stats(),
+        "embedding_batcher": chatbot.embedding_batcher.stats() if chatbot.embedding_batcher is not None else None,
+        "retrieval_pool": chatbot.retrieval_pool.stats() if chatbot.retrieval_pool is not None else None,
+        "answer_cache": chatbot.answer_cache.stats() if chatbot.answer_cache is not None else None,
+        "retrieval_cache": chatbot.retrieval_cache.stats() if chatbot.retrieval_cache is not None else None,
+        "llm_usage": llm_usage(),
+        "catalog": chatbot.catalog_status()
+    }
+
+@router.get("/catalog", summary="Versi katalog obat yang sedang dipakai")
+async def get_catalog(
+    user_id: str = Depends(get_current_user),
+    chatbot: Components = Depends(get_components)
+):
+    return chatbot.catalog_status()
+
+@router.post("/catalog/reload", summary="Muat ulang katalog dan indeks tanpa restart")
+async def reload_catalog(
+    x_admin_token: Optional[str] = Header(None),
+    chatbot: Components = Depends(get_components)
+):
+    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin token required")
+    try:
+        return await run_in_threadpool(chatbot.reload_retrieval)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
 @router.get("/history", response_model=List[ChatMessage], summary="Ambil riwayat chat berdasarkan session_id")
 async def get_chat_history(
     session_id: str = Query(...),
@@ -0,0 +1,41 @@
+import json
+import pytest
+import asyncio
+
+from types import SimpleNamespace
+
+from app.chatbot.chatbot import FACTS_SCHEMA, parse_fact_arguments, identify_facts_structured, revise_facts_structured
+
+
+class ToolCallLLM():
+    # answers every completion with a record_facts tool call carrying the given arguments
+    def __init__(self, arguments):
+        self.arguments = list(arguments)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **kwargs):
+        tool_call = SimpleNamespace(function=SimpleNamespace(arguments=self.arguments.pop(0)))
+        return SimpleNamespace(usage=None, choices=[SimpleNamespace(message=SimpleNamespace(tool_calls=[tool_call]))])
+
+def test_schema_allows_a_list_of_values():
+    schema = FACTS_SCHEMA["properties"]["fact_provided"]["properties"]["Manufacturer"]
+    assert {"type": "array", "items": {"type": "string"}} in schema["anyOf"]
+
+def test_multi_value_fact_is_kept_as_a_list():
+    arguments = json.dumps({
+        "desired_fact": ["Dosage"],
+        "fact_provided": {"Manufacturer": ["Kalbe", "Sanbe"], "General Indications": ["demam", " ", "sakit kepala"], "Drug Name": ["panadol"]}
+    })
+    desired_fact, fact_provided = asyncio.run(identify_facts_structured(ToolCallLLM([arguments]), "dosis obat demam dan sakit kepala buatan Kalbe atau Sanbe"))
+    assert desired_fact == ["Dosage"]
+    assert fact_provided == {"Manufaktur": ["Kalbe", "Sanbe"], "Indikasi Umum": ["demam", "sakit kepala"], "Nama Obat": "panadol"}
+
+def test_revised_multi_value_fact_is_kept_as_a_list():
+    arguments = json.dumps({"fact_provided": {"Manufacturer": ["Kalbe", "Dexa Medica"]}})
+    fact_provided = asyncio.run(revise_facts_structured(ToolCallLLM([arguments]), {"Manufaktur": "Kalbe"}, "bisa juga Dexa Medica"))
+    assert fact_provided == {"Manufaktur": ["Kalbe", "Dexa Medica"]}
+
+def test_list_with_non_string_items_is_rejected():
+    arguments = json.dumps({"desired_fact": [], "fact_provided": {"Manufacturer": ["Kalbe", 1]}})
+    with pytest.raises(ValueError):
+        parse_fact_arguments(arguments, FACTS_SCHEMA)